@@ -49,6 +49,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'django.contrib.gis',
+    'django.contrib.postgres', # For the trigram lookups in assets.search
 
     # dependencies
     'corsheaders',
@@ -187,6 +188,16 @@ REST_FRAMEWORK = {
 
 # Extra stuff
 GEOCODER_API_KEY = GEOCODIO_API_KEY
+# The geocoder URLs can be overridden (e.g., to point them at a local stub server).
+GEOCODIO_URL = 'https://api.geocod.io/v1.4/'
+GEOMANCER_URL = 'https://tools.wprdc.org/geo/geocode'
+GEOCODE_REQUESTS_PER_SECOND = 10 # Shared by all the requests from one BatchGeocoder
+GEOCODE_CACHE_TTL_DAYS = 180
+GEOCODE_NEGATIVE_CACHE_TTL_DAYS = 7 # For addresses that couldn't be geocoded
+
+BULK_UPDATE_UPLOAD_DIR = os.path.join(MEDIA_ROOT, 'bulk_updates') # Merge-instructions files waiting for the Asset updater
+ASSET_DUMP_DIR = os.path.join(MEDIA_ROOT, 'dumps') # Served at ASSET_DUMP_URL
+ASSET_DUMP_URL = MEDIA_URL + 'dumps/'
 
 
 CORS_ORIGIN_ALLOW_ALL = True
@@ -0,0 +1,644 @@
+import csv
+from collections import defaultdict
+
+from django.contrib.gis.geos import Point
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from assets.caching import bump_generation
+from assets.models import RawAsset, Asset, AssetType, Tag, TargetPopulation, ProvidedService, Location, Organization
+from assets.management.commands.util import standardize_phone
+from assets.search import refresh_search_index
+from assets.tasks import queue_carto_sync
+from assets.utils import distance
+
+# The engine behind the Asset updater (the merge-instructions upload at
+# /edit/update-assets/<using>/). The file is parsed once, every Asset, RawAsset,
+# Location, Organization, and lookup value (asset type, tag, service, target
+# population) that it refers to is loaded with a handful of __in queries, and
+# the rows are worked through in memory, building up the changes and the log
+# of what they do (more_results). In 'update' mode the changes are then written
+# with bulk_create/bulk_update and through-table inserts in one transaction, so
+# a file that fails partway through changes nothing.
+
+def there_is_a_field_to_update(row, fields_to_check):
+    """Scan record for certain fields and see if any exist
+    and are non-null (meaning that a Location could be
+    created."""
+    update_is_needed = False
+    for field in fields_to_check:
+        if field in row and row[field] not in ['', None]:
+            return True
+    return update_is_needed
+
+def boolify(x): # This differs from the assets.management.commands.util versiion of boolify.
+    if x.lower() in ['true', 't']:
+        return True
+    if x.lower() in ['false', 'f']:
+        return False
+    return None
+
+def eliminate_empty_strings(xs):
+    return [x for x in xs if x != '']
+
+def non_blank_type_or_none(row, field, desired_type): # This could be imported from elsewhere.
+    """This function tries to cast the value of row[field] to
+    the passed desired type (e.g, float or int). If it fails,
+    or if the passed value is an empty string (which is how
+    None values are passed by CSVs), it returns None.
+
+    Note that this does not yet support fields like
+    PhoneNumberField, URLField, and EmailField."""
+    if field in row:
+        if row[field] == '':
+            return None
+        if desired_type == bool:
+            return boolify(row[field])
+        try:
+            return desired_type(row[field])
+        except ValueError:
+            if desired_type == int:
+                try:
+                    return int(float(row[field])) # This is necessary to handle
+                    # cases where Excel obliviously appends ".0" to integers.
+                except ValueError:
+                    return None
+            return None
+    return None
+
+def pipe_delimit(xs):
+    return '|'.join([str(x) for x in xs])
+
+def split_ids(value):
+    return [int(i) for i in value.split('+')] if value not in ['', None] else []
+
+LOCATION_FIELDS = [('street_address', str), ('unit', str), ('unit_type', str), ('municipality', str),
+    ('city', str), ('state', str), ('zip_code', str), ('parcel_id', str), ('residence', bool), ('iffy_geocoding', bool)]
+LATER_LOCATION_FIELDS = [('available_transportation', str), ('geocoding_properties', str)]
+ASSET_FIELDS = [('url', str), ('email', str), ('hours_of_operation', str), ('holiday_hours_of_operation', str),
+    ('periodicity', str), ('capacity', int), ('wifi_network', str), ('wifi_notes', str), ('internet_access', bool),
+    ('computers_available', bool), ('accessibility', bool), ('open_to_public', bool), ('child_friendly', bool),
+    ('sensitive', bool), ('localizability', str), ('etl_notes', str)]
+
+# Everything the updater can change, for bulk_update.
+LOCATION_UPDATE_FIELDS = [f for f, _ in LOCATION_FIELDS + LATER_LOCATION_FIELDS] + ['latitude', 'longitude', 'geom', 'parent_location']
+ORGANIZATION_UPDATE_FIELDS = ['name', 'email', 'phone']
+ASSET_UPDATE_FIELDS = [f for f, _ in ASSET_FIELDS] + ['name', 'phone', 'do_not_display', 'location', 'organization', 'last_updated']
+
+# Many-to-many fields that the file can set, with the models of their values.
+# Asset types have to exist already, since a new asset type also needs a
+# Category before it can be mapped; the others are created as needed.
+M2M_FIELDS = {'asset_types': AssetType, 'tags': Tag, 'services': ProvidedService, 'hard_to_count_population': TargetPopulation}
+M2M_COLUMNS = {'asset_types': 'asset_type', 'tags': 'tags', 'services': 'services', 'hard_to_count_population': 'hard_to_count_population'}
+CREATABLE_M2M_FIELDS = ['tags', 'services', 'hard_to_count_population']
+
+PROGRESS_INTERVAL = 250 # rows
+
+def by_name(model, names):
+    """Map names to instances (the oldest one, if there are several with the same name)."""
+    return {instance.name: instance for instance in model.objects.filter(name__in=names).order_by('-id')}
+
+
+class AssetUpdater:
+    def __init__(self, rows, mode, using, progress=None):
+        assert using in ['using-raw-assets', 'using-assets']
+        self.rows = rows
+        self.mode = mode
+        self.using = using
+        self.more_results = []
+        self.rows_processed = 0
+        self.errors = 0
+        self.progress = progress # Called with the updater every PROGRESS_INTERVAL rows (and at the end)
+
+        self.new_assets, self.new_locations, self.new_organizations = [], [], []
+        self.saved_assets, self.saved_locations, self.saved_organizations, self.saved_raw_assets = {}, {}, {}, {}
+        self.foreign_keys = [] # (instance, field name, related instance) assignments to redo once the related instance has a pk
+        self.m2m_values = defaultdict(dict) # field name -> asset key -> (asset, list of related instances)
+        self.asset_ids_to_sync_to_carto = []
+
+    def log(self, s):
+        self.more_results.append(s)
+
+    def fail(self, s):
+        self.errors += 1
+        self.log(s)
+
+    def report_progress(self):
+        if self.progress is not None:
+            self.progress(self)
+
+    def would(self, future='will be '):
+        return future if self.mode == 'validate' else ''
+
+    ### BEGIN Loading
+    def ids_in(self, field, split=False):
+        ids = set()
+        for row in self.rows:
+            value = row.get(field, '')
+            if value not in ['', None, 'new']:
+                ids.update(split_ids(value) if split else [int(value)])
+        return ids
+
+    def preload(self):
+        if self.using == 'using-assets':
+            asset_ids = self.ids_in('id') | self.ids_in('ids_to_merge', split=True)
+            raw_asset_ids = set()
+        else:
+            asset_ids = self.ids_in('asset_id')
+            raw_asset_ids = self.ids_in('id') | self.ids_in('ids_to_merge', split=True)
+        self.assets = Asset.objects.in_bulk(list(asset_ids))
+
+        # The RawAssets named in the file, plus the ones linked to the Assets in it (which
+        # get relinked when Assets are merged and decide whether an Asset gets hidden).
+        self.raw_assets = RawAsset.objects.in_bulk(list(raw_asset_ids))
+        self.raw_assets.update({r.id: r for r in RawAsset.objects.filter(asset_id__in=list(asset_ids))})
+        self.raw_assets_by_asset = defaultdict(list)
+        self.raw_asset_owners = {} # RawAsset ID -> key of the Asset it links to
+        for raw_asset in self.raw_assets.values():
+            if raw_asset.asset_id is not None:
+                self.raw_assets_by_asset[raw_asset.asset_id].append(raw_asset)
+                self.raw_asset_owners[raw_asset.id] = raw_asset.asset_id
+
+        location_ids = self.ids_in('location_id') | self.ids_in('parent_location_id') | {a.location_id for a in self.assets.values() if a.location_id is not None}
+        self.locations = Location.objects.in_bulk(list(location_ids))
+        organization_ids = self.ids_in('organization_id') | {a.organization_id for a in self.assets.values() if a.organization_id is not None}
+        self.organizations = Organization.objects.in_bulk(list(organization_ids))
+        # The Locations and Organizations the Assets point to, as changed by the rows so far
+        self.asset_locations, self.asset_organizations = {}, {}
+
+        self.lookups, self.current_m2m_names = {}, defaultdict(dict)
+        for field_name, model in M2M_FIELDS.items():
+            names = set()
+            for row in self.rows:
+                names.update(eliminate_empty_strings(row.get(M2M_COLUMNS[field_name], '').split('|')))
+            self.lookups[field_name] = by_name(model, list(names))
+            field = Asset._meta.get_field(field_name)
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+            current = defaultdict(list)
+            for asset_id, name in field.remote_field.through.objects.filter(**{f'{source}_id__in': list(self.assets.keys())}).values_list(f'{source}_id', f'{target}__name').order_by('id'):
+                current[asset_id].append(name)
+            self.current_m2m_names[field_name] = current
+    ### END Loading
+
+    ### BEGIN Validation
+    def validate(self):
+        """Check that everything the file refers to exists (and that the required
+        columns are there), returning an error message or None."""
+        if self.rows:
+            missing_columns = [c for c in ['id', 'ids_to_merge', 'name', 'asset_type'] + (['asset_id'] if self.using == 'using-raw-assets' else []) if c not in self.rows[0]]
+            if missing_columns:
+                return f"The merge-instructions file is missing these columns: {', '.join(missing_columns)}. ASSET UPDATER FAILURE."
+        for row in self.rows:
+            try:
+                if self.using == 'using-assets':
+                    if 'asset_id' in row and row['asset_id'] not in ['']:
+                        return f"id should be blank but is actually {row['asset_id']}. ASSET UPDATER FAILURE."
+                    if row['id'] in ['', None]:
+                        return f"Every row needs an id. ASSET UPDATER FAILURE."
+                    if int(row['id']) not in self.assets:
+                        return f"Failed to find Asset with id == {row['id']}. ASSET UPDATER FAILURE."
+                    asset_ids = split_ids(row['ids_to_merge'])
+                    if any(i not in self.assets for i in asset_ids):
+                        return f"Failed to find Assets with ids == {asset_ids}. ASSET UPDATER FAILURE."
+                else:
+                    if int(row['id']) not in self.raw_assets:
+                        return f"Failed to find RawAsset with id == {row['id']}. ASSET UPDATER FAILURE."
+                    if row['asset_id'] not in ['', None] and int(row['asset_id']) not in self.assets:
+                        return f"Failed to find Asset with id == {row['asset_id']}. ASSET UPDATER FAILURE."
+                    raw_ids = split_ids(row['ids_to_merge'])
+                    if any(i not in self.raw_assets for i in raw_ids):
+                        return f"Failed to find RawAssets with ids == {raw_ids}. ASSET UPDATER FAILURE."
+            except ValueError as e:
+                return f"Unable to parse an ID in the row {row}: {e}. ASSET UPDATER FAILURE."
+            for field in ['location_id', 'parent_location_id']:
+                if row.get(field, '') not in ['', None, 'new'] and int(row[field]) not in self.locations:
+                    return f"Failed to find Location with id == {row[field]}. ASSET UPDATER FAILURE."
+            if row.get('organization_id', '') not in ['', None, 'new'] and int(row['organization_id']) not in self.organizations:
+                return f"Failed to find Organization with id == {row['organization_id']}. ASSET UPDATER FAILURE."
+        return None
+    ### END Validation
+
+    ### BEGIN Planning
+    def key(self, asset):
+        return asset.id if asset.id is not None else ('new', id(asset))
+
+    def location_of(self, asset):
+        if self.key(asset) in self.asset_locations:
+            return self.asset_locations[self.key(asset)]
+        return self.locations.get(asset.location_id)
+
+    def organization_of(self, asset):
+        if self.key(asset) in self.asset_organizations:
+            return self.asset_organizations[self.key(asset)]
+        return self.organizations.get(asset.organization_id)
+
+    def link(self, raw_asset, asset, change_reason):
+        if raw_asset.id in self.raw_asset_owners:
+            self.raw_assets_by_asset[self.raw_asset_owners[raw_asset.id]].remove(raw_asset)
+        self.raw_assets_by_asset[self.key(asset)].append(raw_asset)
+        self.raw_asset_owners[raw_asset.id] = self.key(asset)
+        self.foreign_keys.append((raw_asset, 'asset', asset))
+        raw_asset.asset = asset
+        raw_asset._change_reason = change_reason
+        if self.mode == 'update':
+            self.saved_raw_assets[raw_asset.id] = raw_asset
+
+    def save_asset(self, asset, change_reason):
+        """Do what Asset.save would: hide Assets that no RawAssets link to."""
+        if len(self.raw_assets_by_asset[self.key(asset)]) == 0:
+            asset.do_not_display = True
+        asset._change_reason = change_reason
+        if asset.id is not None:
+            self.saved_assets[asset.id] = asset
+        self.asset_ids_to_sync_to_carto.append(asset)
+
+    def check_or_update_value(self, instance, row, source_field_name, field_type=str):
+        if source_field_name not in row:
+            return
+        new_value = non_blank_type_or_none(row, source_field_name, field_type)
+        old_value = getattr(instance, source_field_name)
+        if new_value != old_value:
+            self.log(f"{source_field_name} {self.would()}changed from {old_value} to {new_value}.")
+            setattr(instance, source_field_name, new_value)
+
+    def set_m2m_values(self, row, destination_asset, created_new_asset, field_name):
+        """Returns True if there's an error."""
+        source_field_name = M2M_COLUMNS[field_name]
+        if source_field_name not in row:
+            return False
+        new_values = eliminate_empty_strings(row[source_field_name].split('|'))
+        if created_new_asset:
+            list_of_old_values = []
+        elif self.key(destination_asset) in self.m2m_values[field_name]: # Set by an earlier row
+            list_of_old_values = [v.name for v in self.m2m_values[field_name][self.key(destination_asset)][1]]
+        else:
+            list_of_old_values = self.current_m2m_names[field_name][destination_asset.id]
+        if set(new_values) == set(list_of_old_values):
+            return False
+        self.log(f"{source_field_name} {self.would()}changed from {pipe_delimit(list_of_old_values)} to {pipe_delimit(new_values)}.")
+        lookup = self.lookups[field_name]
+        if field_name == 'asset_types':
+            if new_values == []:
+                self.log(f"asset_type can not be empty\n ABORTING!!!\n<hr>")
+                return True
+            if any(v not in lookup for v in new_values):
+                self.log(f"Unable to find one of these asset types: {new_values}.\n ABORTING!!!\n<hr>")
+                return True
+        else:
+            for value in new_values:
+                if value not in lookup: # get_or_create, with the creation deferred to apply()
+                    lookup[value] = M2M_FIELDS[field_name](name=value)
+        if self.mode == 'update':
+            self.m2m_values[field_name][self.key(destination_asset)] = (destination_asset, [lookup[v] for v in new_values])
+        return False
+
+    def modify_destination_asset(self, row, destination_asset, created_new_asset):
+        """Returns the destination Asset's Location and Organization, and whether there's an error."""
+        if 'location_id' in row:
+            location_id = row['location_id']
+            if location_id in ['', None, 'new']:
+                # Create a new Location instance to be populated.
+                location = None # Location creation happens below.
+            else:
+                location = self.locations[int(location_id)]
+        else: # If the location_id field is omitted from the merge instructions,
+            # fall back to the destination asset's location (which may be None).
+            location = self.location_of(destination_asset)
+
+        # The Location.name field is not updated here since we may want to manually name Location instances,
+        # particularly to deal with cases like the two restaurant locations in Schenley Plaza that have the same
+        # street address and parcel ID but slightly different geocoordinates.
+        if location is None:
+            if there_is_a_field_to_update(row, ['street_address', 'municipality', 'city', 'state', 'zip_code', 'parcel_id', 'latitude', 'longitude']):
+                if self.mode == 'update':
+                    self.log(f"Creating a new Location for this Asset.")
+                else:
+                    self.log(f"A new Location would be created for this Asset.")
+                location = Location()
+                self.new_locations.append(location)
+            elif there_is_a_field_to_update(row, ['residence', 'iffy_geocoding', 'unit', 'unit_type', 'available_transportation', 'geocoding_properties']):
+                self.log("There is not enough information to create a new location for this Asset, but there are fields in the merge-instructions file which need to be assigned to a Location. Does not compute! ABORTING!!!<hr>")
+                return None, None, True
+
+        if 'organization_id' in row:
+            organization_id = row['organization_id']
+            if organization_id in ['', None, 'new']:
+                organization = None # Organization creation happens below.
+            else:
+                organization = self.organizations[int(organization_id)]
+        else: # If the organization_id field is omitted from the merge instructions,
+            # fall back to the destination asset's organization (which may be None).
+            organization = self.organization_of(destination_asset)
+
+        asset_name = row['name']
+        if asset_name != destination_asset.name:
+            self.log(f"asset_name {self.would()}changed from {destination_asset.name} to {asset_name}.")
+            destination_asset.name = asset_name
+
+        # [ ] Oddball legacy conversion to be deleted:
+        if 'accessibility_features' in row:
+            new_value = boolify(row['accessibility_features'])
+            old_value = destination_asset.accessibility
+            if new_value != old_value:
+                self.log(f"accessibility_features {self.would()}changed from {old_value} to {new_value}.")
+                destination_asset.accessibility = new_value
+
+        # The organization can be identified EITHER by the organization_id value or by the organization_name value.
+        missing_organization_identifier = row.get('organization_name', '') in ['', None] and row.get('organization_id', '') in ['', None]
+        if missing_organization_identifier:
+            if row.get('organization_phone', '') != '' or row.get('organization_email', '') != '':
+                self.log(f"The organization's name or ID value is required if you want to change either the phone or e-mail address (as a check that the correct Organization instance is being updated. ABORTING!!!!\n<hr>.")
+                return None, None, True
+        else:
+            if organization is None:
+                if self.mode == 'update':
+                    self.log(f"Creating a new Organization for this Asset.")
+                else:
+                    self.log(f"A new Organization would be created for this Asset.")
+                organization = Organization() # Create new organization instance.
+                self.new_organizations.append(organization)
+
+            new_value = non_blank_type_or_none(row, 'organization_name', str)
+            if new_value != organization.name:
+                self.log(f"organization.name {self.would()}changed from {organization.name} to {new_value}.")
+                organization.name = new_value
+            if 'organization_email' in row:
+                new_value = non_blank_type_or_none(row, 'organization_email', str)
+                if new_value != organization.email:
+                    self.log(f"organization.email {self.would()}changed from {organization.email} to {new_value}.")
+                    organization.email = new_value
+            if 'organization_phone' in row:
+                new_value = standardize_phone(non_blank_type_or_none(row, 'organization_phone', str))
+                if new_value != organization.phone:
+                    self.log(f"organization.phone {self.would()}changed from {organization.phone} to {new_value}.")
+                    organization.phone = new_value
+
+        if location is not None:
+            for field_name, field_type in LOCATION_FIELDS:
+                self.check_or_update_value(location, row, field_name, field_type)
+
+            if 'latitude' in row or 'longitude' in row:
+                old_latitude, old_longitude = location.latitude, location.longitude
+                self.check_or_update_value(location, row, 'latitude', float)
+                self.check_or_update_value(location, row, 'longitude', float)
+                dist = distance(old_latitude, old_longitude, location.latitude, location.longitude)
+                if dist is not None:
+                    self.log(f"&nbsp;&nbsp;&nbsp;&nbsp;The distance between the old and new coordinates is {dist:.2f} feet.")
+                if (old_latitude, old_longitude) != (location.latitude, location.longitude) and location.pk is not None:
+                    # Location.save only sets geom when it's missing, which left geom stale here.
+                    location.geom = Point((float(location.longitude), float(location.latitude))) if location.latitude and location.longitude else None
+
+            for field_name, field_type in LATER_LOCATION_FIELDS:
+                self.check_or_update_value(location, row, field_name, field_type)
+
+            # BEGIN Handle parent_location and parent_location_id
+            new_value = non_blank_type_or_none(row, 'parent_location_id', str)
+            old_value = location.parent_location_id
+            if 'parent_location_id' in row and new_value != (str(old_value) if old_value is not None else None):
+                self.log(f"parent_location_id {self.would()}changed from {old_value} to {new_value}.")
+                location.parent_location = self.locations[int(new_value)] if new_value is not None else None
+
+            if 'parent_location' in row:
+                parent_location = self.locations.get(location.parent_location_id) or (location.parent_location if location.parent_location_id is not None else None)
+                parent_location_name = getattr(parent_location, 'name', None)
+                self.log(f"The parent_location name (after any parent_location_id updates) {'would be' if self.mode == 'validate' else 'is'} {parent_location_name}. [The 'parent_location' value in the merge-instructions file is not used to make updates.]")
+            # END Handle parent_location and parent_location_id
+
+        for field_name, field_type in ASSET_FIELDS[:2]: # url and email
+            self.check_or_update_value(destination_asset, row, field_name, field_type)
+        if 'phone' in row:
+            new_value = standardize_phone(non_blank_type_or_none(row, 'phone', str))
+            old_value = destination_asset.phone
+            if new_value != old_value:
+                self.log(f"phone {self.would()}changed from {old_value} to {new_value}.")
+                destination_asset.phone = new_value
+        for field_name, field_type in ASSET_FIELDS[2:]:
+            self.check_or_update_value(destination_asset, row, field_name, field_type)
+
+        if created_new_asset and self.mode == 'update':
+            # A new Asset is saved once before any RawAssets are linked to it (so that
+            # it has an id for the many-to-many relations), which hides it.
+            destination_asset.do_not_display = True
+        # do_not_display must be set after that initial save since a new asset
+        # could be initially locationless and therefore have do_not_display
+        # auto-set to True.
+        self.check_or_update_value(destination_asset, row, 'do_not_display', bool)
+
+        for field_name in M2M_FIELDS:
+            if self.set_m2m_values(row, destination_asset, created_new_asset, field_name):
+                return None, None, True
+
+        # Fields that don't need to be updated: primary_key_from_rocket, synthesized_key, data_source_name, data_source_url
+        return location, organization, False
+
+    def plan_row(self, row):
+        """Work out the changes for one row, returning True if there's an error."""
+        created_new_asset = False
+        raw_assets = []
+        ids_to_merge = row['ids_to_merge']
+        if self.using == 'using-raw-assets':
+            asset_id = row['asset_id']
+            if asset_id in ['', None]:
+                created_new_asset = True
+                destination_asset = Asset()
+                self.log(f"A new Asset {'would' if self.mode == 'validate' else 'will'} be created.")
+            else:
+                destination_asset = self.assets[int(asset_id)]
+
+            if ids_to_merge == '':
+                return False # Skip rows with no ids to merge.
+            if created_new_asset:
+                self.new_assets.append(destination_asset)
+            raw_assets = [self.raw_assets[i] for i in split_ids(ids_to_merge)]
+            for raw_asset in raw_assets:
+                self.link(raw_asset, destination_asset, f'Asset Updater: Linking to {"new " if created_new_asset else ""}Asset')
+
+            prefix = 'Validating this process: ' if self.mode == 'validate' else ''
+            if len(raw_assets) == 1:
+                if created_new_asset:
+                    summary = f"{prefix}Creating a new Asset, "
+                else:
+                    summary = f"{prefix}Editing the Asset with id = {asset_id}, previously named {destination_asset.name}, "
+                summary += f"and linking it to RawAsset with id = {raw_assets[0].id} and name = {raw_assets[0].name}."
+            else:
+                summary = f"{prefix}Merging RawAssets with ids = {', '.join([str(r.id) for r in raw_assets])} and names = {', '.join([r.name for r in raw_assets])} "
+                if created_new_asset:
+                    summary += f" to a new Asset with name {row.get('name', '(No name given)')}."
+                else:
+                    summary += f" to Asset with id = {asset_id}, previously named {destination_asset.name}."
+            self.log(summary)
+
+        else:
+            destination_asset = self.assets[int(row['id'])] # Here the primary asset is also the destination asset.
+            # When merging Assets, the Asset that is not the destination
+            # asset should be delisted.
+            if self.mode == 'update':
+                if ids_to_merge == '':
+                    destination_asset.do_not_display = True
+                    self.save_asset(destination_asset, f'Asset Updater: Delisting Asset')
+                    self.log(f"Delisting {destination_asset.name}.")
+                    return False # Skip rows with no ids to merge.
+                asset_ids = split_ids(ids_to_merge)
+                if destination_asset.id not in asset_ids:
+                    self.log(f"The id {destination_asset.id} is not one of the ids_to_merge ({ids_to_merge}). ABORTING!!!\n<hr>")
+                    return True
+
+                self.log(f"Editing the Asset with id = {destination_asset.id}, previously named {destination_asset.name}.")
+                if len(asset_ids) > 1:
+                    self.log(f"Delisting extra Assets (from the list {ids_to_merge}) and assigning corresponding RawAssets to the destination Asset.")
+
+                for asset_id in asset_ids:
+                    if asset_id != destination_asset.id:
+                        asset = self.assets[asset_id]
+                        # Reassign the RawAssets of this Asset to destination_asset
+                        # (after which this Asset could be deleted rather than delisted).
+                        for raw_asset in list(self.raw_assets_by_asset[asset_id]):
+                            self.link(raw_asset, destination_asset, f'Asset Updater: Linking RawAsset to different Asset because of Asset merge')
+                        asset.do_not_display = True
+                        self.save_asset(asset, f'Asset Updater: Delisting Asset')
+            else:
+                if '+' in ids_to_merge:
+                    self.log(f"Extra Assets (from the list {ids_to_merge}) would be delisted and corresponding RawAssets would be assigned to the destination Asset.")
+                elif ids_to_merge == '':
+                    self.log(f"{destination_asset.name} would be delisted.")
+
+        ### At this point the fields that differentiate Asset-based Asset updates from
+        ### RawAsset-based Asset updates have been processed.
+        location, organization, error = self.modify_destination_asset(row, destination_asset, created_new_asset)
+        if error:
+            return True
+
+        if self.mode == 'update':
+            self.log(f"Updating associated Asset, RawAsset, Location, and Organization instances. (This may leave some orphaned.)\n")
+            change_reason = f'Asset Updater: {"Creating new " if created_new_asset else "Updating "}Asset'
+            if organization is not None:
+                organization._change_reason = change_reason
+                if organization.pk is not None:
+                    self.saved_organizations[organization.pk] = organization
+            if location is not None:
+                location._change_reason = change_reason
+                if location.pk is not None:
+                    self.saved_locations[location.pk] = location
+            self.asset_locations[self.key(destination_asset)] = location
+            self.asset_organizations[self.key(destination_asset)] = organization
+            self.foreign_keys += [(destination_asset, 'location', location), (destination_asset, 'organization', organization)]
+            self.save_asset(destination_asset, change_reason)
+            self.destinations.append((destination_asset, location))
+        else:
+            self.log(f"\n<hr>")
+        return False
+
+    def plan(self):
+        """Returns True if there's an error."""
+        self.destinations = []
+        for row in self.rows:
+            if self.plan_row(row):
+                self.errors += 1
+                return True
+            self.rows_processed += 1
+            if self.rows_processed % PROGRESS_INTERVAL == 0:
+                self.report_progress()
+        return False
+    ### END Planning
+
+    ### BEGIN Applying
+    def redo_foreign_keys(self):
+        # Assigning a related instance before it was saved leaves the _id field empty,
+        # so assign them again once the related instances have been created.
+        for instance, field_name, related in self.foreign_keys:
+            setattr(instance, field_name, related)
+
+    def write_m2m_values(self):
+        for field_name, values in self.m2m_values.items():
+            field = Asset._meta.get_field(field_name)
+            through = field.remote_field.through
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+            through.objects.filter(**{f'{source}_id__in': [asset.id for asset, _ in values.values()]}).delete()
+            through.objects.bulk_create([through(**{f'{source}_id': asset.id, f'{target}_id': related.id})
+                for asset, related_instances in values.values() for related in dict.fromkeys(related_instances)], batch_size=1000)
+
+    def apply(self):
+        now = timezone.now()
+        with transaction.atomic():
+            for field_name in CREATABLE_M2M_FIELDS:
+                new_values = [v for v in self.lookups[field_name].values() if v.pk is None]
+                M2M_FIELDS[field_name].objects.bulk_create(new_values)
+
+            for location in self.new_locations:
+                location.fill_in_derived_fields()
+                location._change_reason = getattr(location, '_change_reason', 'Asset Updater: Creating new Location')
+            Organization.objects.bulk_create(self.new_organizations)
+            Location.objects.bulk_create(self.new_locations)
+            self.redo_foreign_keys()
+            Asset.objects.bulk_create(self.new_assets)
+            self.redo_foreign_keys()
+
+            Organization.objects.bulk_update(list(self.saved_organizations.values()), ORGANIZATION_UPDATE_FIELDS, batch_size=1000)
+            Location.objects.bulk_update(list(self.saved_locations.values()), LOCATION_UPDATE_FIELDS, batch_size=1000)
+            for asset in self.saved_assets.values():
+                asset.last_updated = now # (bulk_update skips auto_now.)
+            Asset.objects.bulk_update(list(self.saved_assets.values()), ASSET_UPDATE_FIELDS, batch_size=1000)
+            RawAsset.objects.bulk_update(list(self.saved_raw_assets.values()), ['asset'], batch_size=1000)
+            self.write_m2m_values()
+
+            for model, created, updated in [(Organization, self.new_organizations, self.saved_organizations.values()),
+                    (Location, self.new_locations, self.saved_locations.values()),
+                    (Asset, self.new_assets, self.saved_assets.values()),
+                    (RawAsset, [], self.saved_raw_assets.values())]:
+                if created:
+                    model.history.bulk_history_create(created, batch_size=1000)
+                if updated:
+                    model.history.bulk_history_create(list(updated), batch_size=1000, update=True)
+
+        # bulk_create and bulk_update don't send signals, so do what the save signals would have.
+        bump_generation('asset')
+        bump_generation('location')
+        bump_generation('organization')
+        self.asset_ids_to_sync_to_carto = list(dict.fromkeys(asset.id for asset in self.asset_ids_to_sync_to_carto))
+        queue_carto_sync(self.asset_ids_to_sync_to_carto)
+        refresh_search_index(set(self.asset_ids_to_sync_to_carto) | set(Asset.objects.filter(
+            Q(organization__in=list(self.saved_organizations.values())) | Q(location__in=list(self.saved_locations.values())))
+            .values_list('id', flat=True)))
+
+        for destination_asset, location in self.destinations:
+            self.log(f'&nbsp;&nbsp;&nbsp;&nbsp;<a href="https://assets.wprdc.org/api/dev/assets/assets/{destination_asset.id}/" target="_blank">Updated Asset</a>\n')
+            if location is not None:
+                self.log(f'&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<a href="https://assets.wprdc.org/api/dev/assets/locations/{location.id}/" target="_blank">Linked Location</a>\n<hr>')
+    ### END Applying
+
+    def run(self):
+        """Validate, plan, and (in 'update' mode) apply the file, returning more_results."""
+        try:
+            self.preload()
+        except ValueError as e:
+            self.fail(f"Unable to parse the IDs in the merge-instructions file: {e}. ASSET UPDATER FAILURE.")
+            self.report_progress()
+            return self.more_results
+        error = self.validate()
+        if error is not None:
+            self.fail(error)
+            self.report_progress()
+            return self.more_results
+        if self.plan():
+            if self.mode == 'update':
+                self.log("Nothing has been changed, since the whole file is applied at once.")
+            self.report_progress()
+            return self.more_results
+        self.report_progress()
+        if self.mode == 'update':
+            self.apply()
+            self.log(f"\nasset_ids_to_sync_to_carto = {self.asset_ids_to_sync_to_carto}")
+        else:
+            self.log(f"\nasset_ids_to_sync_to_carto = []")
+        self.report_progress()
+        return self.more_results
+
+def read_merge_instructions(file_path):
+    with open(file_path, newline='', encoding='utf-8-sig') as f:
+        return list(csv.DictReader(f))
+
+def update_assets_from_csv(lines, mode, using, progress=None):
+    """Run merge instructions (the lines of a CSV file) through the Asset updater."""
+    rows = list(csv.DictReader(lines))
+    return AssetUpdater(rows, mode, using, progress).run()
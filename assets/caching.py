@@ -0,0 +1,155 @@
+import hashlib, json, time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.utils.timezone import utc
+
+RESPONSE_CACHE_TIMEOUT = getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 24*60*60) # Entries are invalidated
+# by generation bumps, so this only bounds how long unused entries hang around.
+
+
+def generation_key(label):
+    return f'generation:{label}'
+
+def get_generation(label):
+    """Return the current generation number for a kind of data (like
+    'asset' or 'location'). Cache keys that include the generation
+    are implicitly invalidated when it gets bumped."""
+    key = generation_key(label)
+    generation = cache.get(key)
+    if generation is None:
+        # Start from the clock rather than from 1 so that an evicted counter
+        # can't roll back to a number that stale entries were stored under.
+        cache.add(key, int(time.time()), timeout=None)
+        generation = cache.get(key, int(time.time()))
+    return generation
+
+def get_generations(labels):
+    """Like get_generation, but for several labels in one cache request."""
+    found = cache.get_many([generation_key(label) for label in labels])
+    return [found.get(generation_key(label)) or get_generation(label) for label in labels]
+
+def bumped_at_key(label):
+    return f'generation-bumped-at:{label}'
+
+def bump_generation(label):
+    cache.set(bumped_at_key(label), time.time(), timeout=None)
+    try:
+        return cache.incr(generation_key(label))
+    except ValueError: # The counter isn't in the cache (yet or anymore).
+        return get_generation(label)
+
+def last_bumped(labels):
+    """Return when the most recently bumped of the labels' generations was
+    bumped (as an aware datetime), or None if there are no labels."""
+    if not labels:
+        return None
+    found = cache.get_many([bumped_at_key(label) for label in labels])
+    times = []
+    for label in labels:
+        bumped_at = found.get(bumped_at_key(label))
+        if bumped_at is None:
+            # Nobody knows when this one was last bumped, so count it as now
+            # (which can only cost a 200 where a 304 would have done).
+            cache.add(bumped_at_key(label), time.time(), timeout=None)
+            bumped_at = cache.get(bumped_at_key(label), time.time())
+        times.append(bumped_at)
+    return datetime.fromtimestamp(int(max(times)), tz=utc)
+
+
+class GenerationCacheMixin:
+    """Serve a viewset's list and detail responses from the cache until one of
+    the generations in cache_generations gets bumped (see assets.signals).
+
+    The rendered response is cached, keyed by the generations, the path, the
+    query parameters, and the negotiated media type, so JSON, CSV, and GeoJSON
+    versions are cached separately. The browsable API isn't cached, since its
+    pages depend on the user."""
+    cache_generations = ()
+
+    def response_cache_key(self, request):
+        if request.accepted_renderer.format == 'api':
+            return None
+        generations = ':'.join(str(g) for g in get_generations(self.cache_generations))
+        request_id = json.dumps([request.path, sorted(request.query_params.lists()), request.accepted_media_type])
+        return f"response:{generations}:{hashlib.sha1(request_id.encode('utf-8')).hexdigest()}"
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        key = self.response_cache_key(request)
+        if key is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                content, content_type = cached
+                return HttpResponse(content, content_type=content_type)
+            request.response_cache_key = key # finalize_response stores the rendered response under this key.
+        return handler(request, *args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        key = getattr(request, 'response_cache_key', None)
+        if key is not None and response.status_code == 200:
+            response.render()
+            # Memcached refuses values over 1 MB, so the biggest pages just don't get cached.
+            cache.set(key, (response.content, response['Content-Type']), RESPONSE_CACHE_TIMEOUT)
+        return response
+
+
+class ConditionalGetMixin:
+    """Give a viewset's list and detail responses ETag and Last-Modified
+    headers, and answer If-None-Match and If-Modified-Since requests for
+    unchanged data with a 304 (and no body).
+
+    The validators are computed without serializing anything: for a model with
+    a last_modified_field, one aggregate query over the filtered queryset
+    (its latest last_modified_field value and its row count, the count
+    catching deletions) plus the generations (see bump_generation) of the
+    related kinds of data in validator_generations, which change without
+    touching last_modified_field; for other models, just the generations of
+    validator_generations. The path, query parameters, and negotiated media
+    type go into the ETag, so each page, filter, and format gets its own."""
+    last_modified_field = None
+    validator_generations = ()
+
+    def conditional_validators(self, request, queryset):
+        last_modified = last_bumped(self.validator_generations)
+        count = None
+        if self.last_modified_field is not None:
+            stats = queryset.order_by().aggregate(latest=Max(self.last_modified_field), count=Count('pk'))
+            count = stats['count']
+            if stats['latest'] is not None and (last_modified is None or stats['latest'] > last_modified):
+                last_modified = stats['latest'].replace(microsecond=0) # HTTP dates only go down to the second.
+        validator_id = json.dumps([request.path, sorted(request.query_params.lists()), request.accepted_media_type,
+            get_generations(self.validator_generations), count, last_modified.isoformat() if last_modified else None])
+        return quote_etag(hashlib.sha1(validator_id.encode('utf-8')).hexdigest()), last_modified
+
+    def conditional_response(self, handler, request, queryset, *args, **kwargs):
+        etag, last_modified = self.conditional_validators(request, queryset)
+        last_modified_timestamp = int(last_modified.timestamp()) if last_modified else None
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified_timestamp)
+        if not_modified is not None:
+            return not_modified
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            response['ETag'] = etag
+            if last_modified_timestamp is not None:
+                response['Last-Modified'] = http_date(last_modified_timestamp)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, self.filter_queryset(self.get_queryset()), *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.get_queryset().filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        return self.conditional_response(super().retrieve, request, queryset, *args, **kwargs)
@@ -0,0 +1,69 @@
+import hashlib, json
+
+from django.db import transaction
+from django.utils import timezone
+
+from assets.marker_offsets import iter_offset_asset_rows
+from assets.models import CartoSyncRecord
+from assets.util_carto import CartoSyncSession, DEFAULT_CARTO_FIELDS
+
+
+def carto_projection(fields=DEFAULT_CARTO_FIELDS):
+    """Return a dict mapping Asset IDs to the rows that belong in the Carto
+    table (with offset geocoordinates), computed in a single query."""
+    projection = {}
+    for row in iter_offset_asset_rows():
+        if row['do_not_display'] == True: # (A missing asset type or category goes up as NULL, as in CartoSyncSession.sync_assets.)
+            continue
+        if row['latitude'] in [None, 0] or row['longitude'] in [None, 0]: # See validate_asset.
+            continue
+        projection[row['id']] = {field: row[field] for field in fields}
+    return projection
+
+def fingerprint(row, fields=DEFAULT_CARTO_FIELDS):
+    values = [round(row[f], 9) if f in ['latitude', 'longitude'] else row[f] for f in fields]
+    return hashlib.sha1(json.dumps(values, default=str).encode('utf-8')).hexdigest()
+
+def incremental_sync(session=None, dry_run=False):
+    """Push only the Carto rows that have changed since the last sync, using
+    the CartoSyncRecord journal. New rows are inserted (or updated, if Carto
+    already has them), changed rows are updated, and rows for Assets that have
+    been deleted or hidden are deleted. If the journal is empty, the Carto IDs
+    are fetched once to bootstrap it."""
+    session = session or CartoSyncSession()
+    projection = carto_projection(session.fields)
+    fingerprints = {asset_id: fingerprint(row, session.fields) for asset_id, row in projection.items()}
+    journal = dict(CartoSyncRecord.objects.values_list('asset_id', 'fingerprint'))
+
+    changed_ids = [i for i, fp in fingerprints.items() if i in journal and journal[i] != fp]
+    new_ids = [i for i in fingerprints if i not in journal]
+    if journal:
+        delisted_ids = [i for i in journal if i not in projection]
+        on_carto = set(int(i) for i in session.get_asset_ids(new_ids)) if new_ids else set()
+    else:
+        print("The Carto sync journal is empty, so fetching all the IDs from the Carto table.")
+        on_carto = set(int(i) for i in session.get_asset_ids())
+        delisted_ids = [i for i in on_carto if i not in projection]
+    to_update = changed_ids + [i for i in new_ids if i in on_carto]
+    to_insert = [i for i in new_ids if i not in on_carto]
+
+    print(f"Found {len(changed_ids)} changed, {len(new_ids)} new, and {len(delisted_ids)} delisted Assets out of {len(projection)} displayable ones.")
+    if dry_run:
+        return {'deleted': len(delisted_ids), 'updated': len(to_update), 'inserted': len(to_insert)}
+
+    counts = {
+        'deleted': session.delete_assets(delisted_ids),
+        'updated': session.update_assets([projection[i] for i in to_update]),
+        'inserted': session.insert_assets([projection[i] for i in to_insert]),
+    }
+
+    # Only record what was pushed after Carto has accepted it, so that a failed
+    # run gets retried in full next time.
+    now = timezone.now()
+    with transaction.atomic():
+        CartoSyncRecord.objects.filter(asset_id__in=changed_ids + delisted_ids).delete()
+        CartoSyncRecord.objects.bulk_create([CartoSyncRecord(asset_id=i, fingerprint=fingerprints[i], synced_at=now)
+            for i in changed_ids + new_ids], batch_size=1000)
+
+    print(f"Deleted {counts['deleted']}, updated {counts['updated']}, and inserted {counts['inserted']} Carto records in {session.requests_sent} requests.")
+    return counts
@@ -0,0 +1,94 @@
+import hashlib, os, tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from assets.caching import get_generations
+from assets.models import Asset, AssetDump
+
+# Asset dumps are written to a temporary file and renamed into ASSET_DUMP_DIR
+# when they're complete, so a half-written dump is never served. Each dump is
+# named for its version (the latest last_updated plus the number of Assets,
+# plus the generations of the other data in the CSV, like Locations and
+# Organizations), so until any of that is added, changed, or deleted, the
+# last dump can be handed out again instead of making a new one.
+
+ASSET_DUMP_DIR = getattr(settings, 'ASSET_DUMP_DIR', os.path.join(settings.MEDIA_ROOT, 'dumps'))
+ASSET_DUMP_URL = getattr(settings, 'ASSET_DUMP_URL', settings.MEDIA_URL + 'dumps/')
+DEFAULT_SECONDS_PER_ASSET = 7*60/32731 # The old rule of thumb (7 minutes for 32,731 Assets), for before there are any timings
+# Changes to these (like regeocode_locations' bulk updates) don't touch Asset.last_updated.
+RELATED_GENERATIONS = ('location', 'organization', 'asset_type', 'category', 'asset_attribute')
+MIN_EXPECTED_DUMP_TIME = timedelta(minutes=5)
+
+def current_version():
+    stats = Asset.objects.aggregate(latest=Max('last_updated'), count=Count('id'))
+    latest = stats['latest'].strftime('%Y%m%dT%H%M%S%f') if stats['latest'] else 'empty'
+    generations = ':'.join(str(g) for g in get_generations(RELATED_GENERATIONS))
+    return f"{latest}-{stats['count']}-{hashlib.sha1(generations.encode('utf-8')).hexdigest()[:12]}"
+
+def dump_path(dump):
+    return os.path.join(ASSET_DUMP_DIR, dump.file_name)
+
+def dump_url(dump):
+    return ASSET_DUMP_URL + dump.file_name
+
+def reusable_dump(version):
+    """The dump for this version that is done (with its file still there) or
+    on its way, if there is one."""
+    dump = AssetDump.objects.filter(version=version).exclude(status=AssetDump.FAILED).order_by('-id').first()
+    if dump is None:
+        return None
+    if dump.status == AssetDump.DONE and not os.path.exists(dump_path(dump)):
+        return None
+    if dump.status in [AssetDump.QUEUED, AssetDump.RUNNING] and is_abandoned(dump):
+        # The worker died or the task was lost, so this one is never finishing.
+        dump.status = AssetDump.FAILED
+        dump.finished_at = timezone.now()
+        dump.save(update_fields=['status', 'finished_at'])
+        return None
+    return dump
+
+def is_abandoned(dump):
+    """Whether a queued or running dump has taken more than twice as long as
+    it should have (counting from when it was queued, or a few minutes at
+    least, to leave room for waiting in the task queue)."""
+    record_count = dump.record_count if dump.record_count is not None else Asset.objects.count()
+    expected = max(timedelta(seconds=seconds_per_asset()*record_count), MIN_EXPECTED_DUMP_TIME)
+    return timezone.now() > (dump.started_at or dump.created_at) + 2*expected
+
+def seconds_per_asset():
+    """The average rate of the last few dumps."""
+    recent = AssetDump.objects.filter(status=AssetDump.DONE, record_count__gt=0,
+        started_at__isnull=False, finished_at__isnull=False).order_by('-finished_at')[:5]
+    rates = [dump.duration/dump.record_count for dump in recent]
+    return sum(rates)/len(rates) if rates else DEFAULT_SECONDS_PER_ASSET
+
+def estimated_completion_time(dump):
+    if dump.status in [AssetDump.DONE, AssetDump.FAILED]:
+        return dump.finished_at
+    record_count = dump.record_count if dump.record_count is not None else Asset.objects.count()
+    return (dump.started_at or timezone.now()) + timedelta(seconds=seconds_per_asset()*record_count)
+
+def write_dump(dump):
+    """Dump all the Assets to the file for this dump, returning the file name."""
+    os.makedirs(ASSET_DUMP_DIR, exist_ok=True)
+    file_name = f'asset_dump-{dump.version}.csv'
+    handle, temporary_path = tempfile.mkstemp(dir=ASSET_DUMP_DIR, suffix='.csv.tmp') # In the same directory, so that os.replace is atomic
+    os.close(handle)
+    try:
+        call_command('dump_assets_all_fields', temporary_path)
+        os.chmod(temporary_path, 0o644) # (mkstemp makes the file readable only by its owner.)
+        os.replace(temporary_path, os.path.join(ASSET_DUMP_DIR, file_name))
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return file_name
+
+def remove_old_dumps(current_dump):
+    # The records are kept for their timings.
+    for dump in AssetDump.objects.filter(status=AssetDump.DONE, file_name__isnull=False).exclude(pk=current_dump.pk):
+        if dump.file_name != current_dump.file_name and os.path.exists(dump_path(dump)):
+            os.remove(dump_path(dump))
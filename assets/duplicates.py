@@ -0,0 +1,251 @@
+import math, re
+from collections import defaultdict
+from difflib import SequenceMatcher
+
+import numpy as np
+
+from assets.geocoding import normalize_address
+from assets.models import Asset, RawAsset
+from assets.utils import distance_matrix, paired_distances
+
+# Finding duplicate Assets (or RawAssets) by hand means eyeballing records
+# that are at nearly the same geocoordinates or that have nearly the same
+# address (often one with a suite number and one without). Comparing every
+# record to every other one is out of the question for the full tables, so
+# candidate pairs are only drawn from "blocks":
+#   1) grid cells about DEFAULT_DISTANCE_FEET on a side (each record is
+#      compared with the records in its own cell and the neighboring cells),
+#   2) the street address (normalized, with any unit stripped off) plus the
+#      ZIP code or city.
+# Each candidate pair is scored by name similarity, address similarity, and
+# proximity, the pairs that score at least min_score are joined into
+# clusters, and the clusters are ranked by their best pair score.
+
+DEFAULT_DISTANCE_FEET = 150
+DEFAULT_MIN_SCORE = 0.75
+FEET_PER_DEGREE_OF_LATITUDE = 364000 # Close enough for sizing the grid cells.
+NAME_WEIGHT, ADDRESS_WEIGHT, PROXIMITY_WEIGHT = 0.5, 0.3, 0.2
+
+UNIT_PATTERN = re.compile(r'[\s,]+(SUITE|STE|UNIT|APT|APARTMENT|FLOOR|FL|ROOM|RM|BLDG|BUILDING|#)\b.*$|\s*#.*$')
+
+def strip_unit(street_address):
+    """'100 MAIN ST, SUITE 200' -> '100 MAIN ST'"""
+    return UNIT_PATTERN.sub('', street_address).strip(', ')
+
+def normalize_name(name):
+    return re.sub(r'\s+', ' ', re.sub(r'[^A-Z0-9 ]', ' ', (name or '').upper())).strip()
+
+def similarity(a, b):
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+def address_key(row):
+    if not row['street_address']:
+        return None
+    return (strip_unit(normalize_address(row['street_address'])), row['zip_code'] or (row['city'] or '').upper())
+
+def prepare(rows):
+    for row in rows:
+        row['normalized_name'] = normalize_name(row['name'])
+        row['normalized_address'] = normalize_address(row['street_address']) if row['street_address'] else ''
+        row['address_key'] = address_key(row)
+    return rows
+
+
+### BEGIN Loading records
+def asset_type_names(model, ids):
+    names = defaultdict(list)
+    for k in range(0, len(ids), 5000):
+        for record_id, name in model.objects.filter(pk__in=ids[k:k+5000]).values_list('id', 'asset_types__name').order_by('id', 'asset_types__name'):
+            if name is not None:
+                names[record_id].append(name)
+    return names
+
+def asset_rows(include_delisted=False):
+    """Load the Asset fields needed for duplicate detection in one query
+    (plus one for the asset types)."""
+    assets = Asset.objects.all()
+    if not include_delisted:
+        assets = assets.exclude(do_not_display=True)
+    rows = []
+    for row in assets.values('id', 'name', 'location_id', 'location__parent_location_id',
+            'location__latitude', 'location__longitude', 'location__street_address',
+            'location__city', 'location__zip_code').order_by('id'):
+        for field in ['parent_location_id', 'latitude', 'longitude', 'street_address', 'city', 'zip_code']:
+            row[field] = row.pop(f'location__{field}')
+        rows.append(row)
+    types = asset_type_names(Asset, [row['id'] for row in rows])
+    for row in rows:
+        row['asset_types'] = types[row['id']]
+    return prepare(rows)
+
+def raw_asset_rows():
+    rows = list(RawAsset.objects.values('id', 'name', 'asset_id', 'latitude', 'longitude',
+        'street_address', 'city', 'zip_code').order_by('id'))
+    types = asset_type_names(RawAsset, [row['id'] for row in rows])
+    for row in rows:
+        row['asset_types'] = types[row['id']]
+    return prepare(rows)
+### END Loading records
+
+
+### BEGIN Blocking
+def grid_candidate_pairs(rows, distance_feet):
+    """Return the (i, j) index pairs (i < j) of rows within distance_feet of
+    each other, comparing each grid cell only with itself and its neighbors."""
+    indices = np.array([n for n, row in enumerate(rows) if row['latitude'] not in [None, 0] and row['longitude'] not in [None, 0]], dtype=int)
+    if len(indices) == 0:
+        return set()
+    latitudes = np.array([rows[n]['latitude'] for n in indices], dtype=float)
+    longitudes = np.array([rows[n]['longitude'] for n in indices], dtype=float)
+    cell_height = distance_feet/FEET_PER_DEGREE_OF_LATITUDE
+    cell_width = cell_height/max(math.cos(math.radians(float(np.mean(latitudes)))), 0.1)
+    cells = defaultdict(list)
+    for k, cell in enumerate(zip(np.floor(latitudes/cell_height).astype(int).tolist(), np.floor(longitudes/cell_width).astype(int).tolist())):
+        cells[cell].append(k)
+
+    pairs = set()
+    for (y, x), members in cells.items():
+        # Gather the cell and its eight neighbors.
+        nearby = [k for dy in (-1, 0, 1) for dx in (-1, 0, 1) for k in cells.get((y + dy, x + dx), [])]
+        members, nearby = np.array(members), np.array(nearby)
+        distances = distance_matrix(latitudes[members], longitudes[members], latitudes[nearby], longitudes[nearby])
+        close_rows, close_columns = np.nonzero(distances <= distance_feet)
+        for a, b in zip(indices[members[close_rows]].tolist(), indices[nearby[close_columns]].tolist()):
+            if a < b: # Each pair shows up from both of its cells (or twice in one cell), so keep one.
+                pairs.add((a, b))
+    return pairs
+
+def address_candidate_pairs(rows):
+    blocks = defaultdict(list)
+    for n, row in enumerate(rows):
+        if row['address_key'] is not None:
+            blocks[row['address_key']].append(n)
+    return {(a, b) for members in blocks.values() for k, a in enumerate(members) for b in members[k+1:]}
+### END Blocking
+
+
+### BEGIN Scoring and clustering
+def score_pairs(rows, pairs, distance_feet):
+    """Score the candidate pairs, returning a list of (score, i, j, distance_in_feet) tuples."""
+    pairs = sorted(pairs)
+    if not pairs:
+        return []
+    first, second = np.array([p[0] for p in pairs]), np.array([p[1] for p in pairs])
+    def coordinates(index_array, field):
+        return np.array([rows[n][field] if rows[n][field] not in [None, 0] else np.nan for n in index_array.tolist()], dtype=float)
+    distances = paired_distances(coordinates(first, 'latitude'), coordinates(first, 'longitude'),
+        coordinates(second, 'latitude'), coordinates(second, 'longitude'))
+    proximities = np.where(np.isnan(distances), 0, np.clip(1 - distances/distance_feet, 0, 1))
+
+    scored = []
+    for (a, b), d, proximity in zip(pairs, distances.tolist(), proximities.tolist()):
+        row_a, row_b = rows[a], rows[b]
+        if row_a['address_key'] is not None and row_a['address_key'] == row_b['address_key']:
+            address_score = 1.0 # The same street address, with or without a unit.
+        else:
+            address_score = similarity(row_a['normalized_address'], row_b['normalized_address'])
+        score = NAME_WEIGHT*similarity(row_a['normalized_name'], row_b['normalized_name']) + ADDRESS_WEIGHT*address_score + PROXIMITY_WEIGHT*proximity
+        scored.append((score, a, b, None if math.isnan(d) else d))
+    return scored
+
+def find(parents, n):
+    while parents[n] != n:
+        parents[n] = parents[parents[n]]
+        n = parents[n]
+    return n
+
+def cluster(rows, scored_pairs, min_score):
+    """Join the rows of the pairs scoring at least min_score into clusters
+    (with union-find), returning a list of dicts with 'members' (row indices),
+    'score' (the best pair score), and 'max_distance_feet', best first."""
+    parents = list(range(len(rows)))
+    good_pairs = [p for p in scored_pairs if p[0] >= min_score]
+    for _, a, b, _ in good_pairs:
+        root_a, root_b = find(parents, a), find(parents, b)
+        if root_a != root_b:
+            parents[max(root_a, root_b)] = min(root_a, root_b)
+
+    clusters = {}
+    for score, a, b, d in good_pairs:
+        c = clusters.setdefault(find(parents, a), {'members': set(), 'score': 0, 'max_distance_feet': None})
+        c['members'].update([a, b])
+        c['score'] = max(c['score'], score)
+        if d is not None:
+            c['max_distance_feet'] = max(c['max_distance_feet'] or 0, d)
+    for c in clusters.values():
+        c['members'] = sorted(c['members'])
+    return sorted(clusters.values(), key=lambda c: (-c['score'], rows[c['members'][0]]['id']))
+
+def find_duplicates(rows, distance_feet=DEFAULT_DISTANCE_FEET, min_score=DEFAULT_MIN_SCORE):
+    pairs = grid_candidate_pairs(rows, distance_feet) | address_candidate_pairs(rows)
+    scored = score_pairs(rows, pairs, distance_feet)
+    print(f"Scored {len(scored)} candidate pairs out of {len(rows)} records.")
+    return cluster(rows, scored, min_score)
+### END Scoring and clustering
+
+
+### BEGIN Merge instructions
+# The rows below are in the merge-instructions format that the Asset updater
+# (handle_uploaded_file in assets/views.py) accepts. Since the updater applies
+# the 'name' and 'asset_type' fields to the destination Asset, those are
+# filled in with the destination's current values, so that uploading the file
+# does nothing but the merge. (The score columns are ignored by the updater.)
+
+def format_distance(d):
+    return '' if d is None else f"{d:.1f}"
+
+def asset_merge_instructions(rows, clusters):
+    """One row per cluster: the oldest Asset in the cluster is the destination
+    (id), and the others get delisted (ids_to_merge lists them all)."""
+    instructions = []
+    for c in clusters:
+        members = [rows[n] for n in c['members']]
+        destination = members[0] # The rows are in ID order.
+        instructions.append({'id': destination['id'],
+            'ids_to_merge': '+'.join(str(m['id']) for m in members),
+            'name': destination['name'],
+            'asset_type': '|'.join(destination['asset_types']),
+            'parent_location_id': destination['parent_location_id'] or '',
+            'score': f"{c['score']:.3f}",
+            'max_distance_feet': format_distance(c['max_distance_feet']),
+            'names_to_merge': ' | '.join(m['name'] or '' for m in members)})
+    return instructions
+
+def raw_asset_merge_instructions(rows, clusters):
+    """One row per cluster: all the RawAssets in the cluster get linked to the
+    Asset that most of them already feed (or to a new Asset if none of them
+    feeds one). Clusters whose RawAssets all feed the same Asset are skipped."""
+    linked_ids = list({rows[n]['asset_id'] for c in clusters for n in c['members'] if rows[n]['asset_id'] is not None})
+    linked_assets = {row['id']: row for row in Asset.objects.filter(pk__in=linked_ids).values('id', 'name', 'location__parent_location_id')}
+    linked_types = asset_type_names(Asset, linked_ids)
+    instructions = []
+    for c in clusters:
+        members = [rows[n] for n in c['members']]
+        asset_ids = [m['asset_id'] for m in members if m['asset_id'] is not None]
+        if len(asset_ids) == len(members) and len(set(asset_ids)) == 1:
+            continue # Already merged
+        if asset_ids:
+            asset_id = min(set(asset_ids), key=lambda i: (-asset_ids.count(i), i))
+            destination = linked_assets[asset_id]
+            name, asset_types = destination['name'], linked_types[asset_id]
+            parent_location_id = destination['location__parent_location_id']
+        else:
+            asset_id = None
+            name = members[0]['name']
+            asset_types = sorted({t for m in members for t in m['asset_types']})
+            parent_location_id = None
+        instructions.append({'id': members[0]['id'],
+            'asset_id': asset_id or '',
+            'ids_to_merge': '+'.join(str(m['id']) for m in members),
+            'name': name,
+            'asset_type': '|'.join(asset_types),
+            'parent_location_id': parent_location_id or '',
+            'score': f"{c['score']:.3f}",
+            'max_distance_feet': format_distance(c['max_distance_feet']),
+            'names_to_merge': ' | '.join(m['name'] or '' for m in members)})
+    return instructions
+### END Merge instructions
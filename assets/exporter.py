@@ -0,0 +1,54 @@
+import csv
+
+from django.contrib.postgres.aggregates import StringAgg
+from django.db.models import CharField, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Coalesce
+
+# The CSV dumps (dump_assets_all_fields, dump_assets, dump_assets_by_type,
+# dump_raw_assets, and dump_v1_assets) build each row from a single query:
+# foreign-key fields come through joins (like 'location__street_address'),
+# and the pipe-delimited many-to-many columns are correlated subqueries that
+# StringAgg the related names. (Aggregating in the subqueries rather than in
+# the main query keeps the joins of several many-to-many fields from
+# multiplying each other's rows.) The rows are streamed from a server-side
+# cursor straight to the CSV writer, so memory use doesn't grow with the
+# number of rows.
+
+def m2m_names(model, field_name, path='name', delimiter='|'):
+    """An annotation of the pipe-delimited names of the related instances
+    (in the order they were linked)."""
+    field = model._meta.get_field(field_name)
+    through = field.remote_field.through
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    return Subquery(through.objects.filter(**{f'{source}_id': OuterRef('pk')}).order_by()
+        .values(f'{source}_id')
+        .annotate(joined=StringAgg(Cast(f'{target}__{path}', CharField()), delimiter, ordering='id'))
+        .values('joined'), output_field=CharField())
+
+def reverse_fk_values(related_model, fk_name, path, default=None, delimiter='|'):
+    """An annotation of the pipe-delimited values of path for the instances of
+    related_model that point to this one (like the IDs of an Asset's RawAssets)."""
+    value = Cast(path, CharField())
+    if default is not None:
+        value = Coalesce(value, Value(default))
+    return Subquery(related_model.objects.filter(**{f'{fk_name}_id': OuterRef('pk')}).order_by()
+        .values(f'{fk_name}_id')
+        .annotate(joined=StringAgg(value, delimiter, ordering='id'))
+        .values('joined'), output_field=CharField())
+
+def write_csv(output_file, queryset, columns, annotations=None, label='assets', chunk_size=2000):
+    """Write the queryset to a CSV file, where columns is a list of (column
+    name, field path or annotation name) pairs."""
+    queryset = queryset.annotate(**(annotations or {})).order_by('id')
+    paths = [path for _, path in columns]
+    names = [name for name, _ in columns]
+    with open(output_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        k = -1
+        for k, row in enumerate(queryset.values_list(*paths).iterator(chunk_size=chunk_size)):
+            writer.writerow(['' if value is None else value for value in row])
+            if k % chunk_size == chunk_size-1:
+                print(f"Wrote {k+1} {label} so far.")
+    print(f"Wrote {k+1} {label} to {output_file}.")
+    return k + 1
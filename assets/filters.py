@@ -0,0 +1,97 @@
+import math
+
+from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.measure import D
+from django.core.exceptions import ValidationError as DjangoValidationError
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+from geo.models import Tract, Neighborhood, CountySubdivision
+
+FEET_PER_DEGREE_OF_LATITUDE = 364000 # Roughly 69 miles
+
+# Geographies that can be used with the "within" parameter, which looks
+# like within=<geo model>:<geoid>. Tracts and county subdivisions are keyed by
+# their Census GEOIDs, while neighborhoods are keyed by their IDs.
+WITHIN_GEOGRAPHIES = {
+    'tract': Tract,
+    'neighborhood': Neighborhood,
+    'county-subdivision': CountySubdivision,
+    'countysubdivision': CountySubdivision,
+}
+
+
+def parse_floats(param, value, expected_count):
+    try:
+        numbers = [float(x) for x in value.split(',')]
+    except ValueError:
+        numbers = []
+    if len(numbers) != expected_count:
+        raise ValidationError({param: f"Expected {expected_count} comma-separated numbers but got '{value}'."})
+    return numbers
+
+
+class SpatialFilter(BaseFilterBackend):
+    """Filter geographically with these query parameters:
+        in_bbox=minx,miny,maxx,maxy (longitudes and latitudes)
+        near=lat,lng&radius=feet
+        within=<geo model>:<geoid> (tract, neighborhood or county-subdivision)
+
+    Each one compiles to a lookup on the view's spatial_filter_field
+    (a PointField), which the GiST index on Location.geom can answer."""
+
+    def filter_queryset(self, request, queryset, view):
+        field = getattr(view, 'spatial_filter_field', 'location__geom')
+        params = request.query_params
+
+        if params.get('in_bbox'):
+            minx, miny, maxx, maxy = parse_floats('in_bbox', params['in_bbox'], 4)
+            bbox = Polygon.from_bbox((minx, miny, maxx, maxy))
+            bbox.srid = 4326
+            queryset = queryset.filter(**{f'{field}__contained': bbox})
+
+        if params.get('near'):
+            latitude, longitude = parse_floats('near', params['near'], 2)
+            radius = parse_floats('radius', params.get('radius', ''), 1)[0]
+            if radius <= 0:
+                raise ValidationError({'radius': "The radius (in feet) must be positive."})
+            point = Point(longitude, latitude, srid=4326)
+            # ST_DWithin on a geometry in degrees is what lets the index be used,
+            # so first cut down to a circle in degrees that is big enough to
+            # include everything within the radius (longitude degrees being the
+            # shorter ones) and then apply the exact spherical distance.
+            degrees = radius/FEET_PER_DEGREE_OF_LATITUDE/max(math.cos(math.radians(latitude)), 0.01)
+            queryset = queryset.filter(**{
+                f'{field}__dwithin': (point, degrees),
+                f'{field}__distance_lte': (point, D(ft=radius)),
+            })
+
+        if params.get('within'):
+            geo_level, _, geoid = params['within'].partition(':')
+            model = WITHIN_GEOGRAPHIES.get(geo_level.lower())
+            if model is None:
+                raise ValidationError({'within': f"Unknown geography '{geo_level}'. Try one of {sorted(WITHIN_GEOGRAPHIES.keys())}."})
+            try: # (Neighborhoods have integer IDs, so 'neighborhood:abc' would fail in the lookup.)
+                geoid = model._meta.pk.to_python(geoid)
+            except DjangoValidationError:
+                raise ValidationError({'within': f"'{geoid}' is not a valid {model.geo_level_title} ID."})
+            boundary = model.objects.filter(pk=geoid).values_list('geom', flat=True).first()
+            if boundary is None:
+                raise ValidationError({'within': f"Unable to find a {model.geo_level_title} with ID '{geoid}'."})
+            queryset = queryset.filter(**{f'{field}__within': boundary})
+
+        return queryset
+
+
+class TextSearchFilter(BaseFilterBackend):
+    """Ranked search with the query parameter q=<text>, through the view's
+    text_search function (search_assets or search_locations from
+    assets.search), which the GIN indexes answer. The results come best
+    match first (HybridPagination gives them limit/offset pages, even with a
+    cursor, so that the ranking is kept)."""
+
+    def filter_queryset(self, request, queryset, view):
+        q = request.query_params.get('q', '').strip()
+        if not q:
+            return queryset
+        return view.text_search(queryset, q)
@@ -0,0 +1,266 @@
+import json, re, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from assets.models import GeocodeCacheEntry
+
+# The URLs can be pointed at a local stub server (in the settings) for testing.
+GEOCODIO_URL = getattr(settings, 'GEOCODIO_URL', 'https://api.geocod.io/v1.4/')
+GEOMANCER_URL = getattr(settings, 'GEOMANCER_URL', 'https://tools.wprdc.org/geo/geocode')
+GEOCODE_REQUESTS_PER_SECOND = getattr(settings, 'GEOCODE_REQUESTS_PER_SECOND', 10)
+GEOCODE_WORKERS = getattr(settings, 'GEOCODE_WORKERS', 4)
+GEOCODE_TIMEOUT = getattr(settings, 'GEOCODE_TIMEOUT', 30) # seconds
+GEOCODE_CACHE_TTL = timedelta(days=getattr(settings, 'GEOCODE_CACHE_TTL_DAYS', 180))
+GEOCODE_NEGATIVE_CACHE_TTL = timedelta(days=getattr(settings, 'GEOCODE_NEGATIVE_CACHE_TTL_DAYS', 7))
+GEOCODIO_BATCH_SIZE = 10000 # The most addresses Geocodio accepts per batch request
+
+def normalize_address(address):
+    """Reduce an address to a form that's the same for trivially different
+    spellings of it (case, spacing, stray commas), for deduplication and
+    cache lookups."""
+    address = re.sub(r'\s+', ' ', address.upper()).strip()
+    address = re.sub(r'\s*,\s*', ', ', address)
+    return address.strip(', ')
+
+
+### BEGIN Geocode cache
+# Cache entries expire after GEOCODE_CACHE_TTL_DAYS (or GEOCODE_NEGATIVE_CACHE_TTL_DAYS
+# for addresses that couldn't be geocoded, so that those get retried sooner). Expired
+# entries are ignored and get replaced when the address is geocoded again;
+# warm_geocode_cache --purge-expired deletes them, and invalidate_geocode_cache drops
+# entries right away (e.g., when a geocoder's results turn out to be bad).
+
+cache_stats = {'hits': 0, 'misses': 0} # For this process; each entry also counts its own hits.
+
+def fresh_entries():
+    now = timezone.now()
+    return GeocodeCacheEntry.objects.filter(
+        Q(latitude__isnull=False, geocoded_at__gte=now - GEOCODE_CACHE_TTL) |
+        Q(latitude__isnull=True, geocoded_at__gte=now - GEOCODE_NEGATIVE_CACHE_TTL))
+
+def expired_entries():
+    now = timezone.now()
+    return GeocodeCacheEntry.objects.filter(
+        Q(latitude__isnull=False, geocoded_at__lt=now - GEOCODE_CACHE_TTL) |
+        Q(latitude__isnull=True, geocoded_at__lt=now - GEOCODE_NEGATIVE_CACHE_TTL))
+
+def cached_results(normalized_addresses, include_negative=True):
+    """Return a dict mapping those of the normalized addresses that have fresh
+    cache entries (only successful ones, unless include_negative) to
+    (latitude, longitude, properties) tuples."""
+    results = {}
+    entries = fresh_entries() if include_negative else fresh_entries().filter(latitude__isnull=False)
+    for k in range(0, len(normalized_addresses), 1000):
+        for entry in entries.filter(normalized_address__in=normalized_addresses[k:k+1000]):
+            results[entry.normalized_address] = (entry.latitude, entry.longitude, json.loads(entry.properties) if entry.properties else None)
+    if results:
+        GeocodeCacheEntry.objects.filter(normalized_address__in=list(results.keys())).update(hit_count=F('hit_count') + 1, last_hit_at=timezone.now())
+    cache_stats['hits'] += len(results)
+    cache_stats['misses'] += len(normalized_addresses) - len(results)
+    return results
+
+def provider_of(properties):
+    if isinstance(properties, dict):
+        return properties.get('geocoder')
+    if isinstance(properties, str) and 'Geomancer' in properties:
+        return 'Geomancer'
+    return None
+
+def save_results(results, provider=None):
+    """Save (latitude, longitude, properties) tuples, keyed by normalized
+    address, to the cache (replacing any existing entries)."""
+    now = timezone.now()
+    addresses = list(results.keys())
+    # Readers never see the addresses missing from the cache partway through,
+    # and if another worker saves the same address in the meantime, its entry
+    # wins instead of the insert failing.
+    with transaction.atomic():
+        for k in range(0, len(addresses), 1000):
+            GeocodeCacheEntry.objects.filter(normalized_address__in=addresses[k:k+1000]).delete()
+        GeocodeCacheEntry.objects.bulk_create([GeocodeCacheEntry(normalized_address=address,
+            latitude=latitude, longitude=longitude,
+            provider=provider or provider_of(properties),
+            accuracy=properties.get('accuracy') if isinstance(properties, dict) else None,
+            properties=json.dumps(properties) if properties is not None else None,
+            geocoded_at=now)
+            for address, (latitude, longitude, properties) in results.items()], batch_size=1000, ignore_conflicts=True)
+
+def invalidate_geocode_cache(addresses=None, provider=None):
+    """Delete the cache entries for the given addresses and/or provider (or all of them)."""
+    entries = GeocodeCacheEntry.objects.all()
+    if addresses is not None:
+        entries = entries.filter(normalized_address__in=[normalize_address(a) for a in addresses])
+    if provider is not None:
+        entries = entries.filter(provider=provider)
+    return entries.delete()[0]
+
+def cached_geocode(address, geocoder):
+    """Look up one address in the cache, falling back to geocoder(address)
+    (which should return a (latitude, longitude, properties) tuple) on a miss.
+    Only successful results are saved, since a single geocoder call can't tell
+    an unknown address from a failed request."""
+    if address in ['', None]:
+        return geocoder(address)
+    normalized = normalize_address(address)
+    results = cached_results([normalized])
+    if normalized in results:
+        return results[normalized]
+    latitude, longitude, properties = geocoder(address)
+    if latitude is not None:
+        save_results({normalized: (latitude, longitude, properties)})
+    return latitude, longitude, properties
+
+### END Geocode cache
+
+
+class TokenBucket:
+    """A thread-safe token-bucket rate limiter: acquire() blocks until a
+    token is available. Tokens accumulate at `rate` per second, up to
+    `capacity` (which allows short bursts)."""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
+
+
+def geocodio_properties(result):
+    """The same properties that assets.utils.geocode_address saves."""
+    wanted_keys = ['accuracy', 'accuracy_type', 'address_components']
+    properties = dict((k, result[k]) for k in wanted_keys if k in result)
+    properties['geocoder'] = 'Geocodio'
+    return properties
+
+
+class BatchGeocoder:
+    """Geocode many addresses at once.
+
+    Addresses are normalized and deduplicated, and any that are in the
+    geocode cache (and haven't expired) are answered from there.
+    The rest are sent to Geocodio's batch endpoint (up to 10,000 per
+    request), and the ones Geocodio can't handle are sent to Geomancer
+    from a pool of threads. All requests go through one token bucket,
+    and new results are saved to the cache.
+
+    geocode() returns a dict mapping each address passed in to a
+    (latitude, longitude, properties) tuple, like geocode_address, with
+    (None, None, None) for failures."""
+
+    def __init__(self, api_key=None, geocodio_url=GEOCODIO_URL, geomancer_url=GEOMANCER_URL,
+            requests_per_second=GEOCODE_REQUESTS_PER_SECOND, workers=GEOCODE_WORKERS,
+            timeout=GEOCODE_TIMEOUT, use_cache=True, skip_negative_cache=False):
+        self.api_key = api_key if api_key is not None else settings.GEOCODER_API_KEY
+        self.geocodio_url = geocodio_url
+        self.geomancer_url = geomancer_url
+        self.bucket = TokenBucket(requests_per_second)
+        self.workers = workers
+        self.timeout = timeout
+        self.use_cache = use_cache
+        self.skip_negative_cache = skip_negative_cache # For retrying addresses that couldn't be geocoded before
+        self.local = threading.local() # A requests.Session per thread
+        self.stats = {'cached': 0, 'geocodio': 0, 'geomancer': 0, 'failed': 0, 'errors': 0} # errors counts failed requests
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def geocode(self, addresses):
+        addresses = list(addresses)
+        normalized = {address: normalize_address(address) for address in addresses if address not in ['', None]}
+        pending = list(dict.fromkeys(normalized.values()))
+        results = cached_results(pending, include_negative=not self.skip_negative_cache) if self.use_cache else {}
+        self.stats['cached'] += len(results)
+        pending = [a for a in pending if a not in results]
+
+        new_results = {}
+        if pending:
+            geocodio_results, errored = self.geocode_with_geocodio(pending)
+            new_results.update(geocodio_results)
+            fallbacks = [a for a in pending if a not in new_results]
+            if fallbacks:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    for address, result in zip(fallbacks, executor.map(self.geocode_with_geomancer, fallbacks)):
+                        if result is not None: # None means the request itself failed.
+                            new_results[address] = result
+                            if result[0] is not None:
+                                self.stats['geomancer'] += 1
+            self.stats['failed'] += len([a for a in pending if new_results.get(a, (None,))[0] is None])
+            if self.use_cache:
+                # Addresses that neither geocoder could place get cached too (for the
+                # shorter GEOCODE_NEGATIVE_CACHE_TTL_DAYS), but not ones that failed
+                # because of a request error: only those that Geocodio itself
+                # answered without a result (and not those whose batch request
+                # failed, like when the quota runs out) count as unknown.
+                save_results({address: result for address, result in new_results.items()
+                    if result[0] is not None or address not in errored})
+        results.update(new_results)
+
+        return {address: results.get(normalized.get(address), (None, None, None)) for address in addresses}
+
+    def geocode_with_geocodio(self, addresses):
+        """Return a dict of the addresses that Geocodio placed and a set of the
+        addresses whose batch requests failed."""
+        results = {}
+        errored = set()
+        for k in range(0, len(addresses), GEOCODIO_BATCH_SIZE):
+            batch = addresses[k:k+GEOCODIO_BATCH_SIZE]
+            self.bucket.acquire()
+            try:
+                r = self.session.post(f"{self.geocodio_url}geocode", params={'api_key': self.api_key},
+                    json=batch, timeout=self.timeout + len(batch)//10) # Big batches take a while.
+                response_data = r.json()
+            except (requests.RequestException, ValueError) as e:
+                print(f"Geocodio batch request failed: {e}")
+                self.stats['errors'] += 1
+                errored.update(batch)
+                continue
+            if 'error' in response_data:
+                print(f"Geocodio response: {response_data['error']}")
+                self.stats['errors'] += 1
+                errored.update(batch)
+                continue
+            # The results come back in the same order as the addresses.
+            for address, item in zip(batch, response_data.get('results', [])):
+                response = item.get('response', {})
+                if 'error' in response or not response.get('results'):
+                    continue
+                first_result = response['results'][0]
+                results[address] = (first_result['location']['lat'], first_result['location']['lng'], geocodio_properties(first_result))
+                self.stats['geocodio'] += 1
+        return results, errored
+
+    def geocode_with_geomancer(self, address):
+        self.bucket.acquire()
+        try:
+            r = self.session.get(self.geomancer_url, params={'addr': address}, timeout=self.timeout)
+            result = r.json()
+        except (requests.RequestException, ValueError) as e:
+            print(f"Unable to geocode {address} with Geomancer: {e}")
+            self.stats['errors'] += 1
+            return None
+        if result['data']['status'] == "OK":
+            longitude, latitude = result['data']['geom']['coordinates']
+            return latitude, longitude, "Geocoded with Geomancer"
+        print("Unable to geocode {}, failing with status code {}.".format(address, result['data']['status']))
+        return None, None, None
@@ -0,0 +1,105 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from djangorestframework_camel_case.render import CamelCaseJSONRenderer
+
+from assets.fast_serializers import FastAssetListSerializer
+from assets.filters import SpatialFilter
+from assets.models import Asset
+from assets.serializers import AssetListSerializer
+from assets.views import AssetViewSet
+
+DEFAULT_QUERY_STRINGS = [
+    'in_bbox=-80.02,40.43,-79.97,40.46',
+    'near=40.4406,-79.9959&radius=2640',
+    'within=tract:42003020100',
+    'in_bbox=-80.36,40.19,-79.69,40.67&limit=100',
+]
+
+
+class UncachedAssetViewSet(AssetViewSet):
+    """AssetViewSet without the response cache, so that every repeat runs the
+    query and the serializer instead of fetching the cached copy."""
+    def response_cache_key(self, request):
+        return None
+
+
+def time_request(view, query_string, repeat):
+    factory = APIRequestFactory()
+    timings = []
+    for _ in range(repeat):
+        request = factory.get(f'/api/dev/assets/assets/?{query_string}', HTTP_ACCEPT='application/json')
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            response = view(request)
+            response.render()
+            timings.append((time.perf_counter() - start)*1000)
+    return response, timings, len(context.captured_queries)
+
+def time_serializers(asset_count, repeat):
+    """Time serializing and rendering asset_count Assets with AssetListSerializer
+    and with FastAssetListSerializer, and check that their JSON is identical."""
+    ids = list(Asset.objects.order_by('id').values_list('id', flat=True)[:asset_count])
+    queryset = Asset.objects.filter(id__in=ids).order_by('id')
+    renderer = CamelCaseJSONRenderer()
+    timings = {'AssetListSerializer': [], 'FastAssetListSerializer': []}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = AssetListSerializer(AssetListSerializer.setup_eager_loading(queryset), many=True).data
+        slow_json = renderer.render(data)
+        timings['AssetListSerializer'].append((time.perf_counter() - start)*1000)
+
+        start = time.perf_counter()
+        data = FastAssetListSerializer(FastAssetListSerializer.setup_queryset(queryset)).data
+        fast_json = super(CamelCaseJSONRenderer, renderer).render(data) # (As PrecamelizedJSONRenderer does.)
+        timings['FastAssetListSerializer'].append((time.perf_counter() - start)*1000)
+    return len(ids), timings, slow_json == fast_json
+
+
+class Command(BaseCommand):
+    help = """Time asset list requests (by default, the spatial filters) against the current database.
+
+    Usage:
+    > python manage.py benchmark_asset_api ["in_bbox=..."] ["near=...&radius=..."] [--repeat 10] [--explain]
+
+    With --serializers, compare the list serializers (AssetListSerializer and
+    FastAssetListSerializer) on the first --asset-count Assets instead."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('query_strings', nargs='*')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--explain', action='store_true', help='Print the query plan for the filtered queryset.')
+        parser.add_argument('--serializers', action='store_true', help='Time the list serializers instead of requests.')
+        parser.add_argument('--asset-count', type=int, default=1000, help='How many Assets to serialize with --serializers')
+
+    def handle(self, *args, **options):
+        if options['serializers']:
+            asset_count, timings, identical = time_serializers(options['asset_count'], options['repeat'])
+            print(f"Serializing and rendering {asset_count} Assets ({'identical' if identical else 'DIFFERENT'} JSON):")
+            for name, times in timings.items():
+                per_thousand = statistics.median(times)*1000/max(asset_count, 1)
+                print(f"    {name}: median {statistics.median(times):.1f} ms, best {min(times):.1f} ms, {per_thousand:.1f} ms per 1,000 Assets")
+            speedup = statistics.median(timings['AssetListSerializer'])/max(statistics.median(timings['FastAssetListSerializer']), 0.001)
+            print(f"    Speedup: {speedup:.1f}x")
+            return
+
+        query_strings = options['query_strings'] or DEFAULT_QUERY_STRINGS
+        view = UncachedAssetViewSet.as_view({'get': 'list'})
+        print(f"{Asset.objects.count()} Assets in the database.")
+        for query_string in query_strings:
+            response, timings, query_count = time_request(view, query_string, options['repeat'])
+            data = json.loads(response.content)
+            count = data.get('count') if isinstance(data, dict) else len(data)
+            print(f"{query_string}\n    status {response.status_code}, {count} results, {query_count} queries, "
+                  f"median {statistics.median(timings):.1f} ms, best {min(timings):.1f} ms")
+            if options['explain']:
+                request = Request(APIRequestFactory().get(f'/?{query_string}'))
+                queryset = SpatialFilter().filter_queryset(request, Asset.objects.all(), AssetViewSet)
+                print(queryset.explain(analyze=True))
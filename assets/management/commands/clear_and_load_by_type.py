@@ -1,6 +1,8 @@
 import csv
+import math
 import os
 import re
+from collections import defaultdict
 import sys  # This is a workaround for an error that
 csv.field_size_limit(sys.maxsize)  # looks like this:
 # _csv.Error: field larger than field limit (131072)
@@ -114,20 +116,127 @@ def get_location_by_keys(row, keys):
     return locations[0], True
 
 
-def update_or_create_location(row):
+class LocationMatcher:
+    """An in-memory stand-in for get_location_by_keys, which loads all the
+    Locations once and indexes them by (upper-cased) address fields and by
+    geocoordinates (on a grid with cells the size of the matching resolution),
+    rather than querying the database twice for each row. The match
+    semantics are the same: address values that are blank in the row are not
+    used for matching, and the Location with the highest ID wins. Locations
+    that are created or changed during the load must be passed to index()."""
+
+    ADDRESS_FIELDS = ['street_address', 'zip_code', 'city', 'state'] # Most selective first
+    RESOLUTION = 10**-6 # The same range as in get_location_by_keys
+
+    def __init__(self, queryset=None):
+        self.locations = {}
+        self.indexed_values = {}
+        self.by_field = {field: defaultdict(set) for field in self.ADDRESS_FIELDS}
+        self.grid = defaultdict(set)
+        for location in (queryset if queryset is not None else Location.objects.all()):
+            self.index(location)
+
+    def cell(self, latitude, longitude):
+        return (math.floor(latitude/self.RESOLUTION), math.floor(longitude/self.RESOLUTION))
+
+    def index_values(self, location):
+        values = {field: getattr(location, field) for field in self.ADDRESS_FIELDS}
+        values['zip_code'] = values['zip_code'][:5] if values['zip_code'] is not None else None
+        values = {field: value.upper() if field != 'zip_code' and value is not None else value for field, value in values.items()}
+        values['cell'] = self.cell(location.latitude, location.longitude) if location.latitude is not None and location.longitude is not None else None
+        return values
+
+    def index(self, location):
+        """Add a Location to the indexes (or update its entries)."""
+        old_values = self.indexed_values.get(location.id)
+        new_values = self.index_values(location)
+        if old_values == new_values:
+            self.locations[location.id] = location
+            return
+        if old_values is not None:
+            for field in self.ADDRESS_FIELDS:
+                self.by_field[field][old_values[field]].discard(location.id)
+            self.grid[old_values['cell']].discard(location.id)
+        for field in self.ADDRESS_FIELDS:
+            if new_values[field] is not None:
+                self.by_field[field][new_values[field]].add(location.id)
+        if new_values['cell'] is not None:
+            self.grid[new_values['cell']].add(location.id)
+        self.locations[location.id] = location
+        self.indexed_values[location.id] = new_values
+
+    def address_candidates(self, values):
+        # Start from the most selective address field in the row and then
+        # check the rest of the fields.
+        first_field = next(field for field in self.ADDRESS_FIELDS if field in values)
+        if first_field == 'zip_code' and len(values['zip_code']) < 5: # A partial ZIP code
+            candidate_ids = [i for i, v in self.indexed_values.items() if v['zip_code'] is not None and v['zip_code'].startswith(values['zip_code'])]
+        else:
+            candidate_ids = self.by_field[first_field][values[first_field]]
+        matches = []
+        for location_id in candidate_ids:
+            indexed = self.indexed_values[location_id]
+            if all(indexed[field] is not None and (indexed[field].startswith(value) if field == 'zip_code' else indexed[field] == value)
+                    for field, value in values.items()):
+                matches.append(location_id)
+        return matches
+
+    def coordinate_candidates(self, latitude, longitude):
+        lat_cell, lng_cell = self.cell(latitude, longitude)
+        matches = []
+        for i in [lat_cell - 1, lat_cell, lat_cell + 1]:
+            for j in [lng_cell - 1, lng_cell, lng_cell + 1]:
+                for location_id in self.grid.get((i, j), []):
+                    location = self.locations[location_id]
+                    if abs(location.latitude - latitude) <= self.RESOLUTION and abs(location.longitude - longitude) <= self.RESOLUTION:
+                        matches.append(location_id)
+        return matches
+
+    def match(self, row, keys):
+        """Find a Location like get_location_by_keys(row, keys) does."""
+        if 'latitude' not in keys and 'longitude' not in keys:
+            values = {}
+            for key in keys:
+                field = key.split('__')[0]
+                value = non_blank_value_or_none(row, field)
+                if value is not None:
+                    values[field] = value[:5] if key == 'zip_code__startswith' else value.upper()
+            if not values:
+                return None, False
+            location_ids = self.address_candidates(values)
+        else:
+            if 'geocoding_properties' in row and 'centroid' in row['geocoding_properties']:
+                return None, False # Centroid geocoordinates are too vague to match on.
+            latitude = non_blank_type_or_none(row, 'latitude', float)
+            longitude = non_blank_type_or_none(row, 'longitude', float)
+            if latitude is None or longitude is None:
+                return None, False
+            location_ids = self.coordinate_candidates(latitude, longitude)
+
+        if len(location_ids) == 0:
+            return None, False
+        if len(location_ids) > 1:
+            print(f"Found {len(location_ids)}. Returning the one with the highest ID.")
+        return self.locations[max(location_ids)], True
+
+
+def update_or_create_location(row, matcher=None):
     # Try to find a pre-existing record by keys. Otherwise create it.
     # Any other fields should be used to fill in gaps and (maybe someday used in clever updating).
+    # If a LocationMatcher is passed, it is used instead of querying the database (and
+    # is kept up to date with any changes to the Location).
+    find_location = matcher.match if matcher is not None else get_location_by_keys
 
     location_created = False
     keys = ['street_address__iexact', 'city__iexact', 'state__iexact', 'zip_code__startswith']
     # Sneak better querying in through the keys.
-    location, location_obtained = get_location_by_keys(row, keys)
+    location, location_obtained = find_location(row, keys)
 
     if location_obtained:
         effective_keys = list(keys)
     else:
         keys = ['latitude', 'longitude']
-        location, location_obtained = get_location_by_keys(row, keys)
+        location, location_obtained = find_location(row, keys)
 
         if location_obtained:
             effective_keys = list(keys)
@@ -232,6 +341,8 @@ def update_or_create_location(row):
                     # Otherwise the values agree, and no update is needed.
 
     location.save()
+    if matcher is not None:
+        matcher.index(location)
     return location, location_created
 
 class Command(BaseCommand):
@@ -286,6 +397,7 @@ class Command(BaseCommand):
             print(f"About to start{'' if override_clearing else 'cleaning and'} uploading {chosen_asset_types}.")
 
             total_count = 0
+            location_matcher = LocationMatcher()
 
             for asset_type in chosen_asset_types:
                 type_count = 0
@@ -328,7 +440,7 @@ class Command(BaseCommand):
                             organization.save()
                             # END primitive Organization object handling
 
-                            location, location_created = update_or_create_location(row)
+                            location, location_created = update_or_create_location(row, location_matcher)
 
                             asset_types = [AssetType.objects.get_or_create(name=asset_type)[0] for asset_type in
                                            parse_cell(row['asset_type'])] if row['asset_type'] else []
@@ -1,25 +1,15 @@
-import csv
 import os
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
+from assets.exporter import write_csv
 from assets.models import Asset
 
 
-def to_dict_for_csv(asset: Asset, for_carto=False):
-    return {
-        'id': asset.id,
-        'name': asset.name,
-        'asset_type': asset.asset_types.all()[0].name,
-        'asset_type_title': asset.asset_types.all()[0].title,
-        'category': asset.category.name,
-        'category_title': asset.category.title,
-        'sensitive': asset.sensitive,
-        'do_not_display': asset.do_not_display,
-        'latitude': asset.location.latitude,
-        'longitude': asset.location.longitude,
-    }
+COLUMNS = [('id', 'id'), ('name', 'name'), ('asset_type', 'asset_type'), ('asset_type_title', 'asset_type_title'),
+    ('category', 'category_name'), ('category_title', 'category_title'), ('sensitive', 'sensitive'),
+    ('do_not_display', 'do_not_display'), ('latitude', 'location__latitude'), ('longitude', 'location__longitude')]
 
 
 class Command(BaseCommand):
@@ -34,7 +24,7 @@ class Command(BaseCommand):
             help='Specify which asset types to filter by',
         )
         parser.add_argument(
-            '-c'
+            '-c',
             '--carto',
             action='store_true',
             help='Dump with geom fields for carto.',
@@ -42,25 +32,10 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         output_file = os.path.join(settings.BASE_DIR, 'asset_dump.csv')
-        asset_types = options['asset-types']
-        for_carto = options['carto']
+        asset_types = options['asset_types']
 
-        with open(output_file, 'w') as f:
-            writer = csv.DictWriter(
-                f,
-                ['id',
-                 'name',
-                 'asset_type',
-                 'asset_type_title',
-                 'category',
-                 'category_title',
-                 'sensitive',
-                 'do_not_display',
-                 'latitude',
-                 'longitude'],
-            )
-            writer.writeheader()
-            asset_set = Asset.objects.all() if not asset_types else Asset.objects.filter(
-                asset_types__name__in=asset_types)
-            for asset in asset_set:
-                writer.writerow(to_dict_for_csv(asset, for_carto=for_carto))
+        # The first asset type (and its category) is the one that's dumped.
+        asset_set = Asset.objects.with_first_asset_type()
+        if asset_types:
+            asset_set = asset_set.filter(pk__in=Asset.objects.filter(asset_types__name__in=asset_types).values('pk'))
+        write_csv(output_file, asset_set, COLUMNS, label='assets')
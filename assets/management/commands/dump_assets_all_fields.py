@@ -1,62 +1,49 @@
-import os, csv, re
+import os
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
+from assets.exporter import m2m_names, reverse_fk_values, write_csv
 from assets.models import RawAsset, Asset, AssetType
 
 
-def to_dict_for_csv(asset: Asset):
+ASSET_FIELDS = ['url', 'email', 'phone', 'hours_of_operation', 'holiday_hours_of_operation', 'periodicity',
+    'capacity', 'wifi_network', 'wifi_notes', 'internet_access', 'computers_available', 'accessibility',
+    'open_to_public', 'child_friendly', 'sensitive', 'do_not_display', 'localizability']
+LOCATION_FIELDS = ['street_address', 'unit', 'unit_type', 'municipality', 'city', 'state', 'zip_code',
+    'latitude', 'longitude', 'parcel_id', 'residence', 'iffy_geocoding', 'available_transportation']
+
+# (column, field path or annotation) pairs, in the order of the columns in the dump
+COLUMNS = [('id', 'id'), ('name', 'name'), ('asset_type', 'asset_type_names'),
+    ('raw_asset_ids', 'raw_asset_ids'), # Replaces asset_id in raw asset dump.
+    ('tags', 'tag_names'),
+    ('location_id', 'location_id')] + [ # Not present in raw asset dump.
+    (f, f'location__{f}') for f in LOCATION_FIELDS] + [
+    ('parent_location_id', 'location__parent_location_id'),
+    ('parent_location', 'location__parent_location__name')] + [
+    (f, f) for f in ASSET_FIELDS] + [
+    ('services', 'service_names'),
+    ('hard_to_count_population', 'population_names'),
+    ('data_source_names', 'data_source_names'), # Another field that differs from the RawAsset dump.
+    ('data_source_urls', 'data_source_urls'), # Another field that differs from the RawAsset dump.
+    ('organization_name', 'organization__name'),
+    ('organization_phone', 'organization__phone'),
+    ('organization_email', 'organization__email'),
+    ('etl_notes', 'etl_notes'),
+    #('primary_key_from_rocket', 'primary_key_from_rocket'), # Excluded from asset dump.
+    #('synthesized_key', 'synthesized_key'), # Excluded from asset dump.
+    ('geocoding_properties', 'location__geocoding_properties'),
+    ]
+
+def annotations():
     return {
-        'id': asset.id,
-        'name': asset.name,
-        'asset_type': '|'.join([getattr(t, 'name', 'None') for t in asset.asset_types.all()]),
-        'raw_asset_ids': '|'.join([str(r.id) for r in asset.rawasset_set.all()]), # This is one field that differs from the RawAsset dump.
-        'tags': '|'.join([getattr(t, 'name', 'None') for t in asset.tags.all()]),
-        'location_id': getattr(asset.location, 'id', None),
-        'street_address': getattr(asset.location, 'street_address', None),
-        'unit': getattr(asset.location, 'unit', None),
-        'unit_type': getattr(asset.location, 'unit_type', None),
-        'municipality': getattr(asset.location, 'municipality', None),
-        'city': getattr(asset.location, 'city', None),
-        'state': getattr(asset.location, 'state', None),
-        'zip_code': getattr(asset.location, 'zip_code', None),
-        'latitude': getattr(asset.location, 'latitude', None),
-        'longitude': getattr(asset.location, 'longitude', None),
-        'parcel_id': getattr(asset.location, 'parcel_id', None),
-        'residence': getattr(asset.location, 'residence', None),
-        'iffy_geocoding': getattr(asset.location, 'iffy_geocoding', None),
-        'available_transportation': getattr(asset.location, 'available_transportation', None),
-        'parent_location_id': getattr(getattr(asset.location, 'parent_location', None), 'id', None),
-        'parent_location': getattr(asset.location, 'parent_location', None),
-        'url': asset.url,
-        'email': asset.email,
-        'phone': asset.phone,
-        'hours_of_operation': asset.hours_of_operation,
-        'holiday_hours_of_operation': asset.holiday_hours_of_operation,
-        'periodicity': asset.periodicity,
-        'capacity': asset.capacity,
-        'wifi_network': asset.wifi_network,
-        'wifi_notes': asset.wifi_notes,
-        'internet_access': asset.internet_access,
-        'computers_available': asset.computers_available,
-        'accessibility': asset.accessibility,
-        'open_to_public': asset.open_to_public,
-        'child_friendly': asset.child_friendly,
-        'localizability': asset.localizability,
-        'sensitive': asset.sensitive,
-        'do_not_display': asset.do_not_display,
-        'services': '|'.join([getattr(s, 'name', None) for s in asset.services.all()]),
-        'hard_to_count_population': '|'.join([getattr(p, 'name', 'None') for p in asset.hard_to_count_population.all()]),
-        'data_source_names': '|'.join([getattr(r.data_source, 'name', 'None') for r in asset.rawasset_set.all()]), # Another field that differs from the RawAsset dump.
-        'data_source_urls': '|'.join([getattr(r.data_source, 'url', 'None') for r in asset.rawasset_set.all()]), # Another field that differs from the RawAsset dump.
-        'organization_name': getattr(asset.organization, 'name', ''),
-        'organization_phone': getattr(asset.organization, 'phone', ''),
-        'organization_email': getattr(asset.organization, 'email', ''),
-        'etl_notes': asset.etl_notes,
-        #'primary_key_from_rocket': asset.primary_key_from_rocket,
-        #'synthesized_key': asset.synthesized_key,
-        'geocoding_properties': getattr(asset.location, 'geocoding_properties', None),
+        'asset_type_names': m2m_names(Asset, 'asset_types'),
+        'tag_names': m2m_names(Asset, 'tags'),
+        'service_names': m2m_names(Asset, 'services'),
+        'population_names': m2m_names(Asset, 'hard_to_count_population'),
+        'raw_asset_ids': reverse_fk_values(RawAsset, 'asset', 'id'),
+        'data_source_names': reverse_fk_values(RawAsset, 'asset', 'data_source__name', default='None'),
+        'data_source_urls': reverse_fk_values(RawAsset, 'asset', 'data_source__url', default='None'),
     }
 
 
@@ -74,8 +61,8 @@ class Command(BaseCommand):
         for arg in args:
             if arg in extant_asset_types:
                 chosen_asset_types.append(arg)
-            elif re.match('/home/david/downloads', arg) is not None and os.path.isdir('/'.join(arg.split('/')[:-1])):
-                filepath = arg
+            elif (os.sep in arg or arg.endswith('.csv')) and os.path.isdir(os.path.dirname(os.path.abspath(arg))):
+                filepath = arg # An output file path (so that a mistyped asset type isn't taken for one)
             else:
                 print(f"It is not clear what to with this argument: '{arg}'.")
 
@@ -92,62 +79,4 @@ class Command(BaseCommand):
         else:
             output_file = filepath
 
-        with open(output_file, 'w') as f:
-            writer = csv.DictWriter(
-                f,
-                ['id',
-                 'name',
-                 'asset_type',
-                 'raw_asset_ids', # Replaces asset_id in raw asset dump.
-                 'tags',
-                 'location_id', # Not present in raw asset dump.
-                 'street_address',
-                 'unit',
-                 'unit_type',
-                 'municipality',
-                 'city',
-                 'state',
-                 'zip_code',
-                 'latitude',
-                 'longitude',
-                 'parcel_id',
-                 'residence',
-                 'iffy_geocoding',
-                 'available_transportation',
-                 'parent_location_id',
-                 'parent_location',
-                 'url',
-                 'email',
-                 'phone',
-                 'hours_of_operation',
-                 'holiday_hours_of_operation',
-                 'periodicity',
-                 'capacity',
-                 'wifi_network',
-                 'wifi_notes',
-                 'internet_access',
-                 'computers_available',
-                 'accessibility',
-                 'open_to_public',
-                 'child_friendly',
-                 'sensitive',
-                 'do_not_display',
-                 'localizability',
-                 'services',
-                 'hard_to_count_population',
-                 'data_source_names',
-                 'data_source_urls',
-                 'organization_name',
-                 'organization_phone',
-                 'organization_email',
-                 'etl_notes',
-                 #'primary_key_from_rocket', # Excluded from asset dump.
-                 #'synthesized_key', # Excluded from asset dump.
-                 'geocoding_properties',
-                 ],
-            )
-            writer.writeheader()
-            for k,asset in enumerate(assets_iterator.iterator()): # Use the "iterator()" method to lazily evaluate the query in chunks (to save memory)
-                writer.writerow(to_dict_for_csv(asset))
-                if k % 2000 == 2000-1:
-                    print(f"Wrote {k+1} raw assets so far.")
+        write_csv(output_file, assets_iterator, COLUMNS, annotations(), label='assets')
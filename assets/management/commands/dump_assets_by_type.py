@@ -1,27 +1,16 @@
-import csv
 import os
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
+from assets.exporter import write_csv
 from assets.models import Asset
 
 
-def to_dict_for_csv(asset: Asset):
-    return {
-        'id': asset.id,
-        'name': asset.name,
-        'asset_type': asset.asset_types.all()[0].name,
-        'asset_type_title': asset.asset_types.all()[0].title,
-        'category': asset.category.name,
-        'category_title': asset.category.title,
-        'sensitive': asset.sensitive,
-        'do_not_display': asset.do_not_display,
-        'latitude': asset.location.latitude,
-        'longitude': asset.location.longitude,
-        'primary_key_from_rocket': asset.primary_key_from_rocket,
-        'synthesized_key': asset.synthesized_key,
-    }
+COLUMNS = [('id', 'id'), ('name', 'name'), ('asset_type', 'asset_type'), ('asset_type_title', 'asset_type_title'),
+    ('category', 'category_name'), ('category_title', 'category_title'), ('sensitive', 'sensitive'),
+    ('do_not_display', 'do_not_display'), ('latitude', 'location__latitude'), ('longitude', 'location__longitude'),
+    ('primary_key_from_rocket', 'primary_key_from_rocket'), ('synthesized_key', 'synthesized_key')]
 
 
 class Command(BaseCommand):
@@ -48,24 +37,4 @@ class Command(BaseCommand):
             
         output_file = os.path.join(settings.BASE_DIR, filename)
 
-        with open(output_file, 'w') as f:
-            writer = csv.DictWriter(
-                f,
-                ['id',
-                 'name',
-                 'asset_type',
-                 'asset_type_title',
-                 'category',
-                 'category_title',
-                 'sensitive',
-                 'do_not_display',
-                 'latitude',
-                 'longitude',
-                 'primary_key_from_rocket',
-                 'synthesized_key',],
-            )
-            writer.writeheader()
-            for k,asset in enumerate(assets_iterator.iterator()): # Use the "iterator()" method to lazily evaluate the query in chunks (to save memory).
-                writer.writerow(to_dict_for_csv(asset))
-                if k % 2000 == 2000-1:
-                    print(f"Wrote {k+1} assets so far.")
+        write_csv(output_file, assets_iterator.with_first_asset_type(), COLUMNS, label='assets')
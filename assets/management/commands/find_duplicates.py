@@ -0,0 +1,43 @@
+import csv, os, time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from assets.duplicates import (DEFAULT_DISTANCE_FEET, DEFAULT_MIN_SCORE, find_duplicates,
+    asset_rows, raw_asset_rows, asset_merge_instructions, raw_asset_merge_instructions)
+
+ASSET_FIELDNAMES = ['id', 'ids_to_merge', 'name', 'asset_type', 'parent_location_id', 'score', 'max_distance_feet', 'names_to_merge']
+RAW_ASSET_FIELDNAMES = ['id', 'asset_id', 'ids_to_merge', 'name', 'asset_type', 'parent_location_id', 'score', 'max_distance_feet', 'names_to_merge']
+
+class Command(BaseCommand):
+    help = """Find likely duplicate Assets (or, with --raw-assets, RawAssets) and write them,
+    best candidates first, to a merge-instructions CSV file that can be reviewed, trimmed,
+    and then uploaded to the Asset updater (using-assets or using-raw-assets, respectively)."""
+
+    def add_arguments(self, parser): # Necessary boilerplate for accessing args.
+        parser.add_argument('args', nargs='*')
+        parser.add_argument('--raw-assets', action='store_true', help='Look for duplicate RawAssets instead of duplicate Assets.')
+        parser.add_argument('--distance', type=float, default=DEFAULT_DISTANCE_FEET, help='How close (in feet) records have to be to be compared by location')
+        parser.add_argument('--min-score', type=float, default=DEFAULT_MIN_SCORE, help='The lowest pair score (from 0 to 1) that counts as a duplicate')
+        parser.add_argument('--include-delisted', action='store_true', help='Include Assets with do_not_display set.')
+        parser.add_argument('--output', default=os.path.join(settings.BASE_DIR, 'merge_candidates.csv'))
+
+    def handle(self, *args, **options):
+        start = time.time()
+        if options['raw_assets']:
+            rows = raw_asset_rows()
+        else:
+            rows = asset_rows(options['include_delisted'])
+        print(f"Loaded {len(rows)} {'RawAssets' if options['raw_assets'] else 'Assets'} in {time.time() - start:.1f} seconds.")
+
+        clusters = find_duplicates(rows, options['distance'], options['min_score'])
+        if options['raw_assets']:
+            instructions, fieldnames = raw_asset_merge_instructions(rows, clusters), RAW_ASSET_FIELDNAMES
+        else:
+            instructions, fieldnames = asset_merge_instructions(rows, clusters), ASSET_FIELDNAMES
+
+        with open(options['output'], 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(instructions)
+        print(f"Wrote {len(instructions)} merge candidates to {options['output']} in {time.time() - start:.1f} seconds.")
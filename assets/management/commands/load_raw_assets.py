@@ -1,15 +1,20 @@
 import csv
 import os
 import re
+from collections import defaultdict
 import sys  # This is a workaround for an error that
 csv.field_size_limit(sys.maxsize)  # looks like this:
 # _csv.Error: field larger than field limit (131072)
 
+import django
 import phonenumbers
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
 
-from assets.models import (RawAsset,
+from assets.models import (BaseAsset,
+                           RawAsset,
                            Asset,
                            AssetType,
                            Tag,
@@ -22,11 +27,324 @@ from assets.management.commands.clear_and_load_by_type import non_blank_value_or
 
 from pprint import pprint
 
+def raw_asset_fields_from_row(row):
+    """Map a row of the source file to RawAsset field values (other than the
+    related fields)."""
+    return dict(
+        name=non_blank_value_or_none(row, 'name'),
+        localizability=get_localizability(non_blank_value_or_none(row, 'localizability')),
+
+        url=non_blank_value_or_none(row, 'url'),
+        email=non_blank_value_or_none(row, 'email'),
+        phone=standardize_phone(row.get('phone', None)),
+
+        hours_of_operation=non_blank_value_or_none(row, 'hours_of_operation'),
+        holiday_hours_of_operation=non_blank_value_or_none(row, 'holiday_hours_of_operation'),
+        periodicity=non_blank_value_or_none(row, 'periodicity'),
+        capacity=non_blank_type_or_none(row, 'capacity', int),
+        wifi_network=non_blank_value_or_none(row, 'wifi_network'),
+        wifi_notes=non_blank_value_or_none(row, 'wifi_notes'),
+
+        etl_notes=non_blank_value_or_none(row, 'notes'),
+
+        child_friendly=boolify(non_blank_value_or_none(row, 'child_friendly')),
+        internet_access=boolify(non_blank_value_or_none(row, 'internet_access')),
+        computers_available=boolify(non_blank_value_or_none(row, 'computers_available')),
+        accessibility=boolify(non_blank_value_or_none(row, 'accessibility')),
+        open_to_public=boolify(non_blank_value_or_none(row, 'open_to_public')),
+        sensitive=boolify(non_blank_value_or_none(row, 'sensitive')),
+        do_not_display=boolify(non_blank_value_or_none(row, 'do_not_display')),
+
+        street_address = non_blank_value_or_none(row, 'street_address'),
+        city = non_blank_value_or_none(row, 'city'),
+        state = non_blank_value_or_none(row, 'state'),
+        zip_code = non_blank_value_or_none(row, 'zip_code'),
+        parcel_id = non_blank_value_or_none(row, 'parcel_id'),
+        residence = boolify(non_blank_value_or_none(row, 'residence')),
+        available_transportation = non_blank_value_or_none(row, 'location_transportation'),
+        parent_location = non_blank_value_or_none(row, 'parent_location'),
+        # Note that parent_location has not yet been added to the Assets (since
+        # the original loader didn't do this), so now it's being added to RawAssets
+        # as a string, representing the name of the location.
+
+        # The thing about the parent location is that it's just a name in the
+        # source data at this point, and we've got to figure out how we're going
+        # to connect it to Location instances. At present, there are only 153 distinct
+        # parent_location values, so doing it semimanually seems viable.
+        # It's pretty much the same deal with the organization having a
+        # Location instance. It might eventually make sense to make this
+        # association, but there's no data or wiring or front-end features
+        # to support it at this point.
+        latitude = non_blank_type_or_none(row, 'latitude', float),
+        longitude = non_blank_type_or_none(row, 'longitude', float),
+        #geom =  We're still not uploading the geom field yet because it wasn't
+        # in the sample_assets.csv field used to populate the Asset model.
+        # There are only a few features with useful geom values (boundaries of
+        # parks mostly), and those will be handled later, once the front end
+        # is ready to use those values.
+        geocoding_properties = non_blank_value_or_none(row, 'geocoding_properties'),
+
+        organization_name = non_blank_value_or_none(row, 'organization_name'),
+        organization_email = non_blank_value_or_none(row, 'organization_email'),
+        organization_phone = standardize_phone(row.get('organization_phone', None)),
+
+        primary_key_from_rocket=non_blank_value_or_none(row, 'primary_key_from_rocket'),
+        synthesized_key=non_blank_value_or_none(row, 'synthesized_key'),
+    )
+
+def clear_raw_assets_of_type(asset_type, extant_types):
+    """Clear the assets of this type if any are found in the database."""
+    if asset_type in extant_types:
+        selected_assets = RawAsset.objects.filter(asset_types__name=asset_type)
+        if len(selected_assets) > 0:
+            print(f"Clearing all {len(selected_assets)} assets with type '{asset_type}'.")
+            selected_assets.delete()
+        else:
+            print(f"No assets with type '{asset_type}' found.")
+
+class NameLookup:
+    """An in-memory name-to-ID map for a lookup table (like Tag or
+    ProvidedService), preloaded with one query, which creates any missing
+    instances as they are asked for (like get_or_create, but without a
+    query per row)."""
+    def __init__(self, model, defaults_from_row=None):
+        self.model = model
+        self.defaults_from_row = defaults_from_row
+        self.ids = {}
+        for pk, name in model.objects.order_by('-id').values_list('id', 'name'):
+            self.ids[name] = pk # Ordering by descending ID lets the oldest duplicate win.
+        self.created = 0
+
+    def id_for(self, name, row=None):
+        if name not in self.ids:
+            defaults = self.defaults_from_row(row) if self.defaults_from_row else {}
+            self.ids[name] = self.model.objects.create(name=name, **defaults).id
+            self.created += 1
+        return self.ids[name]
+
+    def ids_for(self, names):
+        ids = [self.id_for(name) for name in names if name not in ['', None]]
+        return list(dict.fromkeys(ids)) # Drop repeats (which would violate the through tables' unique constraints).
+
+M2M_FIELDS = ['asset_types', 'tags', 'services', 'hard_to_count_population']
+PRIVATE_INSERT_VERSIONS = ((3, 0), (6, 0)) # The Django versions whose Manager._insert insert_child_rows uses
+
+def cell_values(row, field):
+    return parse_cell(row[field]) if row.get(field) else []
+
+def m2m_through_rows(field_name, source_ids_and_target_ids):
+    """Build the through-model instances linking BaseAssets to the related
+    instances of one ManyToManyField."""
+    field = BaseAsset._meta.get_field(field_name)
+    through = field.remote_field.through
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    return through, [through(**{f'{source}_id': source_id, f'{target}_id': target_id})
+        for source_id, target_ids in source_ids_and_target_ids for target_id in target_ids]
+
+def bulk_insert_raw_assets(raw_assets, batch_size):
+    """Insert RawAssets (which have unsaved BaseAsset parents, because of the
+    multi-table inheritance) without a query per instance. bulk_create
+    doesn't support multi-table inheritance, so the BaseAsset rows are bulk
+    created first (getting their IDs back from Postgres) and then the
+    RawAsset rows are inserted pointing at them."""
+    parent_fields = [f for f in BaseAsset._meta.concrete_fields if not f.primary_key]
+    parents = [BaseAsset(**{f.attname: getattr(raw_asset, f.attname) for f in parent_fields}) for raw_asset in raw_assets]
+    BaseAsset.objects.bulk_create(parents, batch_size=batch_size)
+    for raw_asset, parent in zip(raw_assets, parents):
+        raw_asset.id = raw_asset.baseasset_ptr_id = parent.id
+        raw_asset.date_entered = parent.date_entered # Set by bulk_create
+        raw_asset.last_updated = parent.last_updated # (via auto_now[_add]).
+        raw_asset._state.adding = False
+    for k in range(0, len(raw_assets), batch_size):
+        insert_child_rows(RawAsset, raw_assets[k:k+batch_size])
+    return raw_assets
+
+def insert_child_rows(model, instances):
+    """INSERT the rows of a multi-table inheritance child's own table (its
+    local_concrete_fields) for instances whose parent rows already exist.
+
+    bulk_create raises ValueError for such models, and the ORM's only way to
+    write the child rows alone is Manager._insert (what bulk_create calls
+    underneath). That's a private API, so it's only used on the Django
+    versions whose _insert(objs, fields=...) signature is known (3.0 through
+    5.x), and otherwise the same INSERT is built here from the fields."""
+    fields = model._meta.local_concrete_fields
+    if PRIVATE_INSERT_VERSIONS[0] <= django.VERSION[:2] < PRIVATE_INSERT_VERSIONS[1]:
+        model._base_manager._insert(instances, fields=fields)
+        return
+    rows, params = [], []
+    for instance in instances:
+        placeholders = []
+        for field in fields:
+            value = field.get_db_prep_save(field.pre_save(instance, True), connection)
+            # (Geometry fields may need a function around the value.)
+            placeholders.append(field.get_placeholder(value, None, connection) if hasattr(field, 'get_placeholder') else '%s')
+            params.append(value)
+        rows.append(f"({', '.join(placeholders)})")
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {connection.ops.quote_name(model._meta.db_table)} ({columns}) VALUES {', '.join(rows)}", params)
+
+def bulk_link_raw_assets(raw_assets_and_related_ids, batch_size):
+    """Write the M2M through rows for (raw_asset, {field_name: [related IDs]}) pairs."""
+    for field_name in M2M_FIELDS:
+        through, links = m2m_through_rows(field_name,
+            [(raw_asset.id, related_ids[field_name]) for raw_asset, related_ids in raw_assets_and_related_ids])
+        through.objects.bulk_create(links, batch_size=batch_size)
+
+def check_keys_for_insert(rows):
+    """Verify that RawAssets with matching keys do not already exist (in the
+    database or earlier in the file)."""
+    synthesized_keys = set(RawAsset.objects.exclude(synthesized_key=None).values_list('synthesized_key', flat=True))
+    rocket_keys = set(RawAsset.objects.exclude(primary_key_from_rocket=None).values_list('primary_key_from_rocket', flat=True))
+    for row in rows:
+        assert 'synthesized_key' in row
+        assert row['synthesized_key'] != ''
+        if row['synthesized_key'] in synthesized_keys:
+            raise ValueError(f"Unable to insert row with synthesized key {row['synthesized_key']} because one or more other such rows exist.")
+        synthesized_keys.add(row['synthesized_key'])
+        if row.get('primary_key_from_rocket') not in ['', None]:
+            if row['primary_key_from_rocket'] in rocket_keys:
+                raise ValueError(f"Unable to insert row with primary_key_from_rocket {row['primary_key_from_rocket']} because one or more other such rows exist.")
+            rocket_keys.add(row['primary_key_from_rocket'])
+
+def match_rows_to_raw_assets(rows):
+    """Return a list of the IDs of the existing RawAssets matching the rows
+    (or None for rows that match nothing), matching on primary_key_from_rocket
+    when the row has one and otherwise on synthesized_key."""
+    by_rocket_key, by_synthesized_key = {}, {}
+    for raw_asset_id, rocket_key, synthesized_key in RawAsset.objects.order_by('-id').values_list('id', 'primary_key_from_rocket', 'synthesized_key'):
+        if rocket_key is not None:
+            by_rocket_key[rocket_key] = raw_asset_id
+        if synthesized_key is not None:
+            by_synthesized_key[synthesized_key] = raw_asset_id
+    matches = []
+    matched = set()
+    for row in rows:
+        assert row.get('synthesized_key') not in ['', None]
+        rocket_key = row.get('primary_key_from_rocket')
+        if rocket_key not in ['', None] and rocket_key in by_rocket_key:
+            raw_asset_id = by_rocket_key[rocket_key]
+        else:
+            raw_asset_id = by_synthesized_key.get(row['synthesized_key'])
+        if raw_asset_id is not None:
+            if raw_asset_id in matched:
+                raise ValueError(f"More than one row (including the one with synthesized key {row['synthesized_key']}) matches the RawAsset with ID {raw_asset_id}.")
+            matched.add(raw_asset_id)
+        matches.append(raw_asset_id)
+    return matches
+
+def current_related_ids(raw_asset_ids):
+    """Return {field_name: {raw_asset_id: set of related IDs}} for the M2M fields."""
+    related = {}
+    for field_name in M2M_FIELDS:
+        field = BaseAsset._meta.get_field(field_name)
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        related[field_name] = defaultdict(set)
+        for source_id, target_id in field.remote_field.through.objects.filter(**{f'{source}_id__in': raw_asset_ids}).values_list(f'{source}_id', f'{target}_id'):
+            related[field_name][source_id].add(target_id)
+    return related
+
+def bulk_load_raw_assets(file_name, chosen_asset_types, chunk_size=1000, mode='insert'):
+    """Load the rows of the chosen asset types from the source file with a
+    handful of queries per chunk instead of a dozen or so per row. Everything
+    is done in one transaction, so a bad row leaves the database unchanged.
+
+    In 'upsert' mode, rows that match existing RawAssets (see
+    match_rows_to_raw_assets) update them, but only when a field or M2M
+    link has actually changed, and only the changed rows are written. The
+    linked Assets are left alone."""
+    with open(file_name) as f:
+        rows = [row for row in csv.DictReader(f) if row['asset_type'] in chosen_asset_types]
+
+    if mode == 'insert':
+        check_keys_for_insert(rows)
+        matches = [None]*len(rows)
+    else:
+        matches = match_rows_to_raw_assets(rows)
+
+    lookups = {
+        'asset_types': NameLookup(AssetType), # As in the row-by-row loader, new asset types get created
+        # without a Category (so they won't appear on the map until one is assigned).
+        'tags': NameLookup(Tag),
+        'services': NameLookup(ProvidedService),
+        'hard_to_count_population': NameLookup(TargetPopulation),
+    }
+    data_sources = NameLookup(DataSource, lambda row: {'url': non_blank_value_or_none(row, 'data_source_url')})
+    columns = {'asset_types': 'asset_type', 'tags': 'tags', 'services': 'services', 'hard_to_count_population': 'hard_to_count_population'}
+
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    with transaction.atomic():
+        for k in range(0, len(rows), chunk_size):
+            chunk = list(zip(rows[k:k+chunk_size], matches[k:k+chunk_size]))
+            existing = RawAsset.objects.in_bulk([raw_asset_id for _, raw_asset_id in chunk if raw_asset_id is not None])
+            existing_related_ids = current_related_ids(list(existing.keys())) if existing else {}
+
+            new_raw_assets, new_related_ids = [], []
+            changed_raw_assets, changed_fields, relinks = [], set(), []
+            for row, raw_asset_id in chunk:
+                data_source_id = data_sources.id_for(row['data_source_name'], row) if row.get('data_source_name') else None
+                raw_asset = RawAsset(data_source_id=data_source_id, **raw_asset_fields_from_row(row))
+                related_ids = {field_name: lookup.ids_for(cell_values(row, columns[field_name]))
+                    for field_name, lookup in lookups.items()}
+                if raw_asset_id is None:
+                    raw_asset._change_reason = 'load_raw_assets --bulk'
+                    new_raw_assets.append(raw_asset)
+                    new_related_ids.append(related_ids)
+                    continue
+
+                # Compare against the existing RawAsset, field by field. (Constructing the
+                # RawAsset above puts the values in the same form, e.g., PhoneNumbers.)
+                destination = existing[raw_asset_id]
+                fields = [field_name for field_name in list(raw_asset_fields_from_row(row).keys()) + ['data_source_id']
+                    if getattr(raw_asset, field_name) != getattr(destination, field_name)]
+                relinked = {field_name: ids for field_name, ids in related_ids.items()
+                    if set(ids) != existing_related_ids[field_name][raw_asset_id]}
+                if not fields and not relinked:
+                    counts['unchanged'] += 1
+                    continue
+                for field_name in fields:
+                    setattr(destination, field_name, getattr(raw_asset, field_name))
+                destination.last_updated = timezone.now() # bulk_update skips auto_now.
+                destination._change_reason = f'load_raw_assets --mode upsert: Updated {", ".join(fields + list(relinked.keys()))}'
+                changed_raw_assets.append(destination)
+                changed_fields.update(fields)
+                if relinked:
+                    relinks.append((destination, relinked))
+
+            if new_raw_assets:
+                bulk_insert_raw_assets(new_raw_assets, chunk_size)
+                bulk_link_raw_assets(zip(new_raw_assets, new_related_ids), chunk_size)
+                RawAsset.history.bulk_history_create(new_raw_assets, batch_size=chunk_size)
+                counts['inserted'] += len(new_raw_assets)
+            if changed_raw_assets:
+                RawAsset.objects.bulk_update(changed_raw_assets, sorted(changed_fields) + ['last_updated'], batch_size=chunk_size)
+                for field_name in M2M_FIELDS:
+                    field = BaseAsset._meta.get_field(field_name)
+                    relinked_ids = [destination.id for destination, relinked in relinks if field_name in relinked]
+                    if relinked_ids:
+                        field.remote_field.through.objects.filter(**{f'{field.m2m_field_name()}_id__in': relinked_ids}).delete()
+                        through, links = m2m_through_rows(field_name,
+                            [(destination.id, relinked[field_name]) for destination, relinked in relinks if field_name in relinked])
+                        through.objects.bulk_create(links, batch_size=chunk_size)
+                RawAsset.history.bulk_history_create(changed_raw_assets, batch_size=chunk_size, update=True)
+                counts['updated'] += len(changed_raw_assets)
+            print(f"Processed {min(k + chunk_size, len(rows))}/{len(rows)} rows: {counts}")
+
+    for field_name, lookup in list(lookups.items()) + [('data_sources', data_sources)]:
+        if lookup.created:
+            print(f"Created {lookup.created} new {lookup.model._meta.verbose_name_plural}.")
+    print(f"Inserted {counts['inserted']}, updated {counts['updated']}, and left {counts['unchanged']} raw assets unchanged.")
+    return counts
+
 class Command(BaseCommand):
     help = 'Loads raw assets from a CSV file, which may be specified by a command-line argument.'
 
     def add_arguments(self, parser): # Necessary boilerplate for accessing args.
         parser.add_argument('args', nargs='*')
+        parser.add_argument('--bulk', action='store_true', help='Read the file once and insert the RawAssets in bulk (one transaction) instead of row by row.')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='The number of rows per bulk insert (with --bulk).')
+        parser.add_argument('--mode', choices=['insert', 'upsert'], default='insert', help='In upsert mode, rows matching existing RawAssets (by primary_key_from_rocket, then synthesized_key) update them. Upserts are always done in bulk.')
 
     def handle(self, *args, **options):
 
@@ -74,6 +392,13 @@ class Command(BaseCommand):
 
             print(f"About to start{'' if not clear_first else 'cleaning and'} uploading {chosen_asset_types}.")
 
+            if options['bulk'] or options['mode'] == 'upsert':
+                if clear_first:
+                    for asset_type in chosen_asset_types:
+                        clear_raw_assets_of_type(asset_type, extant_types)
+                bulk_load_raw_assets(file_name, chosen_asset_types, options['chunk_size'], options['mode'])
+                return
+
             total_count = 0
 
             for asset_type in chosen_asset_types:
@@ -82,14 +407,7 @@ class Command(BaseCommand):
                     dr = csv.DictReader(f) # This file needs to be reopened to refresh the dr iterator (used up in the loop below).
 
                     if clear_first:
-                        ## Clear the assets of this type if any are found in the database. ##
-                        if asset_type in extant_types:
-                            selected_assets = RawAsset.objects.filter(asset_types__name=asset_type)
-                            if len(selected_assets) > 0:
-                                print(f"Clearing all {len(selected_assets)} assets with type '{asset_type}'.")
-                                selected_assets.delete()
-                            else:
-                                print(f"No assets with type '{asset_type}' found.")
+                        clear_raw_assets_of_type(asset_type, extant_types)
 
                     ## Upload the raw assets. ##
                     keep_links = True
@@ -159,66 +477,8 @@ class Command(BaseCommand):
 
                             raw_asset = RawAsset.objects.create(
                                 asset = asset_to_link_to,
-                                name=non_blank_value_or_none(row, 'name'),
-                                localizability=get_localizability(non_blank_value_or_none(row, 'localizability')),
-
-                                url=non_blank_value_or_none(row, 'url'),
-                                email=non_blank_value_or_none(row, 'email'),
-                                phone=standardize_phone(row.get('phone', None)),
-
-                                hours_of_operation=non_blank_value_or_none(row, 'hours_of_operation'),
-                                holiday_hours_of_operation=non_blank_value_or_none(row, 'holiday_hours_of_operation'),
-                                periodicity=non_blank_value_or_none(row, 'periodicity'),
-                                capacity=non_blank_type_or_none(row, 'capacity', int),
-                                wifi_network=non_blank_value_or_none(row, 'wifi_network'),
-                                wifi_notes=non_blank_value_or_none(row, 'wifi_notes'),
-
-                                etl_notes=non_blank_value_or_none(row, 'notes'),
-
-                                child_friendly=boolify(non_blank_value_or_none(row, 'child_friendly')),
-                                internet_access=boolify(non_blank_value_or_none(row, 'internet_access')),
-                                computers_available=boolify(non_blank_value_or_none(row, 'computers_available')),
-                                accessibility=boolify(non_blank_value_or_none(row, 'accessibility')),
-                                open_to_public=boolify(non_blank_value_or_none(row, 'open_to_public')),
-                                sensitive=boolify(non_blank_value_or_none(row, 'sensitive')),
-                                do_not_display=boolify(non_blank_value_or_none(row, 'do_not_display')),
-
-                                street_address = non_blank_value_or_none(row, 'street_address'),
-                                city = non_blank_value_or_none(row, 'city'),
-                                state = non_blank_value_or_none(row, 'state'),
-                                zip_code = non_blank_value_or_none(row, 'zip_code'),
-                                parcel_id = non_blank_value_or_none(row, 'parcel_id'),
-                                residence = boolify(non_blank_value_or_none(row, 'residence')),
-                                available_transportation = non_blank_value_or_none(row, 'location_transportation'),
-                                parent_location = non_blank_value_or_none(row, 'parent_location'),
-                                # Note that parent_location has not yet been added to the Assets (since
-                                # the original loader didn't do this), so now it's being added to RawAssets
-                                # as a string, representing the name of the location.
-
-                                # The thing about the parent location is that it's just a name in the
-                                # source data at this point, and we've got to figure out how we're going
-                                # to connect it to Location instances. At present, there are only 153 distinct
-                                # parent_location values, so doing it semimanually seems viable.
-                                # It's pretty much the same deal with the organization having a
-                                # Location instance. It might eventually make sense to make this
-                                # association, but there's no data or wiring or front-end features
-                                # to support it at this point.
-                                latitude = non_blank_type_or_none(row, 'latitude', float),
-                                longitude = non_blank_type_or_none(row, 'longitude', float),
-                                #geom =  We're still not uploading the geom field yet because it wasn't
-                                # in the sample_assets.csv field used to populate the Asset model.
-                                # There are only a few features with useful geom values (boundaries of
-                                # parks mostly), and those will be handled later, once the front end
-                                # is ready to use those values.
-                                geocoding_properties = non_blank_value_or_none(row, 'geocoding_properties'),
-
-                                organization_name = non_blank_value_or_none(row, 'organization_name'),
-                                organization_email = non_blank_value_or_none(row, 'organization_email'),
-                                organization_phone = standardize_phone(row.get('organization_phone', None)),
-
                                 data_source=data_source,
-                                primary_key_from_rocket=non_blank_value_or_none(row, 'primary_key_from_rocket'),
-                                synthesized_key=non_blank_value_or_none(row, 'synthesized_key'),
+                                **raw_asset_fields_from_row(row)
                             )
 
                             raw_asset.asset_types.set(asset_types)
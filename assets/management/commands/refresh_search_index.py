@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from assets.search import refresh_search_index
+
+
+class Command(BaseCommand):
+    help = """Rebuild the AssetSearchIndex rows behind the API's ?q= search, for all Assets
+    (after migrating, or if the index has drifted) or just for the given Asset IDs.
+
+    Usage:
+    > python manage.py refresh_search_index [--ids 1 2 3]"""
+
+    def add_arguments(self, parser): # Necessary boilerplate for accessing args.
+        parser.add_argument('args', nargs='*')
+        parser.add_argument('--ids', nargs='+', type=int, help='Only these Asset IDs')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        written = refresh_search_index(options['ids'])
+        print(f"Indexed {written} Assets in {time.time() - start:.1f} seconds.")
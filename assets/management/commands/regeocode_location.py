@@ -21,6 +21,7 @@ csv.field_size_limit(sys.maxsize)  # looks like this:
 from assets.management.commands.util import parse_cell
 from assets.management.commands.clear_and_load_by_type import get_location_by_keys, update_or_create_location
 from assets.utils import geocode_address # This uses Geocod.io
+from assets.geocoding import BatchGeocoder
 # _csv.Error: field larger than field limit (131072)
 
 def form_full_address_from_location(location):
@@ -37,7 +38,8 @@ def form_full_address_from_location(location):
 
     return "{}, {}, {} {}".format(location.street_address, city, state, location.zip_code)
 
-def regeocode(location_id, dry_run):
+def regeocode(location_id, dry_run, geocoded=None):
+    # geocoded is an optional dict of pre-fetched geocode_address results (keyed by full address).
     location = Location.objects.get(pk=location_id)
     total = len(location.asset_set.all())
     print(f"The location has name '{location.name}', street_address '{location.street_address}', and {total} linked Assets.")
@@ -46,7 +48,10 @@ def regeocode(location_id, dry_run):
         
         full_address = form_full_address_from_location(location)
         # Try to geocode with Geocod.io/Geomancer
-        latitude, longitude, properties = geocode_address(full_address)
+        if geocoded is not None and full_address in geocoded:
+            latitude, longitude, properties = geocoded[full_address]
+        else:
+            latitude, longitude, properties = geocode_address(full_address)
         if latitude is None:
             #print(f"Geocoordinates for Location ID {location.id} are being set to (None, None).")
             print(f"Skipping this one since the return geocoordinates are (None, None).")
@@ -62,13 +67,22 @@ def regeocode(location_id, dry_run):
                 location.save()
 
 class Command(BaseCommand):
-    help = """For a given location_id, regeocode it based on its address information."""
+    help = """For the given location_id values, regeocode them based on their address information."""
 
     def add_arguments(self, parser): # Necessary boilerplate for accessing args.
         parser.add_argument('args', nargs='*')
 
     def handle(self, *args, **options):
         dry_run = False
-        if len(args) != 1:
-            raise ValueError("This script accepts exactly one command-line argument, which should be a valid Location ID.")
-        regeocode(args[0], dry_run)
+        if len(args) == 0:
+            raise ValueError("This script accepts one or more command-line arguments, which should be valid Location IDs.")
+        if len(args) == 1:
+            regeocode(args[0], dry_run)
+            return
+        # Geocode all the addresses in one batch (deduplicated and cached), then update the Locations.
+        locations = Location.objects.filter(pk__in=args).exclude(street_address__isnull=True).exclude(street_address='')
+        geocoder = BatchGeocoder()
+        geocoded = geocoder.geocode([form_full_address_from_location(location) for location in locations])
+        print(f"Geocoding stats: {geocoder.stats}")
+        for location_id in args:
+            regeocode(location_id, dry_run, geocoded)
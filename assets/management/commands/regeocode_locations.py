@@ -0,0 +1,175 @@
+import hashlib, json, os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Q
+
+from assets.caching import bump_generation
+from assets.filters import WITHIN_GEOGRAPHIES
+from assets.geocoding import BatchGeocoder
+from assets.models import Asset, Location
+from assets.tasks import queue_carto_sync
+from assets.management.commands.regeocode_location import form_full_address_from_location
+
+CHANGE_REASON = 'Regeocoding locations (regeocode_locations)'
+
+def select_locations(options):
+    """Build the queryset of Locations to regeocode from the command-line predicates.
+    The problem predicates (--iffy, --pelias, --null-coordinates) are combined with OR,
+    and then --within and --ids narrow the selection down (or, without any problem
+    predicates, select all the Locations in the geography or with those IDs)."""
+    problems = Q()
+    if options['iffy']:
+        problems |= Q(iffy_geocoding=True)
+    if options['pelias']: # Pelias geocodings (which have 'confidence' properties) are questionable.
+        problems |= Q(geocoding_properties__contains="'confidence'")
+    if options['null_coordinates']:
+        problems |= Q(latitude__isnull=True) | Q(longitude__isnull=True)
+    if not problems and not options['ids'] and not options['within']:
+        raise ValueError("Choose some Locations with --iffy, --pelias, --null-coordinates, --within, and/or --ids.")
+
+    locations = Location.objects.filter(problems).exclude(street_address__isnull=True).exclude(street_address='')
+    if options['within']:
+        model_name, _, pk = options['within'].partition(':')
+        if model_name not in WITHIN_GEOGRAPHIES or not pk:
+            raise ValueError(f"--within should look like <{'|'.join(WITHIN_GEOGRAPHIES.keys())}>:<id>, not '{options['within']}'.")
+        model = WITHIN_GEOGRAPHIES[model_name]
+        try:
+            boundary = model.objects.get(pk=pk)
+        except (model.DoesNotExist, ValueError):
+            raise ValueError(f"There is no {model_name} with ID '{pk}'.")
+        locations = locations.filter(geom__within=boundary.geom) # Locations without geom can't be in here.
+    if options['ids']:
+        locations = locations.filter(pk__in=options['ids'])
+    return locations.order_by('id')
+
+def selection_key(options):
+    """Identify the selection, so that a checkpoint is only resumed by the same one."""
+    selection = {k: options[k] for k in ['iffy', 'pelias', 'null_coordinates', 'within', 'ids']}
+    return hashlib.sha1(json.dumps(selection, sort_keys=True).encode('utf-8')).hexdigest()
+
+def read_checkpoint(path, key):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get('selection') != key:
+        raise ValueError(f"The checkpoint in {path} is for a different selection of Locations. Delete it or run without --resume.")
+    return checkpoint
+
+def write_checkpoint(path, checkpoint):
+    # Write to a temporary file and then rename it, so that a crash can't leave
+    # a half-written checkpoint.
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(temporary_path, path)
+
+def geocode_chunk(geocoder, chunk):
+    """Return the geocoded results for the chunk and the number of requests
+    that failed while geocoding it. (The chunks are geocoded one at a time on
+    one worker thread, so the error count is this chunk's alone, unlike the
+    geocoder's running total, which the next chunk may already be adding to.)"""
+    try:
+        errors_before = geocoder.stats['errors']
+        geocoded = geocoder.geocode([form_full_address_from_location(location) for location in chunk])
+        return geocoded, geocoder.stats['errors'] - errors_before
+    finally:
+        connections.close_all() # This runs in a worker thread, which has its own connections.
+
+def apply_results(chunk, geocoded, dry_run):
+    """Update the Locations in the chunk that got geocoded, with one bulk_update
+    and one batch of history records."""
+    updated = []
+    for location in chunk:
+        latitude, longitude, properties = geocoded[form_full_address_from_location(location)]
+        if latitude is None:
+            continue # As in regeocode_location, don't throw away the old geocoordinates.
+        location.latitude = latitude
+        location.longitude = longitude
+        location.geom = Point((float(longitude), float(latitude))) # (Location.save only sets geom when it's missing.)
+        location.geocoding_properties = str(properties)
+        location._change_reason = CHANGE_REASON
+        updated.append(location)
+    if updated and not dry_run:
+        with transaction.atomic():
+            Location.objects.bulk_update(updated, ['latitude', 'longitude', 'geom', 'geocoding_properties'])
+            Location.history.bulk_history_create(updated, update=True)
+        # bulk_update doesn't send signals, so do what the save signals would have.
+        bump_generation('location')
+        queue_carto_sync(list(Asset.objects.filter(location__in=updated).values_list('id', flat=True)))
+    return updated
+
+class Command(BaseCommand):
+    help = """Regeocode the Locations matching some predicates in chunks through the batch geocoder,
+    saving a checkpoint after each chunk so that an interrupted run can be resumed with --resume."""
+
+    def add_arguments(self, parser): # Necessary boilerplate for accessing args.
+        parser.add_argument('args', nargs='*')
+        parser.add_argument('--iffy', action='store_true', help='Locations with iffy_geocoding set')
+        parser.add_argument('--pelias', action='store_true', help="Locations geocoded by Pelias (with 'confidence' geocoding properties)")
+        parser.add_argument('--null-coordinates', action='store_true', help='Locations without geocoordinates')
+        parser.add_argument('--within', help='Locations within a geography (alone or narrowing the other predicates), like tract:42003020100 or neighborhood:12')
+        parser.add_argument('--ids', nargs='+', type=int, help='Only these Location IDs')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--checkpoint', default=os.path.join(settings.BASE_DIR, 'regeocode_locations.checkpoint.json'))
+        parser.add_argument('--resume', action='store_true', help='Continue after the last Location ID in the checkpoint file.')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        key = selection_key(options)
+        locations = select_locations(options)
+        checkpoint = read_checkpoint(options['checkpoint'], key) if options['resume'] else None
+        retry_list = []
+        if checkpoint is None:
+            checkpoint = {'selection': key, 'last_id': None, 'updated': 0, 'failed_ids': []}
+        else:
+            # Pick up after the last chunk, and retry the Locations that couldn't be
+            # geocoded (which include any left over when the quota ran out).
+            failed_ids = checkpoint.setdefault('failed_ids', [])
+            print(f"Resuming after Location ID {checkpoint['last_id']} (and retrying {len(failed_ids)} Locations).")
+            retry_list = list(locations.filter(id__in=failed_ids))
+            locations = locations.filter(id__gt=checkpoint['last_id'] or 0).exclude(id__in=failed_ids)
+
+        location_list = list(locations)
+        chunk_size = options['chunk_size']
+        geocoder = BatchGeocoder()
+        # The retries skip the cached negative results, since those may be what
+        # the earlier run got back for them.
+        retry_geocoder = BatchGeocoder(skip_negative_cache=True)
+        chunks = [(retry_geocoder, retry_list[k:k+chunk_size]) for k in range(0, len(retry_list), chunk_size)]
+        chunks += [(geocoder, location_list[k:k+chunk_size]) for k in range(0, len(location_list), chunk_size)]
+        print(f"Regeocoding {len(retry_list) + len(location_list)} Locations in {len(chunks)} chunks.")
+
+        # Geocode the next chunk while the results of the current one are being written.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(geocode_chunk, *chunks[0]) if chunks else None
+            for n, (_, chunk) in enumerate(chunks):
+                geocoded, errors = future.result()
+                future = executor.submit(geocode_chunk, *chunks[n+1]) if n + 1 < len(chunks) else None
+                updated = apply_results(chunk, geocoded, options['dry_run'])
+                if not updated and errors:
+                    # Nothing at all could be geocoded and requests failed, which usually means
+                    # that the geocoding quota has run out (or the geocoder is down), so stop
+                    # here without advancing the checkpoint. (The chunk's Locations are marked
+                    # as failed, so that --resume retries them without the negative cache.)
+                    print(f"None of the {len(chunk)} Locations in this chunk could be geocoded. Stopping (rerun with --resume to continue from here).")
+                    if future is not None:
+                        future.cancel()
+                    checkpoint['failed_ids'] = sorted(set(checkpoint['failed_ids']) | {location.id for location in chunk})
+                    if not options['dry_run']:
+                        write_checkpoint(options['checkpoint'], checkpoint)
+                    break
+                updated_ids = {location.id for location in updated}
+                chunk_ids = {location.id for location in chunk}
+                checkpoint['last_id'] = max(checkpoint['last_id'] or 0, chunk[-1].id) # (Retried Locations come before it.)
+                checkpoint['updated'] += len(updated)
+                checkpoint['failed_ids'] = sorted((set(checkpoint['failed_ids']) - chunk_ids) | (chunk_ids - updated_ids))
+                if not options['dry_run']:
+                    write_checkpoint(options['checkpoint'], checkpoint)
+                print(f"Chunk {n+1}/{len(chunks)}: Updated {len(updated)}/{len(chunk)} Locations (through ID {chunk[-1].id}).")
+
+        print(f"Updated {checkpoint['updated']} Locations; {len(checkpoint['failed_ids'])} could not be geocoded (--resume retries them). Geocoding stats: {geocoder.stats}, retries: {retry_geocoder.stats}")
@@ -11,7 +11,8 @@ from django.core.management.base import BaseCommand
 
 from assets.models import Asset, AssetType
 from parameters.credentials import CARTO_API_KEY
-from assets.util_carto import sync_asset_to_carto, insert_new_assets_into_carto, get_carto_asset_ids, boolean_to_string, fix_carto_geofields, TABLE_NAME, USERNAME, USR_BASE_URL, DEFAULT_CARTO_FIELDS
+from assets.carto_sync import incremental_sync
+from assets.util_carto import CartoSyncSession, get_carto_asset_ids, boolean_to_string, fix_carto_geofields, TABLE_NAME, USERNAME, USR_BASE_URL, DEFAULT_CARTO_FIELDS
 
 USERNAME = "wprdc" # Replicated in 
 USR_BASE_URL = "https://{user}.carto.com/".format(user=USERNAME)  # util_carto.py
@@ -223,8 +224,16 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser): # Necessary boilerplate for accessing args.
         parser.add_argument('args', nargs='*')
+        parser.add_argument('--incremental', action='store_true', help='Push only the rows that changed since the last incremental sync (for the nightly run).')
+        parser.add_argument('--dry-run', action='store_true', help='With --incremental, report what would be pushed without pushing it.')
 
     def handle(self, *args, **options):
+        if options['incremental']:
+            if args:
+                raise ValueError("An incremental sync covers all Assets, so asset types can not be specified.")
+            incremental_sync(dry_run=options['dry_run'])
+            return
+
         extant_asset_types = [a.name for a in AssetType.objects.all()]
         chosen_asset_types = []
         for arg in args:
@@ -236,25 +245,18 @@ class Command(BaseCommand):
         if chosen_asset_types == []:
             print(f"Preparing to sync all Assets to Carto.")
             chosen_assets = Asset.objects.all()
-            raise ValueError("Not ready to sync all Assets to Carto yet.")
         else:
             print(f"Preparing to sync all Assets in these types: {chosen_asset_types}")
-            chosen_assets = Asset.objects.filter(asset_types__name__in = chosen_asset_types)
-
-        insert_list = []
-        pushed = 0
-        existing_ids = get_carto_asset_ids()
-        for a in chosen_assets:
-            pushed, insert_list = sync_asset_to_carto(a, existing_ids, pushed, insert_list)
+            chosen_assets = Asset.objects.filter(asset_types__name__in = chosen_asset_types).distinct()
 
-        if len(insert_list) > 0:
-            print(f"Pushing {len(insert_list)} assets.")
-            insert_new_assets_into_carto(insert_list, DEFAULT_CARTO_FIELDS)
-            pushed += len(insert_list)
+        # The session builds the Carto rows (with the marker offsets) from one
+        # projection query rather than one query per Asset.
 
-        # Fix all those Carto geofields
-        if pushed > 0:
-            fix_carto_geofields()
+        # One CartoSyncSession reuses a single HTTP connection and packs the
+        # deletes, updates, and inserts into as few requests as possible.
+        # The geofields are set as the records are written.
+        session = CartoSyncSession()
+        session.sync_assets(chosen_assets)
 
 
 #if __name__ == '__main__':
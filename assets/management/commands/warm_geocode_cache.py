@@ -0,0 +1,49 @@
+import ast
+
+from django.core.management.base import BaseCommand
+
+from assets.models import Location, GeocodeCacheEntry
+from assets.geocoding import normalize_address, save_results, fresh_entries, expired_entries
+from assets.management.commands.regeocode_location import form_full_address_from_location
+
+def properties_from_location(location):
+    # geocoding_properties is usually the string representation of a dict.
+    try:
+        properties = ast.literal_eval(location.geocoding_properties)
+    except (ValueError, SyntaxError):
+        return location.geocoding_properties
+    return properties
+
+class Command(BaseCommand):
+    help = """Fill the geocode cache from the addresses and geocoordinates of existing Locations,
+    so that geocoding those addresses again doesn't need a remote request."""
+
+    def add_arguments(self, parser): # Necessary boilerplate for accessing args.
+        parser.add_argument('args', nargs='*')
+        parser.add_argument('--overwrite', action='store_true', help='Replace fresh cache entries too (by default only missing or expired ones are filled).')
+        parser.add_argument('--purge-expired', action='store_true', help='Delete expired cache entries first.')
+
+    def handle(self, *args, **options):
+        if options['purge_expired']:
+            deleted = expired_entries().delete()[0]
+            print(f"Deleted {deleted} expired geocode cache entries.")
+
+        locations = Location.objects.exclude(street_address__isnull=True).exclude(street_address='').filter(
+            latitude__isnull=False, longitude__isnull=False)
+        results = {}
+        skipped = 0
+        for location in locations.order_by('id'): # When Locations share an address, the newest one wins.
+            properties = location.geocoding_properties or ''
+            if 'centroid' in properties or 'Unsuccessfully' in properties:
+                skipped += 1 # Not a real geocoding of the address
+                continue
+            address = normalize_address(form_full_address_from_location(location))
+            results[address] = (location.latitude, location.longitude, properties_from_location(location))
+
+        if not options['overwrite']:
+            fresh = set(fresh_entries().values_list('normalized_address', flat=True))
+            results = {address: result for address, result in results.items() if address not in fresh}
+
+        save_results(results, provider='Location')
+        print(f"Warmed the geocode cache with {len(results)} addresses from Locations (skipping {skipped} with centroid or failed geocoordinates).")
+        print(f"The cache now has {GeocodeCacheEntry.objects.count()} entries.")
@@ -0,0 +1,93 @@
+import numpy as np
+
+from django.db.models import Exists, OuterRef
+
+from assets.models import Asset
+
+MARKER_OFFSET_RADIUS = 0.00005 # In degrees. This will be about 18 feet north/south and 15 feet east/west.
+
+# Assets that share a Location would be drawn on top of each other, so each
+# one is nudged onto a circle around the Location. The Assets at a Location
+# (delisted ones included) are sorted by asset type, then name, then ID, and
+# the nth of N goes at angle 2*pi*n/N, measured clockwise from north.
+# The Carto sync, the vector tiles and the GeoJSON export all get their
+# offsets from here so that the markers line up everywhere.
+
+def apply_marker_offsets(rows):
+    """Offset the 'latitude' and 'longitude' of rows (dicts that also have
+    'id', 'location_id', 'asset_type', and 'name') in place, and return the
+    rows sorted by Location and offset order."""
+    rows.sort(key=lambda r: (r['location_id'], r['asset_type'] or '', r['name'] or '', r['id']))
+    if not rows:
+        return rows
+    location_ids = np.array([r['location_id'] for r in rows])
+    _, starts, counts = np.unique(location_ids, return_index=True, return_counts=True)
+    totals = np.repeat(counts, counts)
+    ranks = np.arange(len(rows)) - np.repeat(starts, counts)
+    angles = 2*np.pi*ranks/totals
+    shared = totals > 1
+    latitudes = np.array([r['latitude'] for r in rows], dtype=float) + np.where(shared, MARKER_OFFSET_RADIUS*np.cos(angles), 0)
+    longitudes = np.array([r['longitude'] for r in rows], dtype=float) + np.where(shared, MARKER_OFFSET_RADIUS*np.sin(angles), 0)
+    for row, latitude, longitude in zip(rows, latitudes.tolist(), longitudes.tolist()):
+        row['latitude'] = latitude
+        row['longitude'] = longitude
+    return rows
+
+def offset_location_groups(rows, batch_size=2000):
+    """Apply the offsets to rows that arrive ordered by location_id, yielding
+    the offset rows (still grouped by Location, and sorted within each
+    Location by offset order). Whole Locations are buffered up to about
+    batch_size rows so that each call to apply_marker_offsets covers many of
+    them at once."""
+    batch = []
+    for row in rows:
+        # Only cut the batch between Locations, since each one's offsets
+        # depend on all of its Assets.
+        if len(batch) >= batch_size and row['location_id'] != batch[-1]['location_id']:
+            yield from apply_marker_offsets(batch)
+            batch = []
+        batch.append(row)
+    yield from apply_marker_offsets(batch)
+
+def iter_offset_asset_rows(assets=None, chunk_size=2000):
+    """Yield dicts of the map fields (id, name, asset_type, asset_type_title,
+    category, category_title, sensitive, do_not_display, location_id, latitude,
+    and longitude, with the offsets applied) for the Assets in the given
+    queryset (or all Assets) that have geocoordinates, grouped by Location.
+
+    The rows are streamed from one query ordered by Location, so memory use
+    stays around chunk_size rows (more only when one Location has more
+    Assets than that). The Assets sharing
+    a Location with the selected ones are needed to work out the offsets, so
+    they are pulled in the same query and dropped afterward."""
+    queryset = Asset.objects.with_first_asset_type().filter(
+        location__latitude__isnull=False, location__longitude__isnull=False)
+    if assets is not None:
+        queryset = queryset.filter(location_id__in=assets.order_by().values('location_id'))
+        queryset = queryset.annotate(selected=Exists(assets.order_by().filter(pk=OuterRef('pk'))))
+        extra_fields = ['selected']
+    else:
+        extra_fields = []
+
+    def rows():
+        for row in queryset.order_by('location_id').values('id', 'name', 'asset_type', 'asset_type_title',
+                'category_name', 'category_title', 'sensitive', 'do_not_display', 'location_id',
+                'location__latitude', 'location__longitude', *extra_fields).iterator(chunk_size=chunk_size):
+            row['category'] = row.pop('category_name')
+            row['latitude'] = row.pop('location__latitude')
+            row['longitude'] = row.pop('location__longitude')
+            yield row
+
+    for row in offset_location_groups(rows(), batch_size=chunk_size):
+        if assets is None or row.pop('selected'):
+            yield row
+
+def offset_asset_rows(assets=None):
+    """Like iter_offset_asset_rows, but as a list."""
+    return list(iter_offset_asset_rows(assets))
+
+def offset_coordinates(asset_ids):
+    """Return a dict mapping each of the given Asset IDs (that has
+    geocoordinates) to its offset (latitude, longitude)."""
+    rows = offset_asset_rows(Asset.objects.filter(pk__in=list(asset_ids)))
+    return {row['id']: (row['latitude'], row['longitude']) for row in rows}
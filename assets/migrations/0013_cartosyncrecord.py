@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0012_remove_asset_category'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartoSyncRecord',
+            fields=[
+                ('asset_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('fingerprint', models.CharField(max_length=40)),
+                ('synced_at', models.DateTimeField()),
+            ],
+        ),
+    ]
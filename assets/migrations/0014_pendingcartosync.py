@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0013_cartosyncrecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingCartoSync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('asset_id', models.IntegerField(unique=True)),
+                ('queued_at', models.DateTimeField()),
+            ],
+        ),
+    ]
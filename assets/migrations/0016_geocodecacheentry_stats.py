@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0015_geocodecacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='geocodecacheentry',
+            name='provider',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='geocodecacheentry',
+            name='accuracy',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='geocodecacheentry',
+            name='hit_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='geocodecacheentry',
+            name='last_hit_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
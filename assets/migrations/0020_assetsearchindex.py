@@ -0,0 +1,84 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.operations import TrigramExtension
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations, models
+from django.db.models import CharField, OuterRef, Subquery
+import django.db.models.deletion
+
+CHUNK_SIZE = 2000
+
+
+def fill_search_index(apps, schema_editor):
+    # The same rows that assets.search.refresh_search_index builds, but from
+    # the historical models.
+    Asset = apps.get_model('assets', 'Asset')
+    AssetSearchIndex = apps.get_model('assets', 'AssetSearchIndex')
+
+    def m2m_names(field_name, path):
+        field = Asset._meta.get_field(field_name)
+        through = field.remote_field.through
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        return Subquery(through.objects.filter(**{f'{source}_id': OuterRef('pk')}).order_by()
+            .values(f'{source}_id')
+            .annotate(joined=StringAgg(f'{target}__{path}', ' ', ordering='id'))
+            .values('joined'), output_field=CharField())
+
+    vector = (SearchVector('name', weight='A', config='english')
+        + SearchVector('organization_name', weight='B', config='english')
+        + SearchVector('keywords', weight='C', config='english')
+        + SearchVector('address', weight='D', config='english'))
+    asset_ids = list(Asset.objects.order_by('id').values_list('id', flat=True))
+    for k in range(0, len(asset_ids), CHUNK_SIZE):
+        chunk = asset_ids[k:k+CHUNK_SIZE]
+        rows = (Asset.objects.filter(pk__in=chunk)
+            .annotate(tag_names=m2m_names('tags', 'name'), service_names=m2m_names('services', 'name'),
+                asset_type_titles=m2m_names('asset_types', 'title'))
+            .values_list('id', 'name', 'organization__name', 'location__street_address', 'location__city',
+                'location__zip_code', 'tag_names', 'service_names', 'asset_type_titles'))
+        AssetSearchIndex.objects.bulk_create([AssetSearchIndex(asset_id=asset_id, name=name or '',
+                organization_name=organization_name or '',
+                address=' '.join(part for part in [street_address, city, zip_code] if part),
+                keywords=' '.join(k for k in keywords if k))
+            for asset_id, name, organization_name, street_address, city, zip_code, *keywords in rows], batch_size=1000)
+        AssetSearchIndex.objects.filter(asset_id__in=chunk).update(search_vector=vector)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0019_asset_last_updated_index'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.CreateModel(
+            name='AssetSearchIndex',
+            fields=[
+                ('asset', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_index', serialize=False, to='assets.Asset')),
+                ('name', models.CharField(max_length=255)),
+                ('organization_name', models.TextField(blank=True, default='')),
+                ('address', models.TextField(blank=True, default='')),
+                ('keywords', models.TextField(blank=True, default='')),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='assetsearchindex',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='assets_search_vector'),
+        ),
+        migrations.AddIndex(
+            model_name='assetsearchindex',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='assets_search_name_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='location',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='assets_location_name_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='location',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['street_address'], name='assets_location_address_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.RunPython(fill_search_index, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,12 @@
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import Point
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.db.models import OuterRef, Subquery
 from phonenumber_field.modelfields import PhoneNumberField
 from simple_history.models import HistoricalRecords
 
 from assets.utils import geocode_address
-from assets.util_carto import sync_asset_to_carto, get_carto_asset_ids, fix_carto_geofields
 
 from pprint import pprint
 
@@ -70,7 +72,8 @@ class Location(models.Model):
     )
     latitude = models.FloatField(null=True, blank=True)
     longitude = models.FloatField(null=True, blank=True)
-    geom = models.PointField(null=True, blank=True)
+    geom = models.PointField(null=True, blank=True, spatial_index=True) # The GiST index on
+    # this field is what makes the API's spatial filters (in_bbox, near, within) fast.
     geocoding_properties = models.TextField(null=True, blank=True)
     iffy_geocoding = models.BooleanField(null=True, blank=True) # If False, this means that
     # someone has decided that the location's geocoordinates are unambiguously correct.
@@ -85,6 +88,13 @@ class Location(models.Model):
 
     history = HistoricalRecords()
 
+    class Meta:
+        # Trigram indexes for the API's fuzzy ?q= search (see assets.search).
+        indexes = [
+            GinIndex(fields=['name'], name='assets_location_name_trgm', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['street_address'], name='assets_location_address_trgm', opclasses=['gin_trgm_ops']),
+        ]
+
     @property
     def full_address(self):
         if self.street_address:
@@ -97,8 +107,9 @@ class Location(models.Model):
             return ', '.join(parts)
         return ""
 
-    def save(self, *args, **kwargs):
-        """ When the model is saved, add geom and name (if needed). """
+    def fill_in_derived_fields(self):
+        """ Add geom and name (if needed). This is what save does, pulled out so that
+        Locations written with bulk_create/bulk_update (which skip save) get the same values. """
         if not self.pk or self.name == 'None, None None None':
             if self.street_address not in [None, '']:
                 parts = [self.street_address] # The next few lines are just full_address.
@@ -122,10 +133,13 @@ class Location(models.Model):
         # bad geocoordinates to an asset (like the centroid of Pittsburgh). Currently ~0.5%
         # of assets are ungeocoded, so this is not necessary.
         if not self.geom:
-            print(self.latitude, self.longitude)
             self.geom = Point(
                 (float(self.longitude), float(self.latitude))
             ) if self.latitude and self.longitude else None
+
+    def save(self, *args, **kwargs):
+        """ When the model is saved, add geom and name (if needed). """
+        self.fill_in_derived_fields()
         super(Location, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -306,6 +320,30 @@ class RawAsset(BaseAsset):
 #    def category(self):
 #        return self.asset_types.all()[0].category
 
+class AssetQuerySet(models.QuerySet):
+    def displayable(self):
+        """Assets that belong on the map: not delisted and at a Location
+        with geocoordinates."""
+        return self.exclude(do_not_display=True).filter(
+            location__latitude__isnull=False,
+            location__longitude__isnull=False,
+        )
+
+    def with_first_asset_type(self):
+        """Annotate asset_type, asset_type_title, category_name and
+        category_title from the first asset type (as Asset.category and the
+        Carto sync do), so that these values can be pulled with .values() in
+        one query. (category_name avoids clashing with Asset.category.)"""
+        first_type = Asset.asset_types.through.objects.filter(
+            asset_id=OuterRef('pk')).order_by('id')
+        return self.annotate(
+            asset_type=Subquery(first_type.values('assettype__name')[:1]),
+            asset_type_title=Subquery(first_type.values('assettype__title')[:1]),
+            category_name=Subquery(first_type.values('assettype__category__name')[:1]),
+            category_title=Subquery(first_type.values('assettype__category__title')[:1]),
+        )
+
+
 class Asset(models.Model):
     name = models.CharField(max_length=255)
     localizability = models.CharField(max_length=3, choices=LOCALIZABILITY_CHOICES, null=True, blank=True)
@@ -346,6 +384,13 @@ class Asset(models.Model):
 
     history = HistoricalRecords()
 
+    objects = AssetQuerySet.as_manager()
+
+    class Meta:
+        # The API's ETags and Last-Modified headers (see assets.caching.ConditionalGetMixin)
+        # come from Max('last_updated'), which this index answers without a table scan.
+        indexes = [models.Index(fields=['last_updated'], name='assets_asset_last_updated')]
+
     @property
     def category(self):
         return self.asset_types.all()[0].category
@@ -357,27 +402,149 @@ class Asset(models.Model):
         override_carto_sync = kwargs.pop('override_carto_sync', False)
         if len(self.rawasset_set.all()) == 0: # Hide Assets that are
             self.do_not_display = True # not linked to by RawAssets.
+        super(Asset, self).save(*args, **kwargs)
+
         if not override_carto_sync:
-            # When saving Assets, if do_not_display changes to True, the Asset should be
-            # deleted from the Carto table.
-            existing_ids = get_carto_asset_ids(self.id) # This has been tested.
-
-            # Currently, this is just blindly updating the Carto table without checking
-            # whether a change is necessary (that is, whether one of a few fields
-            # [name, do_not_display, latitude, longitude, asset type, category] has
-            # been altered).
-            pushed, insert_list = sync_asset_to_carto(self, existing_ids, 0, [], records_per_request=1)
-            if pushed > 0:
-                fix_carto_geofields(self.id)
+            # Rather than blocking on Carto requests, queue this Asset to be synced
+            # in the background. Repeated saves within the coalescing window
+            # collapse into one push. (Deletions from Carto happen the same way
+            # when do_not_display changes to True.)
+            from assets.tasks import queue_carto_sync
+            queue_carto_sync([self.id])
 
             # Note that while the geocoordinates of this Asset will be offset from the Location coordinates
             # when there are multiple Assets at that Location, the other offsets are not being updated,
             # so accidental overlaps are not inconceivable without more thorough checks, randomized offsets,
-            # or periodic bulk updates.
-
-            # The Carto SQL connector would be an alternative to this sync_asset_to_carto approach.
-        super(Asset, self).save(*args, **kwargs)
+            # or periodic bulk updates (sync_to_carto --incremental).
 
         # Similar syncing could be done when changing Location instances in a way
         # that would affect Asset locations, but all the affected Assets would need
         # to be collected and updated. For now, a daily cronjob will catch these changes.
+
+
+class CartoSyncRecord(models.Model):
+    # A journal of what was last pushed to the Carto table for each Asset, so that
+    # an incremental sync only has to send the rows that changed. This is keyed by
+    # the Asset ID (rather than a ForeignKey) so that the record outlives the Asset
+    # until the corresponding Carto row has been deleted.
+    asset_id = models.IntegerField(primary_key=True)
+    fingerprint = models.CharField(max_length=40) # SHA-1 of the Carto row
+    synced_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.asset_id}: {self.fingerprint}'
+
+
+class PendingCartoSync(models.Model):
+    # Asset IDs waiting to be pushed to Carto by assets.tasks.flush_pending_carto_syncs.
+    # The uniqueness of asset_id is what coalesces repeated saves of one Asset.
+    asset_id = models.IntegerField(unique=True)
+    queued_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.asset_id} (queued at {self.queued_at})'
+
+
+class GeocodeCacheEntry(models.Model):
+    # Results from the geocoders, keyed by normalized address (see
+    # assets.geocoding.normalize_address), so that an address is only sent
+    # to Geocodio/Geomancer once per GEOCODE_CACHE_TTL_DAYS.
+    normalized_address = models.CharField(max_length=500, unique=True)
+    latitude = models.FloatField(null=True, blank=True) # Null for addresses that
+    longitude = models.FloatField(null=True, blank=True) # couldn't be geocoded.
+    provider = models.CharField(max_length=50, null=True, blank=True) # Geocodio, Geomancer, or Location (from warm_geocode_cache)
+    accuracy = models.FloatField(null=True, blank=True)
+    properties = models.TextField(null=True, blank=True) # JSON of the geocoding_properties
+    geocoded_at = models.DateTimeField()
+    hit_count = models.IntegerField(default=0)
+    last_hit_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.normalized_address}: ({self.latitude}, {self.longitude})'
+
+
+class BulkUpdateJob(models.Model):
+    # An upload of merge instructions to the Asset updater. The file is saved to disk
+    # and processed in the background by assets.tasks.run_bulk_update_job, which
+    # records its progress here for the upload page to poll.
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    using = models.CharField(max_length=20) # using-assets or using-raw-assets
+    mode = models.CharField(max_length=10) # validate or update
+    file_path = models.CharField(max_length=500)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    rows_total = models.IntegerField(null=True, blank=True)
+    rows_processed = models.IntegerField(default=0)
+    errors = models.IntegerField(default=0)
+    more_results = models.TextField(default='[]') # JSON list of the log lines
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.mode} {self.using} ({self.status})'
+
+
+class AssetDump(models.Model):
+    # A CSV dump of all the Assets (from dump_assets_all_fields), written in the background
+    # by assets.tasks.dump_assets_to_file. The version identifies the state of the Asset
+    # table that was dumped, so that a dump can be reused until an Asset changes, and the
+    # timings of past dumps are used to estimate how long the next one will take.
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    version = models.CharField(max_length=100, db_index=True) # The latest last_updated and the number of Assets
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    file_name = models.CharField(max_length=255, null=True, blank=True)
+    record_count = models.IntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def duration(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return (self.finished_at - self.started_at).total_seconds()
+
+    def __str__(self):
+        return f'{self.version} ({self.status})'
+
+
+class AssetSearchIndex(models.Model):
+    """The searchable text of an Asset (including that of its Organization,
+    Location, tags, services, and asset types), with a weighted tsvector for
+    full-text search and a trigram index on the name for fuzzy matches. The
+    rows are rebuilt by assets.search.refresh_search_index, which the signals
+    (and the bulk writers) call when any of the text changes."""
+    asset = models.OneToOneField(Asset, on_delete=models.CASCADE, primary_key=True, related_name='search_index')
+    name = models.CharField(max_length=255)
+    organization_name = models.TextField(blank=True, default='')
+    address = models.TextField(blank=True, default='')
+    keywords = models.TextField(blank=True, default='') # Tags, services, and asset types
+    search_vector = SearchVectorField(null=True)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='assets_search_vector'),
+            GinIndex(fields=['name'], name='assets_search_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,110 @@
+import base64, binascii, json
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+# Deep limit/offset pages make Postgres scan and throw away every row before
+# the offset, and each page also runs a count(). Keyset pagination instead
+# orders by id and picks up after the last id of the previous page (which the
+# primary-key index answers directly), so the thousandth page costs the same
+# as the first. The cursor is just that id, base64-encoded so that clients
+# treat it as opaque.
+#
+# HybridPagination keeps the limit/offset behavior for existing clients and
+# switches to keyset pagination when the request has a cursor parameter
+# (an empty one for the first page):
+#     /assets/?cursor=&limit=500
+#     -> {"next": ".../assets/?cursor=eyJhZnRlciI6IDUxMn0%3D&limit=500", "results": [...]}
+# Add count=true to get the total number of records too (at the cost of the
+# count() query). KeysetPagination paginates by keyset even without a cursor.
+#
+# Ranked search results (with q=; see assets.filters.TextSearchFilter) are
+# ordered by rank rather than by id, so they always get limit/offset pages.
+
+KEYSET_PAGE_SIZE = getattr(settings, 'KEYSET_PAGE_SIZE', 500)
+KEYSET_MAX_PAGE_SIZE = getattr(settings, 'KEYSET_MAX_PAGE_SIZE', 5000)
+
+
+def encode_cursor(after):
+    return base64.urlsafe_b64encode(json.dumps({'after': after}).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Return the id that the page should start after (None for the first page)."""
+    if not cursor:
+        return None
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))['after']
+    except (binascii.Error, ValueError, UnicodeError, KeyError, TypeError):
+        raise NotFound("Invalid cursor")
+    if not isinstance(after, int):
+        raise NotFound("Invalid cursor")
+    return after
+
+
+class HybridPagination(LimitOffsetPagination):
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    ranked_query_param = 'q'
+    keyset_by_default = False
+
+    def uses_keyset(self, request):
+        if request.query_params.get(self.ranked_query_param, '').strip():
+            return False # Keyset pages would throw away the ranking.
+        return self.keyset_by_default or self.cursor_query_param in request.query_params
+
+    def get_keyset_limit(self, request):
+        try:
+            return _positive_int(request.query_params[self.limit_query_param], strict=True, cutoff=KEYSET_MAX_PAGE_SIZE)
+        except (KeyError, ValueError):
+            return KEYSET_PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.uses_keyset(request)
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_keyset_limit(request)
+        self.display_page_controls = False # The browsable API's page controls are offset-based.
+        self.count = None
+        if request.query_params.get(self.count_query_param, '').lower() in ['true', '1']:
+            self.count = queryset.order_by().count()
+
+        queryset = queryset.order_by('id')
+        after = decode_cursor(request.query_params.get(self.cursor_query_param))
+        if after is not None:
+            queryset = queryset.filter(id__gt=after)
+        page = list(queryset[:self.limit + 1]) # The extra record shows whether there's a next page.
+        self.has_next = len(page) > self.limit
+        page = page[:self.limit]
+        if not page:
+            self.last_id = None
+        else: # (The page holds dicts when the fast list serializers use .values().)
+            self.last_id = page[-1]['id'] if isinstance(page[-1], dict) else page[-1].id
+        return page
+
+    def get_keyset_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encode_cursor(self.last_id))
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        response = OrderedDict()
+        if self.count is not None:
+            response['count'] = self.count
+        response['next'] = self.get_keyset_next_link()
+        response['results'] = data
+        return Response(response)
+
+
+class KeysetPagination(HybridPagination):
+    keyset_by_default = True
+    # Offset pages (for ranked searches) are bounded too.
+    default_limit = KEYSET_PAGE_SIZE
+    max_limit = KEYSET_MAX_PAGE_SIZE
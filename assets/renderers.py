@@ -0,0 +1,12 @@
+from djangorestframework_camel_case.render import CamelCaseJSONRenderer
+
+
+class PrecamelizedJSONRenderer(CamelCaseJSONRenderer):
+    """Like CamelCaseJSONRenderer, but responses marked precamelized (whose
+    keys are already camelCase, like those of the fast list serializers in
+    assets.fast_serializers) skip the camelize() pass over the whole body."""
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = (renderer_context or {}).get('response')
+        if getattr(response, 'precamelized', False):
+            return super(CamelCaseJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+        return super().render(data, accepted_media_type, renderer_context)
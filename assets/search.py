@@ -0,0 +1,81 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramSimilarity
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+
+from assets.caching import bump_generation
+from assets.exporter import m2m_names
+from assets.models import Asset, AssetSearchIndex
+
+# Searching Assets with ILIKE '%term%' means scanning the whole table, and it
+# only covers the name. AssetSearchIndex keeps one row of searchable text per
+# Asset, with
+#   1) a weighted tsvector (name A, organization B, tags/services/types C,
+#      address D) behind a GIN index, for ranked full-text matches, and
+#   2) a trigram GIN index on the name, for fuzzy matches (typos and
+#      partial words),
+# so both kinds of match are index lookups however big the catalog gets.
+# Locations are searched by their own trigram indexes (on the name and the
+# street address).
+
+SEARCH_CONFIG = 'english'
+CHUNK_SIZE = 2000
+
+SEARCH_VECTOR = (SearchVector('name', weight='A', config=SEARCH_CONFIG)
+    + SearchVector('organization_name', weight='B', config=SEARCH_CONFIG)
+    + SearchVector('keywords', weight='C', config=SEARCH_CONFIG)
+    + SearchVector('address', weight='D', config=SEARCH_CONFIG))
+
+
+def refresh_chunk(asset_ids):
+    rows = (Asset.objects.filter(pk__in=asset_ids)
+        .annotate(tag_names=m2m_names(Asset, 'tags', delimiter=' '),
+            service_names=m2m_names(Asset, 'services', delimiter=' '),
+            asset_type_titles=m2m_names(Asset, 'asset_types', 'title', delimiter=' '))
+        .values_list('id', 'name', 'organization__name', 'location__street_address', 'location__city',
+            'location__zip_code', 'tag_names', 'service_names', 'asset_type_titles'))
+    entries = []
+    for asset_id, name, organization_name, street_address, city, zip_code, *keywords in rows:
+        entries.append(AssetSearchIndex(asset_id=asset_id, name=name or '',
+            organization_name=organization_name or '',
+            address=' '.join(part for part in [street_address, city, zip_code] if part),
+            keywords=' '.join(k for k in keywords if k)))
+    with transaction.atomic():
+        AssetSearchIndex.objects.filter(asset_id__in=asset_ids).delete()
+        AssetSearchIndex.objects.bulk_create(entries, batch_size=1000)
+        AssetSearchIndex.objects.filter(asset_id__in=asset_ids).update(search_vector=SEARCH_VECTOR)
+    return len(entries)
+
+def refresh_search_index(asset_ids=None):
+    """Rebuild the AssetSearchIndex rows of the given Assets (or of all of
+    them), a chunk at a time. Returns the number of rows written."""
+    if asset_ids is None:
+        asset_ids = list(Asset.objects.order_by('id').values_list('id', flat=True))
+        AssetSearchIndex.objects.exclude(asset_id__in=Asset.objects.all()).delete()
+    else:
+        asset_ids = sorted(set(asset_ids))
+    written = 0
+    for k in range(0, len(asset_ids), CHUNK_SIZE):
+        written += refresh_chunk(asset_ids[k:k+CHUNK_SIZE])
+    # Cached ?q= responses (and their ETags) that were built from the old rows
+    # go stale now, which may be well after the change that called for this
+    # (when it runs as a background task).
+    bump_generation('search')
+    return written
+
+
+def search_assets(queryset, q):
+    """Filter an Asset queryset down to the full-text or fuzzy matches for q,
+    best matches first."""
+    query = SearchQuery(q, config=SEARCH_CONFIG)
+    return (queryset.filter(Q(search_index__search_vector=query) | Q(search_index__name__trigram_similar=q))
+        .annotate(search_rank=SearchRank(F('search_index__search_vector'), query) + TrigramSimilarity('search_index__name', q))
+        .order_by('-search_rank', 'id'))
+
+def search_locations(queryset, q):
+    """Filter a Location queryset down to the fuzzy matches for q (on the name
+    or street address), best matches first."""
+    return (queryset.filter(Q(name__trigram_similar=q) | Q(street_address__trigram_similar=q)
+            | Q(street_address__icontains=q)) # (The trigram indexes answer ILIKE too.)
+        .annotate(search_rank=Greatest(TrigramSimilarity('name', q), TrigramSimilarity('street_address', q)))
+        .order_by('-search_rank', 'id'))
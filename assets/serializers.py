@@ -1,3 +1,6 @@
+from collections import defaultdict
+
+from django.db import models
 from rest_framework import serializers
 from rest_framework_gis.serializers import (
     GeoFeatureModelSerializer,
@@ -15,6 +18,57 @@ from assets.models import (
 )
 
 
+def attach_asset_types(assets):
+    """Load the asset types (with their Categories) of the given Assets with
+    one query on the through table, in the order they were linked (by the
+    through-table ID), like in AssetQuerySet.with_first_asset_type, so that the
+    API shows the same first type and category as the map, the tiles, and the
+    GeoJSON. Each Asset gets them as linked_asset_types, along with
+    linked_category (the category of the first type, as in Asset.category)."""
+    asset_types = defaultdict(list)
+    links = (Asset.asset_types.through.objects.filter(asset_id__in=[asset.id for asset in assets])
+        .select_related('assettype__category').order_by('id'))
+    for link in links:
+        asset_types[link.asset_id].append(link.assettype)
+    for asset in assets:
+        asset.linked_asset_types = asset_types[asset.id]
+        asset.linked_category = asset.linked_asset_types[0].category if asset.linked_asset_types else None
+    return assets
+
+
+class LinkedAssetTypesListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        assets = list(data.all() if isinstance(data, models.Manager) else data)
+        return super().to_representation(attach_asset_types(assets))
+
+
+class LinkedAssetTypesMixin:
+    """For Asset serializers that render asset_types and category from
+    linked_asset_types and linked_category (see attach_asset_types), which are
+    loaded for a whole list at once (through LinkedAssetTypesListSerializer,
+    set as the Meta.list_serializer_class) or for one Asset on its own."""
+    def to_representation(self, instance):
+        if not hasattr(instance, 'linked_asset_types'):
+            attach_asset_types([instance])
+        return super().to_representation(instance)
+
+
+class EagerLoadingMixin:
+    """Lets a serializer declare the related objects it is going to touch, so
+    that views can fetch them up front instead of issuing a few queries per
+    serialized object."""
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        if cls.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*cls.prefetch_related_fields)
+        return queryset
+
+
 class RecursiveField(serializers.Serializer):
     def to_representation(self, value):
         serializer = self.parent.__class__(
@@ -78,17 +132,31 @@ class DataSourceSerializer(serializers.ModelSerializer):
         fields = ['name', 'url']
 
 
-class AssetSerializer(serializers.ModelSerializer):
+class AssetSerializer(LinkedAssetTypesMixin, EagerLoadingMixin, serializers.ModelSerializer):
     organization = OrganizationSerializer()
     location = LocationSerializer()
     services = ProvidedServiceSerializer(many=True)
     hard_to_count_population = TargetPopulationSerializer(many=True)
     data_source = DataSourceSerializer()
-    asset_types = AssetTypeSerializer(many=True)
-    category = CategorySerializer()
+    asset_types = AssetTypeSerializer(many=True, source='linked_asset_types')
+    category = CategorySerializer(source='linked_category')
+
+    # parent_location is serialized through RecursiveField, so only the first
+    # level of parents is joined here. Deeper chains are rare enough to be
+    # left to lazy loading.
+    select_related_fields = (
+        'organization__location__parent_location',
+        'location__parent_location',
+        'data_source',
+    )
+    prefetch_related_fields = (
+        'services',
+        'hard_to_count_population',
+    )
 
     class Meta:
         model = Asset
+        list_serializer_class = LinkedAssetTypesListSerializer
         fields = [
             'id',
             'name',
@@ -120,12 +188,15 @@ class AssetSerializer(serializers.ModelSerializer):
         ]
 
 
-class AssetListSerializer(serializers.ModelSerializer):
-    asset_types = AssetTypeSerializer(many=True)
-    category = CategorySerializer()
+class AssetListSerializer(LinkedAssetTypesMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    # organization is rendered as a primary key, which comes from
+    # organization_id without a join.
+    asset_types = AssetTypeSerializer(many=True, source='linked_asset_types')
+    category = CategorySerializer(source='linked_category')
 
     class Meta:
         model = Asset
+        list_serializer_class = LinkedAssetTypesListSerializer
         fields = [
             'id',
             'name',
@@ -135,10 +206,13 @@ class AssetListSerializer(serializers.ModelSerializer):
         ]
 
 
-class AssetGeoJsonSerializer(GeoFeatureModelSerializer):
+class AssetGeoJsonSerializer(EagerLoadingMixin, GeoFeatureModelSerializer):
     geom = GeometrySerializerMethodField()
     asset_types = AssetTypeSerializer(many=True)
 
+    select_related_fields = ('location',)
+    prefetch_related_fields = ('asset_types',)
+
     def get_geom(self, obj):
         return obj.location.geom
 
@@ -0,0 +1,92 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from assets.caching import bump_generation
+from assets.models import Asset, AssetType, Category, DataSource, Location, Organization, Tag, ProvidedService, TargetPopulation
+from assets.search import refresh_search_index
+from assets.tasks import queue_carto_sync, refresh_linked_search_text
+
+# Each of these bumps a generation counter (see assets.caching), which invalidates
+# the cached tiles and API responses that were built from that kind of data.
+
+@receiver([post_save, post_delete], sender=Asset)
+def asset_changed(sender, **kwargs):
+    bump_generation('asset')
+
+@receiver(post_save, sender=Asset)
+def asset_saved(sender, instance, **kwargs):
+    refresh_search_index([instance.id])
+
+@receiver(m2m_changed, sender=Asset.asset_types.through)
+@receiver(m2m_changed, sender=Asset.tags.through)
+@receiver(m2m_changed, sender=Asset.services.through)
+@receiver(m2m_changed, sender=Asset.hard_to_count_population.through)
+def asset_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # Clearing from the other side (like tag.asset_set.clear()) doesn't say
+        # which Assets were linked, so note them before the links go.
+        field = next(f for f in Asset._meta.many_to_many if f.remote_field.through is sender)
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        cleared = getattr(instance, '_cleared_asset_ids', {})
+        cleared[sender] = list(sender.objects.filter(**{f'{target}_id': instance.pk}).values_list(f'{source}_id', flat=True))
+        instance._cleared_asset_ids = cleared
+    if action in ['post_add', 'post_remove', 'post_clear']:
+        bump_generation('asset')
+        # Linking doesn't save the Asset, but the API's ETags are computed from
+        # last_updated (see assets.caching.ConditionalGetMixin), so touch it.
+        if action == 'post_clear' and reverse:
+            asset_ids = getattr(instance, '_cleared_asset_ids', {}).pop(sender, [])
+        else:
+            asset_ids = pk_set if reverse else [instance.pk]
+        if asset_ids:
+            Asset.objects.filter(pk__in=asset_ids).update(last_updated=timezone.now())
+            if sender is not Asset.hard_to_count_population.through: # (Not part of the search text.)
+                refresh_search_index(asset_ids)
+
+@receiver([post_save, post_delete], sender=Location)
+def location_changed(sender, **kwargs):
+    bump_generation('location')
+
+@receiver([post_save, post_delete], sender=Organization)
+def organization_changed(sender, **kwargs):
+    bump_generation('organization')
+
+@receiver([post_save, post_delete], sender=AssetType)
+def asset_type_changed(sender, **kwargs):
+    bump_generation('asset_type')
+
+@receiver([post_save, post_delete], sender=Tag)
+def tag_changed(sender, **kwargs):
+    bump_generation('search') # Tags only show up in the API through ?q= search.
+
+# The search text of an Asset includes the names of these related instances.
+@receiver(post_save, sender=Location)
+@receiver(post_save, sender=Organization)
+@receiver(post_save, sender=AssetType)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=ProvidedService)
+def search_text_changed(sender, instance, created, **kwargs):
+    if created:
+        return # Nothing links to it yet.
+    lookup = {Location: 'location', Organization: 'organization', AssetType: 'asset_types',
+        Tag: 'tags', ProvidedService: 'services'}[sender]
+    # There can be thousands of linked Assets, so they get reindexed in the
+    # background (once the new text has been committed).
+    transaction.on_commit(lambda: refresh_linked_search_text(lookup, instance.pk))
+
+@receiver([post_save, post_delete], sender=Category)
+def category_changed(sender, **kwargs):
+    bump_generation('category')
+
+# AssetSerializer renders services, hard_to_count_population, and data_source.
+@receiver([post_save, post_delete], sender=ProvidedService)
+@receiver([post_save, post_delete], sender=TargetPopulation)
+@receiver([post_save, post_delete], sender=DataSource)
+def asset_attribute_changed(sender, **kwargs):
+    bump_generation('asset_attribute')
+
+@receiver(post_delete, sender=Asset)
+def asset_deleted(sender, instance, **kwargs):
+    queue_carto_sync([instance.id]) # The flush removes it from the Carto table.
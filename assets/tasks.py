@@ -1,11 +1,131 @@
+import json, os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import timedelta
+
+from huey import crontab
 from huey.contrib.djhuey import periodic_task, task
-from assets.models import Asset
-from assets.util_carto import sync_asset_to_carto
+from assets.models import Asset, AssetDump, BulkUpdateJob, PendingCartoSync
+from assets.search import refresh_search_index
+from assets.util_carto import CartoSyncSession
+
+# Saves within this many seconds of the first queued one get pushed to Carto together.
+CARTO_SYNC_COALESCE_SECONDS = getattr(settings, 'CARTO_SYNC_COALESCE_SECONDS', 60)
+CARTO_SYNC_BATCH_SIZE = 500
+FLUSH_SCHEDULED_KEY = 'carto-sync-flush-scheduled'
 
 @task()
 def sync_assets_to_carto_eventually(asset_ids):
-    pushed = 0
-    for asset_id in asset_ids:
-        asset = Asset.objects.get(pk = asset_id)
-        pushed, _ = sync_asset_to_carto(asset, [asset_id], pushed, [], records_per_request=1)
-    print(f"Pushed {pushed} Assets to Carto.")
+    session = CartoSyncSession()
+    assets = Asset.objects.filter(pk__in=asset_ids)
+    existing_ids = [int(i) for i in session.get_asset_ids(asset_ids)]
+    counts = session.sync_assets(assets, existing_ids=existing_ids)
+    # Assets that have been deleted since being queued should come off the map too.
+    found_ids = set(assets.values_list('id', flat=True))
+    session.delete_assets([i for i in existing_ids if i not in found_ids])
+    print(f"Pushed {counts['updated'] + counts['inserted']} Assets to Carto.")
+
+def queue_carto_sync(asset_ids):
+    """Queue Assets to be pushed to Carto. Rather than syncing right away, the
+    IDs are recorded in PendingCartoSync (where repeated IDs collapse into one
+    row) and the first call in each window schedules a flush."""
+    now = timezone.now()
+    asset_ids = list(dict.fromkeys(asset_ids))
+    for k in range(0, len(asset_ids), CARTO_SYNC_BATCH_SIZE):
+        batch = asset_ids[k:k+CARTO_SYNC_BATCH_SIZE]
+        # Insert the new IDs and then bump queued_at for all of them (including
+        # the ones already waiting), in two queries per batch.
+        PendingCartoSync.objects.bulk_create([PendingCartoSync(asset_id=asset_id, queued_at=now) for asset_id in batch],
+            ignore_conflicts=True)
+        PendingCartoSync.objects.filter(asset_id__in=batch).update(queued_at=now)
+    if cache.add(FLUSH_SCHEDULED_KEY, True, CARTO_SYNC_COALESCE_SECONDS):
+        flush_pending_carto_syncs.schedule(delay=CARTO_SYNC_COALESCE_SECONDS)
+
+@task()
+def flush_pending_carto_syncs():
+    # Clear the flag first so that anything queued from here on schedules
+    # another flush instead of being stranded.
+    cache.delete(FLUSH_SCHEDULED_KEY)
+    started = timezone.now()
+    asset_ids = list(PendingCartoSync.objects.filter(queued_at__lte=started).values_list('asset_id', flat=True))
+    try:
+        for k in range(0, len(asset_ids), CARTO_SYNC_BATCH_SIZE):
+            batch = asset_ids[k:k+CARTO_SYNC_BATCH_SIZE]
+            sync_assets_to_carto_eventually.call_local(batch)
+            # Assets queued again since the flush started stay in the queue.
+            PendingCartoSync.objects.filter(asset_id__in=batch, queued_at__lte=started).delete()
+    except Exception:
+        # The unsynced rows are still queued; try them again after another
+        # window rather than waiting for the next save to schedule a flush.
+        if cache.add(FLUSH_SCHEDULED_KEY, True, CARTO_SYNC_COALESCE_SECONDS):
+            flush_pending_carto_syncs.schedule(delay=CARTO_SYNC_COALESCE_SECONDS)
+        raise
+
+@periodic_task(crontab(minute='*/15'))
+def flush_stranded_carto_syncs():
+    """A fallback for queued Assets whose flush never happened or failed
+    partway (say the worker died mid-push, or the scheduling flag was lost
+    from the cache), which would otherwise wait for some unrelated save to
+    schedule a flush."""
+    cutoff = timezone.now() - timedelta(seconds=2*CARTO_SYNC_COALESCE_SECONDS)
+    if PendingCartoSync.objects.filter(queued_at__lte=cutoff).exists():
+        flush_pending_carto_syncs.call_local()
+
+@task()
+def refresh_linked_search_text(lookup, pk):
+    """Rebuild the search index rows of the Assets linked (through lookup,
+    like 'tags') to a renamed Location, Organization, asset type, tag, or
+    service, which can be thousands of them (see assets.signals)."""
+    refresh_search_index(Asset.objects.filter(**{lookup: pk}).values_list('id', flat=True))
+
+@task()
+def run_bulk_update_job(job_id):
+    """Run an uploaded merge-instructions file through the Asset updater,
+    recording the progress on the BulkUpdateJob as it goes."""
+    from assets.asset_updater import AssetUpdater, read_merge_instructions # (assets.asset_updater imports this module.)
+    job = BulkUpdateJob.objects.get(pk=job_id)
+    job.status = BulkUpdateJob.RUNNING
+    job.save()
+
+    def record_progress(updater):
+        BulkUpdateJob.objects.filter(pk=job_id).update(rows_processed=updater.rows_processed,
+            errors=updater.errors, more_results=json.dumps(updater.more_results))
+
+    status = BulkUpdateJob.FAILED
+    try:
+        rows = read_merge_instructions(job.file_path)
+        BulkUpdateJob.objects.filter(pk=job_id).update(rows_total=len(rows))
+        updater = AssetUpdater(rows, job.mode, job.using, progress=record_progress)
+        updater.run()
+        if not updater.errors:
+            status = BulkUpdateJob.DONE
+    except Exception as e:
+        job.refresh_from_db()
+        more_results = json.loads(job.more_results) + [f"The update failed with an unexpected error: {e!r}"]
+        BulkUpdateJob.objects.filter(pk=job_id).update(errors=job.errors + 1, more_results=json.dumps(more_results))
+        raise
+    finally:
+        BulkUpdateJob.objects.filter(pk=job_id).update(status=status, finished_at=timezone.now())
+        if os.path.exists(job.file_path):
+            os.remove(job.file_path)
+
+@task()
+def dump_assets_to_file(dump_id):
+    from assets.dumps import write_dump, remove_old_dumps
+    dump = AssetDump.objects.get(pk=dump_id)
+    dump.status = AssetDump.RUNNING
+    dump.started_at = timezone.now()
+    dump.record_count = Asset.objects.count()
+    dump.save()
+    try:
+        dump.file_name = write_dump(dump)
+        dump.status = AssetDump.DONE
+    except Exception:
+        dump.status = AssetDump.FAILED
+        raise
+    finally:
+        dump.finished_at = timezone.now()
+        dump.save()
+    remove_old_dumps(dump)
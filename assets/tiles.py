@@ -0,0 +1,107 @@
+import math
+
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.core.cache import cache
+from django.db import connection
+
+from assets.caching import get_generations
+from assets.marker_offsets import offset_asset_rows
+from assets.models import Asset
+
+WEB_MERCATOR_HALF_WIDTH = 20037508.342789244 # meters
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+TILE_LAYER_NAME = 'assets'
+MAX_ZOOM = 22
+TILE_CACHE_TIMEOUT = getattr(settings, 'ASSET_TILE_CACHE_TIMEOUT', 7*24*60*60)
+
+# The marker offsets for Assets that share a Location are computed in Python
+# by assets.marker_offsets (so they match the Carto table and the GeoJSON
+# export) and handed to PostGIS as arrays, which only has to encode them.
+# Sensitive Assets stay in the tiles (as they stay in the Carto table), with
+# the same nullable 'sensitive' flag that the map styles them by.
+TILE_SQL = """
+WITH bounds AS (
+    SELECT ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 3857) AS envelope
+),
+features AS (
+    SELECT f.id, f.name, f.asset_type, f.asset_type_title, f.category, f.category_title, f.sensitive,
+        ST_AsMVTGeom(
+            ST_Transform(ST_SetSRID(ST_MakePoint(f.longitude, f.latitude), 4326), 3857),
+            (SELECT envelope FROM bounds), %(extent)s, %(buffer)s, true
+        ) AS geom
+    FROM unnest(
+        %(ids)s::integer[], %(names)s::text[], %(asset_types)s::text[], %(asset_type_titles)s::text[],
+        %(categories)s::text[], %(category_titles)s::text[], %(sensitive)s::boolean[],
+        %(latitudes)s::float8[], %(longitudes)s::float8[]
+    ) AS f(id, name, asset_type, asset_type_title, category, category_title, sensitive, latitude, longitude)
+)
+SELECT ST_AsMVT(features, %(layer)s, %(extent)s, 'geom') FROM features WHERE geom IS NOT NULL
+"""
+
+def tile_is_valid(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z
+
+def tile_bounds(z, x, y):
+    """Return the (xmin, ymin, xmax, ymax) Web Mercator bounds of a tile
+    in the XYZ scheme."""
+    tile_width = 2*WEB_MERCATOR_HALF_WIDTH/2**z
+    xmin = -WEB_MERCATOR_HALF_WIDTH + x*tile_width
+    ymax = WEB_MERCATOR_HALF_WIDTH - y*tile_width
+    return xmin, ymax - tile_width, xmin + tile_width, ymax
+
+def mercator_to_lnglat(x, y):
+    longitude = x/WEB_MERCATOR_HALF_WIDTH*180
+    latitude = math.degrees(math.atan(math.sinh(y/WEB_MERCATOR_HALF_WIDTH*math.pi)))
+    return longitude, latitude
+
+def render_asset_tile(z, x, y):
+    """Build a Mapbox vector tile of displayable Assets in the database."""
+    xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+    tile_width = xmax - xmin
+    # Pull in points a little beyond the tile so that markers within the
+    # buffer (and markers nudged by the overlap offset) aren't clipped.
+    margin = tile_width*TILE_BUFFER/TILE_EXTENT + 10
+    west, south = mercator_to_lnglat(max(xmin - margin, -WEB_MERCATOR_HALF_WIDTH), max(ymin - margin, -WEB_MERCATOR_HALF_WIDTH))
+    east, north = mercator_to_lnglat(min(xmax + margin, WEB_MERCATOR_HALF_WIDTH), min(ymax + margin, WEB_MERCATOR_HALF_WIDTH))
+    area = Polygon.from_bbox((west, south, east, north))
+    area.srid = 4326
+    rows = [row for row in offset_asset_rows(Asset.objects.filter(location__geom__contained=area))
+        if row['do_not_display'] != True]
+    if not rows:
+        return b''
+
+    params = {
+        'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax,
+        'extent': TILE_EXTENT,
+        'buffer': TILE_BUFFER,
+        'layer': TILE_LAYER_NAME,
+        'ids': [row['id'] for row in rows],
+        'names': [row['name'] for row in rows],
+        'asset_types': [row['asset_type'] for row in rows],
+        'asset_type_titles': [row['asset_type_title'] for row in rows],
+        'categories': [row['category'] for row in rows],
+        'category_titles': [row['category_title'] for row in rows],
+        'sensitive': [row['sensitive'] for row in rows],
+        'latitudes': [row['latitude'] for row in rows],
+        'longitudes': [row['longitude'] for row in rows],
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(TILE_SQL, params)
+        row = cursor.fetchone()
+    return bytes(row[0]) if row and row[0] is not None else b''
+
+def tile_cache_key(z, x, y):
+    # Saving an Asset, a Location, an asset type, or a category bumps its generation,
+    # which moves every tile to a new key (leaving the old entries to expire).
+    generations = ':'.join(str(g) for g in get_generations(['asset', 'location', 'asset_type', 'category']))
+    return f"asset-tile:{generations}:{z}:{x}:{y}"
+
+def get_asset_tile(z, x, y):
+    key = tile_cache_key(z, x, y)
+    tile = cache.get(key)
+    if tile is None:
+        tile = render_asset_tile(z, x, y)
+        cache.set(key, tile, TILE_CACHE_TIMEOUT)
+    return tile
@@ -1,8 +1,9 @@
-from django.urls import re_path
+from django.urls import path, re_path
 
 from rest_framework import routers
 
-from assets.views import AssetViewSet, AssetTypeViewSet, CategoryViewSet, LocationViewSet
+from assets.views import AssetViewSet, AssetTypeViewSet, CategoryViewSet, LocationViewSet, stream_assets_geojson, \
+    asset_tile
 
 # register DRF Views and ViewSets
 router = routers.DefaultRouter()
@@ -11,7 +12,12 @@ router.register(r'asset-types', AssetTypeViewSet)
 router.register(r'categories', CategoryViewSet)
 router.register(r'locations', LocationViewSet)
 
-urlpatterns = [ ]
+urlpatterns = [
+    # The whole displayable catalog as one streamed GeoJSON FeatureCollection.
+    re_path(r'^assets-geojson/$', stream_assets_geojson, name='assets-geojson'),
+    # Mapbox vector tiles of displayable assets.
+    path('tiles/<int:z>/<int:x>/<int:y>.pbf', asset_tile, name='asset-tile'),
+]
 
 # appends registered API urls to `urlpatterns`
 urlpatterns += router.urls
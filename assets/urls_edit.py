@@ -1,6 +1,6 @@
 from django.urls import path, re_path
 
-from assets.views import upload_file, request_asset_dump
+from assets.views import upload_file, bulk_update_job, bulk_update_job_progress, request_asset_dump
 
 urlpatterns = []
 
@@ -9,5 +9,7 @@ urlpatterns = []
 # and that handle bulk database edits.
 urlpatterns = [
     path('update-assets/<using>/', upload_file, name='update-assets'),
+    path('update-assets/<using>/jobs/<int:job_id>/', bulk_update_job, name='bulk-update-job'),
+    path('update-assets/jobs/<int:job_id>/progress/', bulk_update_job_progress, name='bulk-update-job-progress'),
     re_path(r'^dump_assets/', request_asset_dump, name='request_asset_dump'),
 ]
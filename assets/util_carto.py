@@ -3,6 +3,10 @@ from operator import itemgetter
 from carto.auth import APIKeyAuthClient
 from carto.sql import SQLClient
 from parameters.credentials import CARTO_API_KEY
+from django.db.models import QuerySet
+
+from assets.marker_offsets import MARKER_OFFSET_RADIUS, offset_asset_rows, offset_coordinates
+from assets.models import Asset
 
 USERNAME = "wprdc"
 USR_BASE_URL = "https://{user}.carto.com/".format(user=USERNAME)
@@ -13,6 +17,18 @@ DEFAULT_CARTO_FIELDS = ['id', 'name', 'asset_type', 'asset_type_title',
 
 TABLE_NAME = 'assets_v1'
 
+MAX_QUERY_LENGTH = 16384 # Batched statements get split to stay under this length.
+
+NUMERIC_CARTO_FIELDS = ['id', 'latitude', 'longitude', 'location_id']
+CARTO_FIELD_TYPES = {
+    'id': 'numeric',
+    'latitude': 'float8',
+    'longitude': 'float8',
+    'location_id': 'numeric',
+    'sensitive': 'boolean',
+    'do_not_display': 'boolean',
+}
+
 def validate_asset(asset):
     """ Checks that an Asset has geocoordinates and (therefore) belongs on Carto."""
     if getattr(getattr(asset, 'location', None), 'latitude', None) not in [None, 0] and getattr(getattr(asset, 'location', None), 'latitude', None) not in [None, 0]:
@@ -30,150 +46,231 @@ def sql_escape(s):
     s = re.sub("'", '"', s)
     return s
 
-def extract_values_from_model(asset, fields):
-    values = []
-
-    for field in fields:
+def first_asset_type(asset):
+    """Return the first of the Asset's asset types in the order they were linked
+    (as in AssetQuerySet.with_first_asset_type, which the tiles and the GeoJSON
+    use), or None if it has none."""
+    link = (Asset.asset_types.through.objects.filter(asset_id=asset.id)
+        .select_related('assettype__category').order_by('id').first())
+    return None if link is None else link.assettype
+
+def carto_value_from_model(asset, field):
+    if field in ['asset_type', 'asset_type_title', 'category', 'category_title']:
+        # Here, we are explicitly ignoring asset types beyond the first
+        # (because the new policy is one asset type per Asset), though this
+        # could be rectified by returning a list of values strings and
+        # modifying the code on the other end.
+        asset_type = first_asset_type(asset)
+        if asset_type is None:
+            return None
         if field == 'asset_type':
-            value = asset.asset_types.all()[0].name # Here, we are explicitly ignoring
-            # asset types beyond the first (because the new policy is one
-            # asset type per Asset), though this could be rectified by
-            # returning a list of values strings and modifying the code on the
-            # other end.
-        elif field == 'asset_type_title':
-            value = asset.asset_types.all()[0].title
-        elif field == 'category':
-            value = asset.asset_types.all()[0].category.name
-        elif field == 'category_title':
-            value = asset.asset_types.all()[0].category.title
-        elif field in ['latitude', 'longitude']:
-            value = getattr(getattr(asset, 'location', None), field, None)
-        elif field == 'location_id':
-            value = getattr(getattr(asset, 'location', None), 'id', None)
+            return asset_type.name
+        if field == 'asset_type_title':
+            return asset_type.title
+        category = asset_type.category
+        if category is None:
+            return None
+        return category.name if field == 'category' else category.title
+    if field in ['latitude', 'longitude']:
+        return getattr(getattr(asset, 'location', None), field, None)
+    if field == 'location_id':
+        return getattr(getattr(asset, 'location', None), 'id', None)
+    return getattr(asset, field, None)
+
+def carto_row_from_model(asset_dict, fields):
+    """Convert {'asset': asset, 'latitude': ..., 'longitude': ...} (where the
+    geocoordinates may have been offset) to a dict of Carto field values."""
+    row = {field: carto_value_from_model(asset_dict['asset'], field) for field in fields}
+    if 'latitude' in row:
+        row['latitude'] = asset_dict['latitude']
+    if 'longitude' in row:
+        row['longitude'] = asset_dict['longitude']
+    return row
+
+def sql_value(field, value):
+    """Format a value as a SQL literal for the Carto API."""
+    if field in ['sensitive', 'do_not_display']:
+        if type(value) == bool:
+            return boolean_to_string(value)
+        elif value in ['True', 'False']:
+            return value.upper()
+        elif value in ['', None]:
+            return "NULL"
+        raise ValueError(f"It's unclear what to do with a boolean value of {value}.")
+        # I theorized that there needed to be values for these fields because I thought null values
+        # caused them to not make it from the Carto dataset to the assets.wprdc.org map.
+        # This was wrong. There are records already on the map that have values of "null" for
+        # the 'sensitive' field and "" for the do_not_display field.
+    if value is None:
+        return "NULL"
+    if field in NUMERIC_CARTO_FIELDS:
+        return str(value)
+    value = sql_escape(str(value))
+    return f"'{value}'"
+
+def extract_values_from_model(asset, fields):
+    return [sql_value(field, carto_value_from_model(asset, field)) for field in fields]
+
+def geom_sql(longitude, latitude):
+    """SQL for the_geom and the_geom_webmercator, which Carto does not fill in
+    for rows written through the SQL API."""
+    point = f"ST_SetSRID(ST_MakePoint({longitude}, {latitude}), 4326)"
+    return point, f"ST_Transform({point}, 3857)"
+
+def pack_statements(prefix, items, suffix, max_length, separator=', '):
+    """Join items into as few statements (prefix + items + suffix) as
+    possible while keeping each statement shorter than max_length."""
+    statements = []
+    current = []
+    length = len(prefix) + len(suffix)
+    for item in items:
+        if len(prefix) + len(item) + len(suffix) >= max_length:
+            raise ValueError(f"A single item is too long to fit in a {max_length}-character query: {item[:200]}...")
+        if current and length + len(separator) + len(item) >= max_length:
+            statements.append(prefix + separator.join(current) + suffix)
+            current = []
+            length = len(prefix) + len(suffix)
+        current.append(item)
+        length += len(item) + len(separator)
+    if current:
+        statements.append(prefix + separator.join(current) + suffix)
+    return statements
+
+def marker_offset_coordinates(a):
+    """Compute geocoordinate offsets to distinguish overlapping assets (that is,
+    Assets that share a Location). To do this for many Assets, use
+    assets.marker_offsets.offset_coordinates, which takes one query for all of them."""
+    return offset_coordinates([a.id])[a.id]
+
+
+class CartoSyncSession:
+    """A batch of work against the Carto table over one authenticated HTTP
+    session (the requests.Session inside APIKeyAuthClient).
+
+    Deletes are packed into DELETE ... WHERE id IN (...), updates into
+    multi-row UPDATE ... FROM (VALUES ...) statements, and inserts into
+    multi-row INSERTs. Each statement is kept under max_query_length, and
+    the_geom/the_geom_webmercator are set in the same statement, so no
+    follow-up fix_carto_geofields pass is needed."""
+
+    def __init__(self, table_name=TABLE_NAME, fields=None, max_query_length=MAX_QUERY_LENGTH):
+        self.table_name = table_name
+        self.fields = list(fields or DEFAULT_CARTO_FIELDS)
+        self.max_query_length = max_query_length
+        self.auth_client = APIKeyAuthClient(api_key=CARTO_API_KEY, base_url=USR_BASE_URL)
+        self.sql = SQLClient(self.auth_client)
+        self.requests_sent = 0
+
+    def send(self, q):
+        self.requests_sent += 1
+        return self.sql.send(q)
+
+    def get_asset_ids(self, ids_to_check=None):
+        if ids_to_check is None:
+            results = self.send(f"SELECT id FROM {self.table_name}")
+            return [r['id'] for r in results['rows']]
+        ids = []
+        for q in pack_statements(f"SELECT id FROM {self.table_name} WHERE id IN (", [str(int(i)) for i in ids_to_check], ")", self.max_query_length):
+            ids += [r['id'] for r in self.send(q)['rows']]
+        return ids
+
+    def delete_assets(self, asset_ids):
+        for q in pack_statements(f"DELETE FROM {self.table_name} WHERE id IN (", [str(int(i)) for i in asset_ids], ")", self.max_query_length):
+            self.send(q)
+        return len(asset_ids)
+
+    def update_assets(self, rows):
+        """Update existing Carto records from a list of dicts of field values
+        (which must include 'id', 'latitude' and 'longitude')."""
+        fields = list(rows[0].keys()) if rows else []
+        other_fields = [f for f in fields if f != 'id']
+        # The VALUES columns may come through as text (e.g., when a column is all
+        # NULLs), so cast them back to the types of the Carto columns.
+        assignments = [f"{f} = v.{f}::{CARTO_FIELD_TYPES.get(f, 'text')}" for f in other_fields]
+        the_geom, the_geom_webmercator = geom_sql('v.longitude::float8', 'v.latitude::float8')
+        assignments += [f"the_geom = {the_geom}", f"the_geom_webmercator = {the_geom_webmercator}"]
+        prefix = f"UPDATE {self.table_name} AS t SET {', '.join(assignments)} FROM (VALUES "
+        suffix = f") AS v({', '.join(fields)}) WHERE t.id = v.id::numeric;"
+        tuples = [f"({', '.join(sql_value(f, row[f]) for f in fields)})" for row in rows]
+        for q in pack_statements(prefix, tuples, suffix, self.max_query_length):
+            self.send(q)
+        return len(rows)
+
+    def insert_assets(self, rows):
+        """Insert new Carto records from a list of dicts of field values."""
+        fields = list(rows[0].keys()) if rows else []
+        prefix = f"INSERT INTO {self.table_name} ({', '.join(fields + ['the_geom', 'the_geom_webmercator'])}) VALUES "
+        tuples = []
+        for row in rows:
+            values = [sql_value(f, row[f]) for f in fields]
+            values += geom_sql(sql_value('longitude', row['longitude']), sql_value('latitude', row['latitude']))
+            tuples.append(f"({', '.join(values)})")
+        for q in pack_statements(prefix, tuples, ";", self.max_query_length):
+            self.send(q)
+        return len(rows)
+
+    def sync_assets(self, assets, existing_ids=None):
+        """Push a collection of Assets (a queryset or a list) to Carto: delete
+        the delisted ones, update the ones already there, and insert the rest.
+        The rows come from the same projection as the tiles and the GeoJSON
+        (offset_asset_rows), so the map gets the same asset type, category,
+        and marker offsets everywhere."""
+        if existing_ids is None:
+            existing_ids = self.get_asset_ids()
+        existing_ids = set(int(i) for i in existing_ids)
+        if isinstance(assets, QuerySet):
+            asset_ids = list(assets.order_by().values_list('id', flat=True))
         else:
-            value = getattr(asset, field, None)
-
-        if field in ['sensitive', 'do_not_display', 'the_geom', 'the_geom_webmercator']:
-            if type(value) == bool:
-                values.append(boolean_to_string(value))
-            elif value in ['True', 'False']:
-                values.append(value.upper())
-            elif value in ['', None]:
-                values.append("NULL")
+            asset_ids = [a.id for a in assets]
+        hidden_ids = set(Asset.objects.filter(pk__in=asset_ids, do_not_display=True).values_list('id', flat=True))
+        to_delete = [i for i in asset_ids if i in hidden_ids and i in existing_ids]
+        to_update, to_insert = [], []
+        for row in offset_asset_rows(Asset.objects.filter(pk__in=asset_ids)):
+            if row['do_not_display'] == True:
+                continue
+            if row['latitude'] in [None, 0] or row['longitude'] in [None, 0]: # See validate_asset.
+                continue
+            carto_row = {field: row[field] for field in self.fields} # (A missing asset type or category is NULL.)
+            if row['id'] in existing_ids:
+                to_update.append(carto_row)
             else:
-                raise ValueError(f"It's unclear what to do with a boolean value of {value}.")
-            # I theorized that there needed to be values for these fields because I thought null values
-            # caused them to not make it from the Carto dataset to the assets.wprdc.org map.
-            # This was wrong. There are records already on the map that have values of "null" for
-            # the 'sensitive' field and "" for the do_not_display field.
-        elif field in ['id', 'latitude', 'longitude']:
-            values.append(str(value)) # Coerce to string for the join function below.
-        else:
-            value = sql_escape(str(value))
-            values.append(f"'{value}'")
-    return values
-
-def batch_values_string_from_model(asset_dict, fields):
-    asset = asset_dict['asset']
-    values = extract_values_from_model(asset, fields)
-    # Handle geocoordinates overrides
-    for f, v in zip(fields, values):
-        if f == 'latitude':
-            v = asset_dict['latitude']
-        elif f == 'longitude':
-            v = asset_dict['longitude']
-    return f"({', '.join(values)})"
-
-def set_string_from_model(asset_dict, fields):
-    asset = asset_dict['asset']
-    values = extract_values_from_model(asset, fields)
-    # Handle geocoordinates overrides
-    fields_values = {f: v for f, v in zip(fields, values)}
-    fields_values['latitude'] = asset_dict['latitude']
-    fields_values['longitude'] = asset_dict['longitude']
-    definitions = [f"{f} = {v}" for f, v in fields_values.items()]
-    return f"{', '.join(definitions)}"
+                to_insert.append(carto_row)
+        counts = {
+            'deleted': self.delete_assets(to_delete),
+            'updated': self.update_assets(to_update),
+            'inserted': self.insert_assets(to_insert),
+        }
+        print(f"Deleted {counts['deleted']}, updated {counts['updated']}, and inserted {counts['inserted']} Carto records in {self.requests_sent} requests.")
+        return counts
+
+
+_session = None
+
+def get_session():
+    """Return a CartoSyncSession that is shared by the module-level helpers
+    below (so that they reuse one HTTP connection)."""
+    global _session
+    if _session is None:
+        _session = CartoSyncSession()
+    return _session
 
 ### BEGIN Functions for modifying individual records on Carto
 def get_carto_asset_ids(id_to_check=None):
-    auth_client = APIKeyAuthClient(api_key=CARTO_API_KEY, base_url=USR_BASE_URL)
-    sql = SQLClient(auth_client)
     if id_to_check is None:
-        results = sql.send(f"SELECT id FROM {TABLE_NAME}")
-    else:
-        results = sql.send(f"SELECT id FROM {TABLE_NAME} WHERE id = {id_to_check}")
-    ids = [r['id'] for r in results['rows']]
-    return ids
+        return get_session().get_asset_ids()
+    return get_session().get_asset_ids([id_to_check])
 
 def delete_from_carto_by_id(asset_id):
-    auth_client = APIKeyAuthClient(api_key=CARTO_API_KEY, base_url=USR_BASE_URL)
-    sql = SQLClient(auth_client)
-    results = sql.send(f"DELETE from {TABLE_NAME} WHERE id ='{asset_id}'")
-    return results
+    return get_session().delete_assets([asset_id])
 
 def update_asset_on_carto(asset_dict, fields):
-    auth_client = APIKeyAuthClient(api_key=CARTO_API_KEY, base_url=USR_BASE_URL)
-    sql = SQLClient(auth_client)
-    #values_tuple_strings = [make_values_tuple_string_from_model(r, fields) for r in [asset]]
-    # OR POSSIBLY
-    #values_tuple_strings = [make_values_tuple_string_from_model(asset, fields)]
-
-
-    #q = f"UPDATE {TABLE_NAME} SET {values_tuple_strings} WHERE asset_id = {asset.id};"
-
-    #values_tuple_strings = [values_string_from_model(asset, fields)]
-    #q = f"UPDATE {TABLE_NAME} SET ({', '.join(fields + ['the_geom', 'the_geom_webmercator'])}) " \
-    #    f"VALUES {', '.join(map(lambda x: x + 1, values_tuple_strings))};" # This is throwing an
-    # error, and it's really not clear why it's trying to map a math function over strings.
-    # Let's ignore the the_geom* fields for now and do the update the simple way:
-
-    # Single updates can be done like this:
-    # UPDATE election_results SET votes=52, pro=24 WHERE county_id = 1;
-
-    other_fields = copy.deepcopy(fields)
-    other_fields.remove('id')
-    q = f"UPDATE {TABLE_NAME} SET {set_string_from_model(asset_dict, other_fields)} WHERE id = {asset_dict['asset'].id};"
-    assert len(q) < 16384
-    print(q)
-    results = sql.send(q)
+    return get_session().update_assets([carto_row_from_model(asset_dict, fields)])
 
 def insert_new_assets_into_carto(asset_dicts, fields):
-    auth_client = APIKeyAuthClient(api_key=CARTO_API_KEY, base_url=USR_BASE_URL)
-    sql = SQLClient(auth_client)
-    # q = f"INSERT INTO {table_name} (id, name, asset_type, asset_type_title, category, category_title, latitude, longitude) VALUES (202020, 'Zyzzlvaria Zoo', 'zoo', 'animal places', 'cool_stuff', 'Cool Stuff', 40.5195849005734, -80.0445997570883 );"
-    # results = sql.send(q)
-
-    # Example of how to insert a single record:
-    # q = f"INSERT INTO {table_name} (id, name, asset_type, asset_type_title, category, category_title, latitude, longitude) VALUES (112644, 'Ormsby Pool and Recreation Center', 'rec_centers', 'Rec Centers', 'civic', 'Civic', 40.4290817, -79.97429357);"
-
-    # Batch inserts can be done like this:
-    # INSERT INTO election_results (county_id,voters,pro)
-    # VALUES  (1, 11,8),
-    #        (12,21,10),
-    #        (78,31,27);
-
-    # map set of records into value tuple strings
-    #values_tuple_strings = [make_values_tuple_string(r, fields) for r in records]
-
-    extra_fields = ['the_geom', 'the_geom_webmercator']
-    fields_extended = fields + extra_fields
-    for a_dict in asset_dicts:
-        for f in extra_fields:
-            a_dict[f] = None
-
-    values_tuple_strings = [batch_values_string_from_model(a_dict, fields_extended) for a_dict in asset_dicts]
-
-    q = f"INSERT INTO {TABLE_NAME} ({', '.join(fields_extended)}) " \
-        f"VALUES {', '.join(values_tuple_strings)};"
-
-    assert len(q) < 16384
-    print(q)
-    results = sql.send(q)
+    return get_session().insert_assets([carto_row_from_model(a_dict, fields) for a_dict in asset_dicts])
 
 
 def sync_asset_to_carto(a, existing_ids, pushed, insert_list, records_per_request=100):
-    radius_offset = 0.00005 # This will be about 18 feet north/south and 15 feet east/west.
-
     if a.do_not_display == True:
         print(f"Deleting the record with ID {a.id} from Carto.")
         delete_from_carto_by_id(a.id)
@@ -182,22 +279,7 @@ def sync_asset_to_carto(a, existing_ids, pushed, insert_list, records_per_reques
     if not validate_asset(a):
         return pushed, insert_list
 
-    # Compute and apply geocoordinate offsets to distinguish overlapping assets
-    overlapping_assets = a.location.asset_set.all()
-    asset_types_and_names = [{'name': a.name, 'type': a.asset_types.all()[0].name, 'asset_id': a.id} for a in overlapping_assets]
-        # This assumes that there is only one asset type per asset, which is not enforced by the model,
-        # but which we have decided should be the case generally becausing mixing asset types may make
-        # things like operating hours poorly defined.
-    sorted_asset_types_and_names = sorted(asset_types_and_names, key=itemgetter('type', 'name'))
-    number_of_overlapping_assets = len(overlapping_assets)
-    n = [a['asset_id'] for a in sorted_asset_types_and_names].index(a.id)
-    if number_of_overlapping_assets > 1:
-        new_latitude  = a.location.latitude  + radius_offset*math.cos(n*2*math.pi/number_of_overlapping_assets)
-        new_longitude = a.location.longitude + radius_offset*math.sin(n*2*math.pi/number_of_overlapping_assets)
-        print(f"    ** Offsetting the marker for the asset named '{a.name}' with address {a.location.street_address} to ({new_latitude}, {new_longitude}). **   ")
-    else:
-        new_latitude = a.location.latitude
-        new_longitude = a.location.longitude
+    new_latitude, new_longitude = marker_offset_coordinates(a)
 
     if a.id in existing_ids:
         update_asset_on_carto({'asset': a, 'latitude': new_latitude, 'longitude': new_longitude}, DEFAULT_CARTO_FIELDS)
@@ -210,15 +292,15 @@ def sync_asset_to_carto(a, existing_ids, pushed, insert_list, records_per_reques
         print(f"Pushing {len(insert_list)} assets.")
         pushed += len(insert_list)
         insert_new_assets_into_carto(insert_list, DEFAULT_CARTO_FIELDS)
-        time.sleep(0.01)
         insert_list = []
     return pushed, insert_list
 
 ### END Functions for modifying individual records on Carto
 
 def fix_carto_geofields(asset_id=None):
-    auth_client = APIKeyAuthClient(api_key=CARTO_API_KEY, base_url=USR_BASE_URL)
-    sql = SQLClient(auth_client)
+    # CartoSyncSession now sets the geofields as it writes records, so this is
+    # only needed to repair rows written some other way.
+    sql = get_session()
     # Now the problem with pushing this data through SQL calls is that Carto does not rerun the
     # processes that add values for the_geom and the_geom_webmercator. So it kind of seems like
     # we have to do this ourselves as documented at
@@ -1,57 +1,59 @@
 import requests, math, time
+import numpy as np
 
+from django.conf import settings
 from asset_hound.settings import GEOCODER_API_KEY
 
-def distance_on_unit_sphere(lat1, long1, lat2, long2):
-    # Convert latitude and longitude to
-    # spherical coordinates in radians.
-    degrees_to_radians = math.pi/180.0
-
-    # phi = 90 - latitude
-    phi1 = (90.0 - lat1)*degrees_to_radians
-    phi2 = (90.0 - lat2)*degrees_to_radians
-
-    # theta = longitude
-    theta1 = long1*degrees_to_radians
-    theta2 = long2*degrees_to_radians
+session = requests.Session() # Reuse connections between geocoding requests.
 
-    # Compute spherical distance from spherical coordinates.
+EARTH_RADIUS_IN_FEET = 20.902*1000*1000
 
-    # For two locations in spherical coordinates
-    # (1, theta, phi) and (1, theta', phi')
-    # cosine( arc length ) =
-    # sin phi sin phi' cos(theta-theta') + cos phi cos phi'
-    # distance = rho * arc length
+def haversine_arc(lat1, long1, lat2, long2):
+    """Return the central angle (in radians) between points given in degrees.
+    The arguments can be numbers or NumPy arrays (which get broadcast against
+    each other), so this works for single pairs, paired arrays, or (with
+    lat1[:, None] and so on) whole matrices of distances.
 
-    cos = (math.sin(phi1)*math.sin(phi2)*math.cos(theta1 - theta2) +
-    math.cos(phi1)*math.cos(phi2))
+    The haversine formula is used because it stays accurate for nearby points,
+    where the spherical law of cosines (which this replaced) loses precision
+    and can push the acos argument slightly past 1."""
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(long2) - np.radians(long1)
+    a = np.sin(d_phi/2)**2 + np.cos(phi1)*np.cos(phi2)*np.sin(d_lambda/2)**2
+    return 2*np.arcsin(np.sqrt(np.clip(a, 0, 1)))
 
-    try:
-        arc = math.acos( cos )
-    except ValueError:
-        if 1.0 < cos < 1.01:
-            cos = 1
-        try:
-            arc = math.acos( cos )
-        except ValueError:
-            ic(cos)
-            raise
+def distance_on_unit_sphere(lat1, long1, lat2, long2):
     # Remember to multiply arc by the radius of the earth
     # in your favorite set of units to get length.
-    return arc
+    return float(haversine_arc(lat1, long1, lat2, long2))
 
 def distance(lat1, long1, lat2, long2):
     if lat1 in ['', None] or long1 in ['', None] or lat2 in ['', None] or long2 in ['', None]:
         return None # Don't try to calculate distances of invalid coordinates.
     arc = distance_on_unit_sphere(lat1, long1, lat2, long2)
-    R = 20.902*1000*1000 # in feet
+    R = EARTH_RADIUS_IN_FEET
     # Remember to multiply arc by the radius of the earth
     # in your favorite set of units to get length.
     return R*arc
 
+def paired_distances(lats1, longs1, lats2, longs2):
+    """Distances in feet between corresponding points of two sets of coordinates."""
+    return EARTH_RADIUS_IN_FEET*haversine_arc(np.asarray(lats1, dtype=float), np.asarray(longs1, dtype=float),
+        np.asarray(lats2, dtype=float), np.asarray(longs2, dtype=float))
+
+def distance_matrix(lats1, longs1, lats2=None, longs2=None):
+    """The matrix of distances in feet from every point in the first set to every
+    point in the second set (or to every other point in the first set)."""
+    lats1, longs1 = np.asarray(lats1, dtype=float), np.asarray(longs1, dtype=float)
+    if lats2 is None:
+        lats2, longs2 = lats1, longs1
+    lats2, longs2 = np.asarray(lats2, dtype=float), np.asarray(longs2, dtype=float)
+    return EARTH_RADIUS_IN_FEET*haversine_arc(lats1[:, None], longs1[:, None], lats2[None, :], longs2[None, :])
+
 def geocode_address_with_geomancer(address):
-    url = "https://tools.wprdc.org/geo/geocode?addr={}".format(address)
-    r = requests.get(url)
+    url = getattr(settings, 'GEOMANCER_URL', 'https://tools.wprdc.org/geo/geocode')
+    r = session.get(url, params={'addr': address}, timeout=getattr(settings, 'GEOCODE_TIMEOUT', 30))
     result = r.json()
     time.sleep(0.1)
     if result['data']['status'] == "OK":
@@ -60,14 +62,24 @@ def geocode_address_with_geomancer(address):
     print("Unable to geocode {}, failing with status code {}.".format(address, result['data']['status']))
     return None, None
 
-def geocode_address(address):
-    """ Takes a string address and attempts to geocode it using a remote geocoder
+def geocode_address(address, use_cache=True):
+    """ Takes a string address and attempts to geocode it, first checking the
+    geocode cache (see assets.geocoding) and then using a remote geocoder
 
     Returns ({float}, {float}) (lat,lng) tuple
+
+    To geocode many addresses, use assets.geocoding.BatchGeocoder.
     """
-    url = 'https://api.geocod.io/v1.4/geocode'
+    if use_cache:
+        from assets.geocoding import cached_geocode # (Imported here because assets.geocoding
+        # imports the models, which import this module.)
+        return cached_geocode(address, geocode_address_remotely)
+    return geocode_address_remotely(address)
+
+def geocode_address_remotely(address):
+    url = getattr(settings, 'GEOCODIO_URL', 'https://api.geocod.io/v1.4/') + 'geocode'
     try:
-        r = requests.get(url, params={'q': address, 'api_key': GEOCODER_API_KEY})
+        r = session.get(url, params={'q': address, 'api_key': GEOCODER_API_KEY}, timeout=getattr(settings, 'GEOCODE_TIMEOUT', 30))
         response_data = r.json()
         if 'error' in response_data:
             print(f"Geocodio response: {response_data['error']}")
@@ -0,0 +1 @@
+default_app_config = 'community_resources.apps.CommunityResourcesConfig'
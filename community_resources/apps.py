@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class CommunityResourcesConfig(AppConfig):
     name = 'community_resources'
+
+    def ready(self):
+        import community_resources.signals  # Connect the signal receivers.
@@ -0,0 +1,22 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from assets.caching import bump_generation
+
+# Resources and Communities are rendered with their categories, populations,
+# sections, and so on, so a change to any model in this app bumps the one
+# 'community_resources' generation (which the API's ETags are built from;
+# see assets.caching.ConditionalGetMixin).
+
+def is_community_resources_model(model):
+    return model._meta.app_label == 'community_resources'
+
+@receiver([post_save, post_delete])
+def community_resources_changed(sender, **kwargs):
+    if is_community_resources_model(sender):
+        bump_generation('community_resources')
+
+@receiver(m2m_changed)
+def community_resources_relations_changed(sender, instance, action, **kwargs):
+    if action in ['post_add', 'post_remove', 'post_clear'] and is_community_resources_model(type(instance)):
+        bump_generation('community_resources')